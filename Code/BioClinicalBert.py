@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import numpy as np
 import torch
@@ -9,6 +10,9 @@ from sklearn.utils.class_weight import compute_class_weight
 import torch.nn as nn
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'FinalCode', 'New'))
+from benchmark import MemorySampler
+
 # Define the dataset class
 class ICUNotesDataset(Dataset):
     def __init__(self, data, label_column, tokenizer, max_length=512):
@@ -16,53 +20,108 @@ class ICUNotesDataset(Dataset):
         self.label_column = label_column
         self.tokenizer = tokenizer
         self.max_length = max_length
+        self.note_columns = [col for col in data.columns if col.startswith('note_')]
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
         row = self.data.iloc[idx]
-        note_chunks = [row[col] for col in self.data.columns if col.startswith('note_') and not pd.isnull(row[col])]
+        note_chunks = [row[col] for col in self.note_columns if not pd.isnull(row[col])]
         label = row[self.label_column]
 
-        # Tokenize each note chunk
-        tokenized_chunks = [
-            self.tokenizer(
-                chunk,
-                padding='max_length',
-                truncation=True,
-                max_length=self.max_length,
-                return_tensors='pt'
-            )
-            for chunk in note_chunks
-        ]
+        # Tokenize all note chunks of the patient in one call -> (num_chunks, max_length)
+        tokenized = self.tokenizer(
+            note_chunks if note_chunks else [''],
+            padding='max_length',
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors='pt'
+        )
+        # A patient without notes gets one empty chunk that is masked out.
+        chunk_mask = torch.full((tokenized['input_ids'].shape[0],), bool(note_chunks), dtype=torch.bool)
 
         return {
-            'input_ids': [tc['input_ids'].squeeze(0) for tc in tokenized_chunks],
-            'attention_mask': [tc['attention_mask'].squeeze(0) for tc in tokenized_chunks],
+            'input_ids': tokenized['input_ids'],
+            'attention_mask': tokenized['attention_mask'],
+            'chunk_mask': chunk_mask,
             'label': torch.tensor(label, dtype=torch.float)
         }
 
+def collate_note_chunks(batch):
+    """
+    Pads the chunk dimension to the largest chunk count in the batch (not in the dataset):
+    input_ids / attention_mask (B, C, L), chunk_mask (B, C) marking real chunks, label (B,).
+    """
+    max_chunks = max(item['input_ids'].shape[0] for item in batch)
+    seq_len = batch[0]['input_ids'].shape[1]
+    input_ids = torch.zeros((len(batch), max_chunks, seq_len), dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_chunks, seq_len), dtype=torch.long)
+    chunk_mask = torch.zeros((len(batch), max_chunks), dtype=torch.bool)
+    for i, item in enumerate(batch):
+        c = item['input_ids'].shape[0]
+        input_ids[i, :c] = item['input_ids']
+        attention_mask[i, :c] = item['attention_mask']
+        chunk_mask[i, :c] = item['chunk_mask']
+    return {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'chunk_mask': chunk_mask,
+        'label': torch.stack([item['label'] for item in batch])
+    }
+
 # Define the BioClinicalBERT model
 class BioClinicalBERTClassifier(nn.Module):
-    def __init__(self, bert_model_name, num_chunks, num_classes=1):
+    """
+    Encodes all note chunks of a batch in a single BERT call: (B, C, L) is flattened to (B*C, L),
+    all-padding chunks are dropped before the call, and the chunk CLS vectors are pooled per patient
+    (masked mean or attention over the real chunks), so the classifier does not depend on the chunk count.
+    num_chunks is kept for compatibility with older calls and is not used.
+    gradient_checkpointing recomputes BERT layer activations in backward, so memory grows with B*C much more slowly.
+    """
+    def __init__(self, bert_model_name, num_chunks=None, num_classes=1, pooling='mean', gradient_checkpointing=False):
         super(BioClinicalBERTClassifier, self).__init__()
+        if pooling not in ('mean', 'attention'):
+            raise ValueError(f"Unknown pooling: {pooling}")
         self.bert = AutoModel.from_pretrained(bert_model_name)
-        self.fc = nn.Linear(self.bert.config.hidden_size * num_chunks, num_classes)
-
-    def forward(self, input_ids_list, attention_mask_list):
-        embeddings = []
-
-        for input_ids, attention_mask in zip(input_ids_list, attention_mask_list):
-            outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
-            pooled_output = outputs.last_hidden_state[:, 0, :]  # CLS token
-            embeddings.append(pooled_output)
-
-        # Concatenate embeddings from all note chunks
-        concatenated_embeddings = torch.cat(embeddings, dim=1)
-
-        # Pass concatenated embeddings through the classification layer
-        logits = self.fc(concatenated_embeddings)
+        if gradient_checkpointing:
+            self.bert.gradient_checkpointing_enable()
+        hidden_size = self.bert.config.hidden_size
+        self.pooling = pooling
+        if pooling == 'attention':
+            self.chunk_attention = nn.Linear(hidden_size, 1)
+        self.fc = nn.Linear(hidden_size, num_classes)
+
+    def encode_chunks(self, input_ids, attention_mask, chunk_mask):
+        """(B, C, L) token ids -> (B, C, H) CLS vectors, zeros for padding chunks."""
+        batch_size, num_chunks, seq_len = input_ids.shape
+        flat_ids = input_ids.reshape(batch_size * num_chunks, seq_len)
+        flat_mask = attention_mask.reshape(batch_size * num_chunks, seq_len)
+        valid = chunk_mask.reshape(-1)
+        embeddings = self.fc.weight.new_zeros((batch_size * num_chunks, self.bert.config.hidden_size))
+        if valid.any():
+            # Trailing positions that are padding in every chunk are cut before the call.
+            used_len = int(flat_mask[valid].sum(dim=1).max())
+            cls = self.bert(input_ids=flat_ids[valid, :used_len],
+                            attention_mask=flat_mask[valid, :used_len]).last_hidden_state[:, 0, :]
+            embeddings[valid] = cls.to(embeddings.dtype)
+        return embeddings.reshape(batch_size, num_chunks, -1)
+
+    def forward(self, input_ids, attention_mask, chunk_mask=None):
+        if chunk_mask is None:
+            chunk_mask = attention_mask.sum(dim=-1) > 0
+        embeddings = self.encode_chunks(input_ids, attention_mask, chunk_mask)
+        weights = chunk_mask.to(embeddings.dtype)
+        if self.pooling == 'attention':
+            scores = self.chunk_attention(embeddings).squeeze(-1)
+            scores = scores.masked_fill(~chunk_mask, torch.finfo(scores.dtype).min)
+            weights = torch.softmax(scores, dim=1) * weights
+        else:
+            weights = weights / weights.sum(dim=1, keepdim=True).clamp(min=1.0)
+        pooled = (weights.unsqueeze(-1) * embeddings).sum(dim=1)
+
+        # Pass the pooled embedding through the classification layer
+        logits = self.fc(pooled)
         return logits
 
 # Function to compute class weights
@@ -71,22 +130,60 @@ def compute_class_weights(labels):
     weights = compute_class_weight(class_weight='balanced', classes=unique_classes, y=labels)
     return torch.tensor(weights, dtype=torch.float)
 
+# Peak memory since the last reset(): CUDA max allocated on GPU; on CPU the resident set size sampled
+# every 10 ms by benchmark.MemorySampler (ru_maxrss would be the peak over the whole process lifetime)
+class StepPeakMemory(object):
+    def __init__(self, device):
+        self.device = device
+        self._rss = MemorySampler().start() if device.type != 'cuda' else None
+        self.reset()
+
+    def reset(self):
+        if self._rss is None:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._rss.reset()
+
+    def peak_mb(self):
+        if self._rss is None:
+            return torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        return self._rss.peak()
+
+    def close(self):
+        if self._rss is not None:
+            self._rss.close()
+
 # Function to train the model
-def train_model(model, dataloader, optimizer, criterion, device):
+# Gradients of accumulation_steps batches are summed before each optimizer step
+# (effective batch size = batch_size * accumulation_steps).
+def train_model(model, dataloader, optimizer, criterion, device, accumulation_steps=1):
     model.train()
     total_loss = 0
-    for batch in tqdm(dataloader, desc="Training"):
-        input_ids_list = [x.to(device) for x in batch['input_ids']]
-        attention_mask_list = [x.to(device) for x in batch['attention_mask']]
+    optimizer.zero_grad()
+    memory = StepPeakMemory(device)
+    max_step_peak = 0.0
+    progress = tqdm(dataloader, desc="Training")
+    for step, batch in enumerate(progress, start=1):
+        input_ids = batch['input_ids'].to(device)
+        attention_mask = batch['attention_mask'].to(device)
+        chunk_mask = batch['chunk_mask'].to(device)
         labels = batch['label'].to(device).unsqueeze(1)
 
-        optimizer.zero_grad()
-        outputs = model(input_ids_list, attention_mask_list)
+        outputs = model(input_ids, attention_mask, chunk_mask)
         loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
+        (loss / accumulation_steps).backward()
+        if step % accumulation_steps == 0 or step == len(dataloader):
+            optimizer.step()
+            optimizer.zero_grad()
+            step_peak = memory.peak_mb()
+            max_step_peak = max(max_step_peak, step_peak)
+            progress.set_postfix(step_peak_mb=f"{step_peak:.0f}")
+            memory.reset()
 
         total_loss += loss.item()
+    memory.close()
+    print(f"Peak memory per optimizer step: max {max_step_peak:.0f} MB "
+          f"(effective batch size {dataloader.batch_size * accumulation_steps})")
     return total_loss / len(dataloader)
 
 # Function to evaluate the model
@@ -96,11 +193,12 @@ def evaluate_model(model, dataloader, device):
     all_preds = []
     with torch.no_grad():
         for batch in tqdm(dataloader, desc="Evaluating"):
-            input_ids_list = [x.to(device) for x in batch['input_ids']]
-            attention_mask_list = [x.to(device) for x in batch['attention_mask']]
+            input_ids = batch['input_ids'].to(device)
+            attention_mask = batch['attention_mask'].to(device)
+            chunk_mask = batch['chunk_mask'].to(device)
             labels = batch['label'].to(device).unsqueeze(1)
 
-            outputs = model(input_ids_list, attention_mask_list)
+            outputs = model(input_ids, attention_mask, chunk_mask)
             preds = torch.sigmoid(outputs).cpu().numpy().flatten()
 
             all_labels.extend(labels.cpu().numpy().flatten())
@@ -171,19 +269,21 @@ test_data = remaining_data.drop(val_data.index)
 
 # Prepare datasets and data loaders
 batch_size = 16
+target_batch_size = 32  # reached with gradient accumulation over batches of batch_size
+gradient_checkpointing = True
 max_length = 512
-num_chunks = len([col for col in processed_data.columns if col.startswith('note_')])  # Number of note chunks per patient
 tokenizer = AutoTokenizer.from_pretrained("emilyalsentzer/Bio_ClinicalBERT")
 train_dataset = ICUNotesDataset(train_data, label_column, tokenizer, max_length)
 val_dataset = ICUNotesDataset(val_data, label_column, tokenizer, max_length)
 test_dataset = ICUNotesDataset(test_data, label_column, tokenizer, max_length)
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_note_chunks)
+val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_note_chunks)
+test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_note_chunks)
 
 # Initialize and train the model
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = BioClinicalBERTClassifier("emilyalsentzer/Bio_ClinicalBERT", num_chunks=num_chunks).to(device)
+model = BioClinicalBERTClassifier("emilyalsentzer/Bio_ClinicalBERT", pooling='mean',
+                                  gradient_checkpointing=gradient_checkpointing).to(device)
 optimizer = AdamW(model.parameters(), lr=2e-5)
 criterion = nn.BCEWithLogitsLoss(pos_weight=compute_class_weights(train_data[label_column])[1])
 
@@ -191,7 +291,8 @@ criterion = nn.BCEWithLogitsLoss(pos_weight=compute_class_weights(train_data[lab
 num_epochs = 5
 for epoch in range(num_epochs):
     print(f"Epoch {epoch + 1}/{num_epochs}")
-    train_loss = train_model(model, train_loader, optimizer, criterion, device)
+    train_loss = train_model(model, train_loader, optimizer, criterion, device,
+                             accumulation_steps=max(1, target_batch_size // batch_size))
     val_metrics = evaluate_model(model, val_loader, device)
     print(f"Epoch {epoch + 1} - Train Loss: {train_loss:.4f}")
     print(f"Validation Metrics: AUROC={val_metrics['auroc']:.4f}, AUPRC={val_metrics['auprc']:.4f}, "
@@ -210,4 +311,4 @@ for attr, col in sensitive_attributes.items():
         fairness_results = calculate_fairness_metrics(test_metrics['labels'], test_metrics['predictions'], sensitive_attribute)
         print(f"\nFairness Evaluation for {attr}:")
         print("Equalized Odds (TPR, FPR):", fairness_results['equalized_odds'])
-        print("Disparity:", fairness_results['disparity']")
+        print("Disparity:", fairness_results['disparity'])
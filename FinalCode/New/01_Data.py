@@ -53,6 +53,23 @@ def calculate_short_term_mortality(df):
     df['short_term_mortality'] = df['DEATHTIME'].notnull().astype(int)
     return df
 
+# Define a list of ITEMIDs related to ventilation.
+vent_itemids = [
+    720, 223848, 223849, 467,
+    445, 448, 449, 450, 1340, 1486, 1600, 224687,
+    639, 654, 681, 682, 683, 684, 224685, 224684, 224686,
+    218, 436, 535, 444, 224697, 224695, 224696, 224746, 224747,
+    221, 1, 1211, 1655, 2000, 226873, 224738, 224419, 224750, 227187,
+    543, 5865, 5866, 224707, 224709, 224705, 224706,
+    60, 437, 505, 506, 686, 220339, 224700,
+    3459,
+    501, 502, 503, 224702,
+    223, 667, 668, 669, 670, 671, 672,
+    224701,
+    # Oxygen device related
+    468, 469, 470, 471, 227287, 226732, 223834
+]
+
 # Determine mechanical ventilation based on signals from CHARTEVENTS and PROCEDUREEVENTS_MV.
 def calculate_mechanical_ventilation():
     # Load relevant CHARTEVENTS
@@ -64,22 +81,6 @@ def calculate_mechanical_ventilation():
     chartevents = chartevents[chartevents['value'].notnull()]
     chartevents = chartevents[(chartevents['error'] != 1) | (chartevents['error'].isnull())]
 
-    # Define a list of ITEMIDs related to ventilation.
-    vent_itemids = [
-        720, 223848, 223849, 467,
-        445, 448, 449, 450, 1340, 1486, 1600, 224687,
-        639, 654, 681, 682, 683, 684, 224685, 224684, 224686,
-        218, 436, 535, 444, 224697, 224695, 224696, 224746, 224747,
-        221, 1, 1211, 1655, 2000, 226873, 224738, 224419, 224750, 227187,
-        543, 5865, 5866, 224707, 224709, 224705, 224706,
-        60, 437, 505, 506, 686, 220339, 224700,
-        3459,
-        501, 502, 503, 224702,
-        223, 667, 668, 669, 670, 671, 672,
-        224701,
-        # Oxygen device related
-        468, 469, 470, 471, 227287, 226732, 223834
-    ]
     chartevents = chartevents[chartevents['itemid'].isin(vent_itemids)]
 
     # Define a function to set ventilation flags based on itemid and value.
@@ -201,7 +202,7 @@ def load_and_aggregate_lab_data(file_path, bin_size=2):
     return aggregated_df
 
 # Load and aggregate additional feature data into 2-hour bins.
-def load_and_aggregate_feature_data(file_paths, table_name):
+def load_and_aggregate_feature_data(file_paths, table_name, filtered_subjects, icu_stays):
     print(f"\nProcessing {table_name} from {file_paths}...")
     # Load one or multiple files.
     if isinstance(file_paths, list):
@@ -260,92 +261,6 @@ def load_and_aggregate_feature_data(file_paths, table_name):
     return aggregated_df
 
 
-# Build the Base Structured Dataset
-# Read in structured tables.
-admissions = pd.read_csv(
-    'ADMISSIONS.csv.gz', compression='gzip', low_memory=False,
-    usecols=['SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ETHNICITY', 'INSURANCE']
-)
-patients = pd.read_csv(
-    'PATIENTS.csv.gz', compression='gzip', low_memory=False,
-    usecols=['SUBJECT_ID', 'GENDER', 'DOB']
-)
-icu_stays = pd.read_csv(
-    'ICUSTAYS.csv.gz', compression='gzip', low_memory=False,
-    usecols=['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'INTIME', 'OUTTIME']
-)
-
-# Convert date/time columns.
-admissions['ADMITTIME'] = pd.to_datetime(admissions['ADMITTIME'])
-admissions['DISCHTIME'] = pd.to_datetime(admissions['DISCHTIME'])
-admissions['DEATHTIME'] = pd.to_datetime(admissions['DEATHTIME'])
-icu_stays['INTIME'] = pd.to_datetime(icu_stays['INTIME'])
-icu_stays['OUTTIME'] = pd.to_datetime(icu_stays['OUTTIME'])
-
-# Rename columns for consistency.
-admissions.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
-patients.rename(columns={'SUBJECT_ID': 'subject_id'}, inplace=True)
-icu_stays.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
-
-# Merge ICU stays with Admissions and Patients.
-df_struct = pd.merge(icu_stays, admissions, on=['subject_id', 'hadm_id'], how='left')
-df_struct = pd.merge(df_struct, patients, on='subject_id', how='left')
-
-# Compute age and assign age bucket.
-df_struct['DOB'] = pd.to_datetime(df_struct['DOB'], errors='coerce')
-df_struct['age'] = df_struct.apply(lambda row: calculate_age(row['DOB'], row['INTIME'])
-                                   if pd.notnull(row['DOB']) and pd.notnull(row['INTIME']) else np.nan, axis=1)
-df_struct = df_struct[(df_struct['age'] >= 15) & (df_struct['age'] <= 90)]
-df_struct['age_bucket'] = df_struct['age'].apply(categorize_age)
-
-# Standardize ethnicity, insurance, and gender.
-df_struct['ethnicity_category'] = df_struct['ETHNICITY'].apply(categorize_ethnicity)
-df_struct['insurance_category'] = df_struct['INSURANCE'].apply(categorize_insurance)
-df_struct['gender'] = df_struct['GENDER'].str.lower().apply(lambda x: 'male' if 'm' in x else ('female' if 'f' in x else x))
-
-# Calculate short-term mortality.
-df_struct = calculate_short_term_mortality(df_struct)
-
-# Compute continuous ICU LOS (in hours)
-df_struct['icu_los'] = (df_struct['OUTTIME'] - df_struct['INTIME']).dt.total_seconds() / 3600
-
-# Create los_binary column 
-# For LOS prediction (> 3 days), use a threshold of 72 hours.
-df_struct['los_binary'] = (df_struct['icu_los'] > 72).astype(int)
-
-# Compute mechanical ventilation flag.
-vent_flags = calculate_mechanical_ventilation()
-df_struct = pd.merge(df_struct, vent_flags, on=['subject_id', 'hadm_id'], how='left')
-df_struct['mechanical_ventilation'] = df_struct['mechanical_ventilation'].fillna(0).astype(int)
-
-# Aggregate LABEVENTS features into 2-hour bins over the first 24 hours.
-lab_aggregated = load_and_aggregate_lab_data('LABEVENTS.csv.gz', bin_size=2)
-if lab_aggregated is not None:
-    df_struct = pd.merge(df_struct, lab_aggregated, on=['subject_id', 'hadm_id'], how='left')
-
-# Sort by admission time and take the first ICU stay per subject.
-df_struct = df_struct.sort_values(by='INTIME').groupby('subject_id').first().reset_index()
-
-# Save the base structured dataset.
-df_struct.to_csv('final_structured_dataset.csv', index=False)
-print("Base structured dataset saved as 'final_structured_dataset.csv'.")
-
-# Merge Feature Set C into the Structured Dataset
-# Load the dataset that includes icu_los and los_binary.
-structured_df = pd.read_csv('final_structured_dataset.csv')
-filtered_subjects = set(structured_df['subject_id'].unique())
-print(f"Filtered structured dataset shape: {structured_df.shape}")
-
-# Load ICU stays data (used for feature extraction) and filter for stays longer than 30 hours.
-icu_stays = pd.read_csv('ICUSTAYS.csv.gz', compression='gzip', usecols=['SUBJECT_ID', 'HADM_ID', 'INTIME', 'OUTTIME'])
-icu_stays.columns = icu_stays.columns.str.lower()
-icu_stays['intime'] = pd.to_datetime(icu_stays['intime'])
-icu_stays['outtime'] = pd.to_datetime(icu_stays['outtime'])
-icu_stays['icu_los'] = (icu_stays['outtime'] - icu_stays['intime']).dt.total_seconds() / 3600
-icu_stays = icu_stays[icu_stays['subject_id'].isin(filtered_subjects)]
-icu_stays = icu_stays[icu_stays['icu_los'] >= 30]
-print(f"ICU stays shape after filtering by subject_id and LOS>=30h: {icu_stays.shape}")
-
 # Define the set of features to extract for each table.
 feature_set_C_items = {
     'chartevents': [220051, 220052, 618, 220210, 224641, 220292, 535, 224695, 506, 220339, 448, 224687, 224685, 220293, 444, 224697, 220074, 224688, 223834, 50815, 225664, 220059, 683, 224684, 220060, 226253, 224161, 642, 225185, 226758, 226757, 226756, 220050, 211, 220045, 223761, 223835, 226873, 226871, 8364, 8555, 8368, 53, 646, 1529, 50809, 50931, 51478, 224639, 763, 224639, 226707],
@@ -364,36 +279,129 @@ input_files = {
     'prescriptions': 'PRESCRIPTIONS.csv.gz'
 }
 
-aggregated_features = {}
-for table, file in input_files.items():
-    aggregated_features[table] = load_and_aggregate_feature_data(file, table)
-
-# Merge these aggregated features with the structured dataset.
-merged_features = structured_df.copy()
-for table_name, feature_df in aggregated_features.items():
-    if feature_df is not None:
-        merged_features = merged_features.merge(feature_df, on=['subject_id', 'hadm_id'], how='left')
-
-# If icu_los is still missing, merge it from structured_df.
-if 'icu_los' not in merged_features.columns:
-    if 'icu_los' in structured_df.columns:
-        merged_features = merged_features.merge(structured_df[['subject_id', 'icu_los']], on='subject_id', how='left')
-
-# Group by subject_id: average numeric columns and take the first value for categoricals.
-numeric_cols = merged_features.select_dtypes(include=[np.number]).columns
-categorical_cols = merged_features.select_dtypes(exclude=[np.number]).columns
-merged_features_numeric = merged_features.groupby('subject_id', as_index=False)[numeric_cols].mean()
-merged_features_categorical = merged_features.groupby('subject_id', as_index=False)[categorical_cols].first()
-merged_features = merged_features_numeric.merge(merged_features_categorical, on='subject_id', how='left')
-
-output_file = 'final_structured_with_feature_set_C_24h_2h_bins.csv'
-merged_features.to_csv(output_file, index=False)
-print(f"\nFinal dataset saved as {output_file}")
-
-print(f"\nFinal Dataset Shape: {merged_features.shape}")
-print(f"Short-Term Mortality Count: {merged_features['short_term_mortality'].sum()}")
-print(f"Average ICU LOS: {merged_features['icu_los'].mean()}")
-print(f"Mechanical Ventilation Count: {merged_features['mechanical_ventilation'].sum()}")
+
+# Build the Base Structured Dataset
+def build_structured_dataset():
+    """ICU stays + admissions + patients, outcomes and 2-hour LABEVENTS bins -> final_structured_dataset.csv."""
+    # Read in structured tables.
+    admissions = pd.read_csv(
+        'ADMISSIONS.csv.gz', compression='gzip', low_memory=False,
+        usecols=['SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ETHNICITY', 'INSURANCE']
+    )
+    patients = pd.read_csv(
+        'PATIENTS.csv.gz', compression='gzip', low_memory=False,
+        usecols=['SUBJECT_ID', 'GENDER', 'DOB']
+    )
+    icu_stays = pd.read_csv(
+        'ICUSTAYS.csv.gz', compression='gzip', low_memory=False,
+        usecols=['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'INTIME', 'OUTTIME']
+    )
+
+    # Convert date/time columns.
+    admissions['ADMITTIME'] = pd.to_datetime(admissions['ADMITTIME'])
+    admissions['DISCHTIME'] = pd.to_datetime(admissions['DISCHTIME'])
+    admissions['DEATHTIME'] = pd.to_datetime(admissions['DEATHTIME'])
+    icu_stays['INTIME'] = pd.to_datetime(icu_stays['INTIME'])
+    icu_stays['OUTTIME'] = pd.to_datetime(icu_stays['OUTTIME'])
+
+    # Rename columns for consistency.
+    admissions.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
+    patients.rename(columns={'SUBJECT_ID': 'subject_id'}, inplace=True)
+    icu_stays.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
+
+    # Merge ICU stays with Admissions and Patients.
+    df_struct = pd.merge(icu_stays, admissions, on=['subject_id', 'hadm_id'], how='left')
+    df_struct = pd.merge(df_struct, patients, on='subject_id', how='left')
+
+    # Compute age and assign age bucket.
+    df_struct['DOB'] = pd.to_datetime(df_struct['DOB'], errors='coerce')
+    df_struct['age'] = df_struct.apply(lambda row: calculate_age(row['DOB'], row['INTIME'])
+                                       if pd.notnull(row['DOB']) and pd.notnull(row['INTIME']) else np.nan, axis=1)
+    df_struct = df_struct[(df_struct['age'] >= 15) & (df_struct['age'] <= 90)]
+    df_struct['age_bucket'] = df_struct['age'].apply(categorize_age)
+
+    # Standardize ethnicity, insurance, and gender.
+    df_struct['ethnicity_category'] = df_struct['ETHNICITY'].apply(categorize_ethnicity)
+    df_struct['insurance_category'] = df_struct['INSURANCE'].apply(categorize_insurance)
+    df_struct['gender'] = df_struct['GENDER'].str.lower().apply(lambda x: 'male' if 'm' in x else ('female' if 'f' in x else x))
+
+    # Calculate short-term mortality.
+    df_struct = calculate_short_term_mortality(df_struct)
+
+    # Compute continuous ICU LOS (in hours)
+    df_struct['icu_los'] = (df_struct['OUTTIME'] - df_struct['INTIME']).dt.total_seconds() / 3600
+
+    # Create los_binary column 
+    # For LOS prediction (> 3 days), use a threshold of 72 hours.
+    df_struct['los_binary'] = (df_struct['icu_los'] > 72).astype(int)
+
+    # Compute mechanical ventilation flag.
+    vent_flags = calculate_mechanical_ventilation()
+    df_struct = pd.merge(df_struct, vent_flags, on=['subject_id', 'hadm_id'], how='left')
+    df_struct['mechanical_ventilation'] = df_struct['mechanical_ventilation'].fillna(0).astype(int)
+
+    # Aggregate LABEVENTS features into 2-hour bins over the first 24 hours.
+    lab_aggregated = load_and_aggregate_lab_data('LABEVENTS.csv.gz', bin_size=2)
+    if lab_aggregated is not None:
+        df_struct = pd.merge(df_struct, lab_aggregated, on=['subject_id', 'hadm_id'], how='left')
+
+    # Sort by admission time and take the first ICU stay per subject.
+    df_struct = df_struct.sort_values(by='INTIME').groupby('subject_id').first().reset_index()
+
+    # Save the base structured dataset.
+    df_struct.to_csv('final_structured_dataset.csv', index=False)
+    print("Base structured dataset saved as 'final_structured_dataset.csv'.")
+    return df_struct
+
+# Merge Feature Set C into the Structured Dataset
+def merge_feature_set_c():
+    """Adds the Feature Set C tables (first 24h, 2-hour bins) -> final_structured_with_feature_set_C_24h_2h_bins.csv."""
+    # Load the dataset that includes icu_los and los_binary.
+    structured_df = pd.read_csv('final_structured_dataset.csv')
+    filtered_subjects = set(structured_df['subject_id'].unique())
+    print(f"Filtered structured dataset shape: {structured_df.shape}")
+
+    # Load ICU stays data (used for feature extraction) and filter for stays longer than 30 hours.
+    icu_stays = pd.read_csv('ICUSTAYS.csv.gz', compression='gzip', usecols=['SUBJECT_ID', 'HADM_ID', 'INTIME', 'OUTTIME'])
+    icu_stays.columns = icu_stays.columns.str.lower()
+    icu_stays['intime'] = pd.to_datetime(icu_stays['intime'])
+    icu_stays['outtime'] = pd.to_datetime(icu_stays['outtime'])
+    icu_stays['icu_los'] = (icu_stays['outtime'] - icu_stays['intime']).dt.total_seconds() / 3600
+    icu_stays = icu_stays[icu_stays['subject_id'].isin(filtered_subjects)]
+    icu_stays = icu_stays[icu_stays['icu_los'] >= 30]
+    print(f"ICU stays shape after filtering by subject_id and LOS>=30h: {icu_stays.shape}")
+
+    aggregated_features = {}
+    for table, file in input_files.items():
+        aggregated_features[table] = load_and_aggregate_feature_data(file, table, filtered_subjects, icu_stays)
+
+    # Merge these aggregated features with the structured dataset.
+    merged_features = structured_df.copy()
+    for table_name, feature_df in aggregated_features.items():
+        if feature_df is not None:
+            merged_features = merged_features.merge(feature_df, on=['subject_id', 'hadm_id'], how='left')
+
+    # If icu_los is still missing, merge it from structured_df.
+    if 'icu_los' not in merged_features.columns:
+        if 'icu_los' in structured_df.columns:
+            merged_features = merged_features.merge(structured_df[['subject_id', 'icu_los']], on='subject_id', how='left')
+
+    # Group by subject_id: average numeric columns and take the first value for categoricals.
+    numeric_cols = merged_features.select_dtypes(include=[np.number]).columns
+    categorical_cols = merged_features.select_dtypes(exclude=[np.number]).columns
+    merged_features_numeric = merged_features.groupby('subject_id', as_index=False)[numeric_cols].mean()
+    merged_features_categorical = merged_features.groupby('subject_id', as_index=False)[categorical_cols].first()
+    merged_features = merged_features_numeric.merge(merged_features_categorical, on='subject_id', how='left')
+
+    output_file = 'final_structured_with_feature_set_C_24h_2h_bins.csv'
+    merged_features.to_csv(output_file, index=False)
+    print(f"\nFinal dataset saved as {output_file}")
+
+    print(f"\nFinal Dataset Shape: {merged_features.shape}")
+    print(f"Short-Term Mortality Count: {merged_features['short_term_mortality'].sum()}")
+    print(f"Average ICU LOS: {merged_features['icu_los'].mean()}")
+    print(f"Mechanical Ventilation Count: {merged_features['mechanical_ventilation'].sum()}")
+    return merged_features
 
 # Unstructured Notes Processing
 def preprocess1(x):
@@ -442,108 +450,120 @@ def split_into_512_token_columns(text, chunk_size=512):
         chunk_dict[f"note_chunk_{i+1}"] = chunk
     return pd.Series(chunk_dict)
 
-# File paths for unstructured data and structured outcomes/demographics.
-notes_path = 'NOTEEVENTS.csv.gz'
-icustays_path = 'ICUSTAYS.csv.gz'
-structured_file = 'final_structured_dataset.csv'  
-
-# Read NOTEEVENTS and ICUSTAYS.
-df_notes = pd.read_csv(notes_path, compression='gzip', low_memory=False,
-                       usecols=['SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'TEXT'])
-df_icustays = pd.read_csv(icustays_path, compression='gzip', low_memory=False,
-                          usecols=['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'INTIME', 'OUTTIME'])
-
-# Convert datetime columns.
-df_notes['CHARTDATE'] = pd.to_datetime(df_notes['CHARTDATE'], format='%Y-%m-%d', errors='coerce')
-df_icustays['INTIME'] = pd.to_datetime(df_icustays['INTIME'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
-df_icustays['OUTTIME'] = pd.to_datetime(df_icustays['OUTTIME'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
-
-# Rename columns for consistency.
-df_notes.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
-df_icustays.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
-
-# Extract the first ICU stay per patient by sorting by INTIME.
-df_first_icu = df_icustays.sort_values(by='INTIME').groupby('subject_id').first().reset_index()
-
-# Select notes corresponding to the first ICU stay based on hadm_id.
-first_icu_notes = df_notes[df_notes['hadm_id'].isin(df_first_icu['hadm_id'])]
-
-# Merge notes with the ICU admission and discharge times from the first ICU stay.
-first_icu_admission = df_first_icu[['subject_id', 'hadm_id', 'INTIME', 'OUTTIME']].copy()
-first_icu_admission.rename(columns={'INTIME': 'admission_time', 'OUTTIME': 'discharge_time'}, inplace=True)
-notes_merged = pd.merge(first_icu_notes, first_icu_admission, on=['subject_id', 'hadm_id'], how='inner')
-
-# Retain only notes recorded during the ICU stay (between admission_time and discharge_time).
-notes_filtered = notes_merged[(notes_merged['CHARTDATE'] >= notes_merged['admission_time']) & 
-                              (notes_merged['CHARTDATE'] <= notes_merged['discharge_time'])].copy()
-
-# Aggregate notes by subject and hadm_id by concatenating all TEXT entries.
-notes_agg = notes_filtered.groupby(['subject_id', 'hadm_id']).agg({
-    'TEXT': lambda texts: " ".join(texts)
-}).reset_index()
-
-# Clean the aggregated text.
-notes_agg = preprocessing(notes_agg)
-
-# Split the aggregated text into 512-token chunks.
-df_note_chunks = notes_agg['TEXT'].apply(split_into_512_token_columns)
-notes_agg = pd.concat([notes_agg, df_note_chunks], axis=1)
-
-# Merge with Structured Data
-structured_df = pd.read_csv(structured_file)
-# If 'los_binary' is not present, compute it (using 72 hours as threshold).
-if 'los_binary' not in structured_df.columns:
-    structured_df['los_binary'] = (structured_df['icu_los'] > 72).astype(int)
-
-unstructured_merged = pd.merge(
-    notes_agg,
-    structured_df[['subject_id', 'short_term_mortality', 'icu_los', 'los_binary', 'mechanical_ventilation', 
-                     'age', 'age_bucket', 'ethnicity_category', 'insurance_category', 'gender']],
-    on='subject_id', how='left'
-)
-
-unstructured_merged.to_csv('unstructured_with_demographics.csv', index=False)
-print("Unstructured dataset with demographics, outcomes, and notes saved as 'unstructured_with_demographics.csv'.")
-
-# Load final structured dataset 
-structured_file = 'final_structured_with_feature_set_C_24h_2h_bins.csv'
-structured_df = pd.read_csv(structured_file)
-print("Final Structured Dataset:")
-print("Shape:", structured_df.shape)
-print("Columns:", structured_df.columns.tolist())
-print("Short-Term Mortality (positive count):", structured_df['short_term_mortality'].sum())
-print("Binary LOS (positive count):", structured_df['los_binary'].sum())
-print("Mechanical Ventilation (positive count):", structured_df['mechanical_ventilation'].sum())
-print("\n")
-
-# Load final unstructured dataset 
-unstructured_file = 'unstructured_with_demographics.csv'
-unstructured_df = pd.read_csv(unstructured_file)
-print("Final Unstructured Dataset:")
-print("Shape:", unstructured_df.shape)
-print("Columns:", unstructured_df.columns.tolist())
-print("Short-Term Mortality (positive count):", unstructured_df['short_term_mortality'].sum())
-print("Binary LOS (positive count):", unstructured_df['los_binary'].sum())
-print("Mechanical Ventilation (positive count):", unstructured_df['mechanical_ventilation'].sum())
-print("\n")
-
-# Identify common subject IDs between the two datasets.
-common_ids = set(structured_df['subject_id'].unique()).intersection(set(unstructured_df['subject_id'].unique()))
-print("Number of common subject IDs:", len(common_ids))
-
-# Filter both datasets to include only rows with common subject IDs.
-structured_common = structured_df[structured_df['subject_id'].isin(common_ids)].copy()
-unstructured_common = unstructured_df[unstructured_df['subject_id'].isin(common_ids)].copy()
-
-# Save the final datasets with common subject IDs.
-structured_common.to_csv('final_structured_common.csv', index=False)
-unstructured_common.to_csv('final_unstructured_common.csv', index=False)
-
-print("Final Structured (Common IDs) Shape:", structured_common.shape)
-print("Final Unstructured (Common IDs) Shape:", unstructured_common.shape)
-print("Structured - Short-Term Mortality Count:", structured_common['short_term_mortality'].sum())
-print("Structured - Binary LOS Count:", structured_common['los_binary'].sum())
-print("Structured - Mechanical Ventilation Count:", structured_common['mechanical_ventilation'].sum())
-print("Unstructured - Short-Term Mortality Count:", unstructured_common['short_term_mortality'].sum())
-print("Unstructured - Binary LOS Count:", unstructured_common['los_binary'].sum())
-print("Unstructured - Mechanical Ventilation Count:", unstructured_common['mechanical_ventilation'].sum())
+def build_unstructured_dataset():
+    """First-ICU-stay notes, cleaned and split into 512-token chunks, with outcomes and demographics."""
+    # File paths for unstructured data and structured outcomes/demographics.
+    notes_path = 'NOTEEVENTS.csv.gz'
+    icustays_path = 'ICUSTAYS.csv.gz'
+    structured_file = 'final_structured_dataset.csv'  
+
+    # Read NOTEEVENTS and ICUSTAYS.
+    df_notes = pd.read_csv(notes_path, compression='gzip', low_memory=False,
+                           usecols=['SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'TEXT'])
+    df_icustays = pd.read_csv(icustays_path, compression='gzip', low_memory=False,
+                              usecols=['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'INTIME', 'OUTTIME'])
+
+    # Convert datetime columns.
+    df_notes['CHARTDATE'] = pd.to_datetime(df_notes['CHARTDATE'], format='%Y-%m-%d', errors='coerce')
+    df_icustays['INTIME'] = pd.to_datetime(df_icustays['INTIME'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    df_icustays['OUTTIME'] = pd.to_datetime(df_icustays['OUTTIME'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+
+    # Rename columns for consistency.
+    df_notes.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
+    df_icustays.rename(columns={'SUBJECT_ID': 'subject_id', 'HADM_ID': 'hadm_id'}, inplace=True)
+
+    # Extract the first ICU stay per patient by sorting by INTIME.
+    df_first_icu = df_icustays.sort_values(by='INTIME').groupby('subject_id').first().reset_index()
+
+    # Select notes corresponding to the first ICU stay based on hadm_id.
+    first_icu_notes = df_notes[df_notes['hadm_id'].isin(df_first_icu['hadm_id'])]
+
+    # Merge notes with the ICU admission and discharge times from the first ICU stay.
+    first_icu_admission = df_first_icu[['subject_id', 'hadm_id', 'INTIME', 'OUTTIME']].copy()
+    first_icu_admission.rename(columns={'INTIME': 'admission_time', 'OUTTIME': 'discharge_time'}, inplace=True)
+    notes_merged = pd.merge(first_icu_notes, first_icu_admission, on=['subject_id', 'hadm_id'], how='inner')
+
+    # Retain only notes recorded during the ICU stay (between admission_time and discharge_time).
+    notes_filtered = notes_merged[(notes_merged['CHARTDATE'] >= notes_merged['admission_time']) & 
+                                  (notes_merged['CHARTDATE'] <= notes_merged['discharge_time'])].copy()
+
+    # Aggregate notes by subject and hadm_id by concatenating all TEXT entries.
+    notes_agg = notes_filtered.groupby(['subject_id', 'hadm_id']).agg({
+        'TEXT': lambda texts: " ".join(texts)
+    }).reset_index()
+
+    # Clean the aggregated text.
+    notes_agg = preprocessing(notes_agg)
+
+    # Split the aggregated text into 512-token chunks.
+    df_note_chunks = notes_agg['TEXT'].apply(split_into_512_token_columns)
+    notes_agg = pd.concat([notes_agg, df_note_chunks], axis=1)
+
+    # Merge with Structured Data
+    structured_df = pd.read_csv(structured_file)
+    # If 'los_binary' is not present, compute it (using 72 hours as threshold).
+    if 'los_binary' not in structured_df.columns:
+        structured_df['los_binary'] = (structured_df['icu_los'] > 72).astype(int)
+
+    unstructured_merged = pd.merge(
+        notes_agg,
+        structured_df[['subject_id', 'short_term_mortality', 'icu_los', 'los_binary', 'mechanical_ventilation', 
+                         'age', 'age_bucket', 'ethnicity_category', 'insurance_category', 'gender']],
+        on='subject_id', how='left'
+    )
+
+    unstructured_merged.to_csv('unstructured_with_demographics.csv', index=False)
+    print("Unstructured dataset with demographics, outcomes, and notes saved as 'unstructured_with_demographics.csv'.")
+    return unstructured_merged
+
+def build_common_datasets():
+    """Restricts both datasets to the subjects present in each -> final_*_common.csv."""
+    # Load final structured dataset 
+    structured_file = 'final_structured_with_feature_set_C_24h_2h_bins.csv'
+    structured_df = pd.read_csv(structured_file)
+    print("Final Structured Dataset:")
+    print("Shape:", structured_df.shape)
+    print("Columns:", structured_df.columns.tolist())
+    print("Short-Term Mortality (positive count):", structured_df['short_term_mortality'].sum())
+    print("Binary LOS (positive count):", structured_df['los_binary'].sum())
+    print("Mechanical Ventilation (positive count):", structured_df['mechanical_ventilation'].sum())
+    print("\n")
+
+    # Load final unstructured dataset 
+    unstructured_file = 'unstructured_with_demographics.csv'
+    unstructured_df = pd.read_csv(unstructured_file)
+    print("Final Unstructured Dataset:")
+    print("Shape:", unstructured_df.shape)
+    print("Columns:", unstructured_df.columns.tolist())
+    print("Short-Term Mortality (positive count):", unstructured_df['short_term_mortality'].sum())
+    print("Binary LOS (positive count):", unstructured_df['los_binary'].sum())
+    print("Mechanical Ventilation (positive count):", unstructured_df['mechanical_ventilation'].sum())
+    print("\n")
+
+    # Identify common subject IDs between the two datasets.
+    common_ids = set(structured_df['subject_id'].unique()).intersection(set(unstructured_df['subject_id'].unique()))
+    print("Number of common subject IDs:", len(common_ids))
+
+    # Filter both datasets to include only rows with common subject IDs.
+    structured_common = structured_df[structured_df['subject_id'].isin(common_ids)].copy()
+    unstructured_common = unstructured_df[unstructured_df['subject_id'].isin(common_ids)].copy()
+
+    # Save the final datasets with common subject IDs.
+    structured_common.to_csv('final_structured_common.csv', index=False)
+    unstructured_common.to_csv('final_unstructured_common.csv', index=False)
+
+    print("Final Structured (Common IDs) Shape:", structured_common.shape)
+    print("Final Unstructured (Common IDs) Shape:", unstructured_common.shape)
+    print("Structured - Short-Term Mortality Count:", structured_common['short_term_mortality'].sum())
+    print("Structured - Binary LOS Count:", structured_common['los_binary'].sum())
+    print("Structured - Mechanical Ventilation Count:", structured_common['mechanical_ventilation'].sum())
+    print("Unstructured - Short-Term Mortality Count:", unstructured_common['short_term_mortality'].sum())
+    print("Unstructured - Binary LOS Count:", unstructured_common['los_binary'].sum())
+    print("Unstructured - Mechanical Ventilation Count:", unstructured_common['mechanical_ventilation'].sum())
+    return structured_common, unstructured_common
+
+if __name__ == "__main__":
+    build_structured_dataset()
+    merge_feature_set_c()
+    build_unstructured_dataset()
+    build_common_datasets()
@@ -14,6 +14,8 @@ from scipy.special import expit
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from transformers import BertModel, BertConfig
+from batch_loader import BatchLoader
+from checkpoint import CheckpointManager
 
 
 def compute_eddi(sensitive_attr, true_labels, pred_labels, threshold=0.5):
@@ -85,13 +87,15 @@ class BEHRTModel_Combined(nn.Module):
         return logits_mort, logits_los, logits_mech
 
 
-class FinalStructuredDataset(Dataset):
+class FinalStructuredDataset(TensorDataset):
     """
     Dataset for structured data from final_structured_common.csv.
     Expected columns:
       - Lab features: columns starting with 'lab_t' (e.g., lab_t0, lab_t2, …)
       - Demographic features: 'age', 'gender', 'ethnicity_category', 'insurance_category'
       - Outcome labels: 'short_term_mortality', 'los_binary', 'mechanical_ventilation'
+    All columns are converted to contiguous tensors once, so batches are built by indexing
+    (see batch_loader.BatchLoader) instead of per-row pandas lookups.
     """
     def __init__(self, csv_file):
         self.df = pd.read_csv(csv_file)
@@ -114,21 +118,16 @@ class FinalStructuredDataset(Dataset):
         self.df['insurance_code'] = self.df['insurance_category'].astype('category').cat.codes
         self.df['age_int'] = self.df['age'].astype(int)
 
-    def __len__(self):
-        return len(self.df)
-    
-    def __getitem__(self, idx):
-        row = self.df.iloc[idx]
-        lab_features = torch.tensor(row[self.lab_cols].values.astype(np.float32))
+        lab_features = torch.tensor(self.df[self.lab_cols].values.astype(np.float32))
         # The demographic features are no longer used by the model but kept here in case needed for analysis.
-        age = torch.tensor(row['age_int'], dtype=torch.long)
-        gender = torch.tensor(row['gender_code'], dtype=torch.long)
-        ethnicity = torch.tensor(row['ethnicity_code'], dtype=torch.long)
-        insurance = torch.tensor(row['insurance_code'], dtype=torch.long)
-        labels = torch.tensor([row['short_term_mortality'],
-                               row['los_binary'],
-                               row['mechanical_ventilation']], dtype=torch.float32)
-        return lab_features, age, gender, ethnicity, insurance, labels
+        age = torch.tensor(self.df['age_int'].values, dtype=torch.long)
+        gender = torch.tensor(self.df['gender_code'].values, dtype=torch.long)
+        ethnicity = torch.tensor(self.df['ethnicity_code'].values, dtype=torch.long)
+        insurance = torch.tensor(self.df['insurance_code'].values, dtype=torch.long)
+        labels = torch.tensor(self.df[['short_term_mortality',
+                                       'los_binary',
+                                       'mechanical_ventilation']].values.astype(np.float32))
+        super(FinalStructuredDataset, self).__init__(lab_features, age, gender, ethnicity, insurance, labels)
 
 
 def compute_class_weights(loader):
@@ -155,6 +154,7 @@ def train_model(model, train_loader, val_loader, device, num_epochs=50, patience
     loss_fn_mech = nn.BCEWithLogitsLoss(pos_weight=torch.tensor(train_class_weights[2], device=device))
     best_val_loss = float('inf')
     epochs_no_improve = 0
+    checkpoints = CheckpointManager(manifest={"script": "01_behrt"})
     for epoch in range(num_epochs):
         model.train()
         train_losses = []
@@ -242,13 +242,14 @@ def train_model(model, train_loader, val_loader, device, num_epochs=50, patience
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             epochs_no_improve = 0
-            torch.save(model.state_dict(), "best_behrt_model.pt")
+            checkpoints.save(model, "best_behrt_model", metric=avg_val_loss, step=epoch + 1)
             print("Best model saved.\n")
         else:
             epochs_no_improve += 1
             if epochs_no_improve >= patience:
                 print("Early stopping triggered.\n")
                 break
+    checkpoints.close()
 
 def evaluate_model(model, dataloader, device, threshold=0.5):
     model.eval()
@@ -342,10 +343,13 @@ def main():
     
     print(f"Train size: {len(train_dataset)}, Validation size: {len(val_dataset)}, Test size: {len(test_dataset)}")
     
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Using device:", device)
+
     batch_size = 16
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=batch_size, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=batch_size, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=batch_size, shuffle=False, device=device)
 
     # Read CSV to extract sensitive attributes.
     df = pd.read_csv(csv_file)
@@ -366,11 +370,9 @@ def main():
     print("Demo vocab sizes removed since BEHRT demo is no longer used.")
     
     model = BEHRTModel_Combined(len(dataset.lab_cols), hidden_size=768)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using device:", device)
     
     train_model(model, train_loader, val_loader, device, num_epochs=10, patience=5, lr=1e-5, weight_decay=0.01)
-    model.load_state_dict(torch.load("best_behrt_model.pt", map_location=device))
+    CheckpointManager(async_write=False).load(model, "best_behrt_model")
     eval_metrics, all_logits, all_labels = evaluate_model(model, test_loader, device, threshold=0.5)
     print("Test Set Evaluation Metrics:")
     for task, m in eval_metrics.items():
@@ -13,6 +13,8 @@ from transformers import AutoTokenizer, AutoModel
 from sklearn.metrics import roc_auc_score, average_precision_score, f1_score, recall_score, precision_score, confusion_matrix
 from scipy.special import expit  # for logistic sigmoid
 from skmultilearn.model_selection import iterative_train_test_split
+from text_encoder import prepare_text_encoder, check_text_encoder_backend, TEXT_ENCODER_BACKEND
+from checkpoint import CheckpointManager
 
 
 class FocalLoss(nn.Module):
@@ -71,7 +73,8 @@ class BioClinicalBERT_FT(nn.Module):
         return cls_embedding
 
 # Apply BioClinicalBERT on Patient Notes
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", max_length=512):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", max_length=512, backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -285,7 +288,7 @@ def print_detailed_eddi(y_true, y_pred, outcome_name, df_results, age_order, eth
     return total_eddi, {"age": age_sub, "ethnicity": eth_sub, "insurance": ins_sub}
 
 
-def train_pipeline():
+def train_pipeline(check_backend=None):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("Using device:", device)
 
@@ -314,6 +317,10 @@ def train_pipeline():
         df_filtered, note_columns, tokenizer, bioclinical_bert_ft, device, aggregation="mean", max_length=512
     )
     print("Aggregated text embeddings shape:", aggregated_embeddings_np.shape)
+    if check_backend is not None:
+        check_text_encoder_backend(apply_bioclinicalbert_on_patient_notes, df_filtered, note_columns, tokenizer,
+                                   bioclinical_bert_ft, device, backend=check_backend, max_length=512,
+                                   out_file=f"text_encoder_check_{check_backend}.csv")
     
     # Use unique patients for labels and demographics.
     df_unique = df_filtered.drop_duplicates(subset="subject_id")
@@ -398,8 +405,10 @@ def train_pipeline():
     max_epochs = 50
     early_stopping_patience = 5
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     epochs_without_improvement = 0
-    best_model_path = "best_classifier_model.pt"
+    best_model_name = "best_classifier_model"
+    checkpoints = CheckpointManager(manifest={"script": "02_bio"})
     
     print("\nStarting training...")
     for epoch in range(max_epochs):
@@ -413,7 +422,8 @@ def train_pipeline():
             best_val_loss = val_loss
             epochs_without_improvement = 0
             # Save the best model.
-            torch.save(classifier.state_dict(), best_model_path)
+            checkpoints.save(classifier, best_model_name, metric=val_loss, step=epoch + 1)
+            best_saved = True
             print("Best model saved.")
         else:
             epochs_without_improvement += 1
@@ -426,7 +436,9 @@ def train_pipeline():
     
     print("Training complete.")
     
-    classifier.load_state_dict(torch.load(best_model_path))
+    if best_saved:
+        checkpoints.load(classifier, best_model_name)
+    checkpoints.close()
     
 
     print("\nEvaluating on the test set:")
@@ -514,4 +526,8 @@ def train_pipeline():
 
 
 if __name__ == "__main__":
-    train_pipeline()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check_backend", choices=["int8", "onnx"], default=None,
+                        help="Compare this text encoder backend against fp32 (cosine similarity, AUROC/EDDI delta, speed).")
+    args = parser.parse_args()
+    train_pipeline(check_backend=args.check_backend)
@@ -13,6 +13,9 @@ from torch.utils.data import Dataset, DataLoader, Subset
 from transformers import BertModel, BertConfig, AutoTokenizer
 from sklearn.metrics import roc_auc_score, average_precision_score, f1_score, recall_score, precision_score, confusion_matrix
 from skmultilearn.model_selection import iterative_train_test_split
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from perf_mode import PerfMode, record_perf_run
+from checkpoint import CheckpointManager
 
 DEBUG = True
 
@@ -119,7 +122,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -358,8 +362,10 @@ def calculate_equalized_odds_difference(y_true, y_pred, sensitive_attr):
     return avg_tpr_diff, avg_fpr_diff
 
 
-def train_step(model, dataloader, optimizer, device, crit_mort, crit_los, crit_vent):
+def train_step(model, dataloader, optimizer, device, crit_mort, crit_los, crit_vent, perf=None):
     model.train()
+    if perf is None:
+        perf = PerfMode(device)
     running_loss = 0.0
     for batch in dataloader:
         batch_moved = [x.to(device) if isinstance(x, torch.Tensor) else x for x in batch]
@@ -368,18 +374,19 @@ def train_step(model, dataloader, optimizer, device, crit_mort, crit_los, crit_v
          aggregated_text_embedding,
          labels_mortality, labels_los, labels_vent,
          _, _, _) = batch_moved  # sensitive strings are ignored during training
+        perf.start_step()
         optimizer.zero_grad()
-        mortality_logits, los_logits, vent_logits = model(
-            dummy_input_ids, dummy_attn_mask,
-            segment_ids, adm_loc_ids, disch_loc_ids,
-            aggregated_text_embedding
-        )
-        loss_mort = crit_mort(mortality_logits, labels_mortality.unsqueeze(1))
-        loss_los = crit_los(los_logits, labels_los.unsqueeze(1))
-        loss_vent = crit_vent(vent_logits, labels_vent.unsqueeze(1))
-        loss = loss_mort + loss_los + loss_vent
-        loss.backward()
-        optimizer.step()
+        with perf.autocast():
+            mortality_logits, los_logits, vent_logits = model(
+                dummy_input_ids, dummy_attn_mask,
+                segment_ids, adm_loc_ids, disch_loc_ids,
+                aggregated_text_embedding
+            )
+            loss_mort = crit_mort(mortality_logits, labels_mortality.unsqueeze(1))
+            loss_los = crit_los(los_logits, labels_los.unsqueeze(1))
+            loss_vent = crit_vent(vent_logits, labels_vent.unsqueeze(1))
+            loss = loss_mort + loss_los + loss_vent
+        perf.backward_step(loss, optimizer)
         running_loss += loss.item()
     return running_loss
 
@@ -719,18 +726,29 @@ def train_pipeline():
         device=device,
         hidden_size=512
     ).to(device)
+    perf = PerfMode.from_env(device)
+    multimodal_model = perf.compile(multimodal_model)
 
     
     optimizer = AdamW(multimodal_model.parameters(), lr=1e-4, weight_decay=1e-2)
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
     
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
+    checkpoints = CheckpointManager(manifest={
+        "script": "03_DfC", "model": "MultimodalTransformer_DfC",
+        "text_max_length": 128,
+        "architecture": {"text_embed_size": 768, "hidden_size": 512, "behrt_hidden_size": 768,
+                         "num_diseases": NUM_DISEASES, "num_segments": NUM_SEGMENTS,
+                         "num_admission_locs": NUM_ADMISSION_LOCS, "num_discharge_locs": NUM_DISCHARGE_LOCS},
+        "code_tables": {"ethnicity": sorted(set(ethnicity_list)), "insurance": sorted(set(insurance_list))},
+        "label_columns": ["short_term_mortality", "los_binary", "mechanical_ventilation"]})
     num_epochs = 20
     for epoch in range(num_epochs):
         multimodal_model.train()
         running_loss = train_step(multimodal_model, train_loader, optimizer, device,
-                                  criterion_mortality, criterion_los, criterion_mech)
+                                  criterion_mortality, criterion_los, criterion_mech, perf=perf)
         train_loss = running_loss / len(train_loader)
         
         val_loss = validation_step(multimodal_model, val_loader, device, criterion_mortality, criterion_los, criterion_mech)
@@ -741,30 +759,20 @@ def train_pipeline():
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(multimodal_model.state_dict(), "best_model.pt")
+            checkpoints.save(multimodal_model, "best_model", metric=val_loss, step=epoch + 1)
+            best_saved = True
         else:
             patience_counter += 1
             if patience_counter >= 5:
                 print("Early stopping triggered. No improvement in validation loss for 5 consecutive epochs.")
                 break
 
-    state_dict = torch.load("best_model.pt", map_location=device)
-    model_dict = multimodal_model.state_dict()
-    new_state_dict = {}
-    for key, value in state_dict.items():
-        if key.startswith("bert.") or key.startswith("segment_embedding") or key.startswith("admission_loc_embedding") or key.startswith("discharge_loc_embedding"):
-            new_key = "BEHRT." + key
-        else:
-            new_key = key
-        if new_key in model_dict:
-            new_state_dict[new_key] = value
-        else:
-            print("Skipping key:", key)
-    missing_keys, unexpected_keys = multimodal_model.load_state_dict(new_state_dict, strict=False)
-    print("Missing keys after loading:", missing_keys)
-    print("Unexpected keys after loading:", unexpected_keys)
+    if best_saved:
+        checkpoints.load(multimodal_model, "best_model")
+    checkpoints.close()
     
     metrics = evaluate_model(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True)
+    record_perf_run("03_DfC", perf, {"best_val_loss": best_val_loss, "test": metrics})
     print("\nFinal Evaluation Metrics on Test Set (DfC):")
     for outcome in ["mortality", "los", "mechanical_ventilation"]:
         m = metrics[outcome]
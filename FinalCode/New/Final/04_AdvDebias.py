@@ -1,5 +1,6 @@
 import time
 import random
+import hashlib
 import argparse
 import numpy as np
 import pandas as pd
@@ -18,6 +19,10 @@ import pickle
 import math
 import matplotlib.pyplot as plt
 import os
+import sys
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from checkpoint import CheckpointManager
 
 DEBUG = True
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -236,7 +241,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -598,6 +604,72 @@ import itertools
 hyperparameter_list = ['learning_rate', 'num_iters', 'num_nodes', 'num_nodes_adv', 'dropout_rate', 'alpha']
 get_new_control_indices = False
 use_data_as_is = False
+control_match_number = 20
+control_seed = 42
+stratify_controls = False  # match controls within the case's sensitive group (ztrain)
+
+def _draw_controls(rng, control_pool, n_cases, k):
+    """
+    k distinct controls per case. Bulk draw with replacement, redrawing only the rows with a repeat (rare
+    when k is much smaller than the pool); when k is over half the pool a per-row permutation is used instead,
+    since redraws would rarely succeed there.
+    """
+    if 2 * k > len(control_pool):
+        return np.array([rng.permutation(control_pool)[:k] for _ in range(n_cases)], dtype=np.int64).reshape(n_cases, k)
+    matched = control_pool[rng.integers(0, len(control_pool), (n_cases, k))]
+    while k > 1:
+        ordered = np.sort(matched, axis=1)
+        dup_rows = np.flatnonzero((ordered[:, 1:] == ordered[:, :-1]).any(axis=1))
+        if dup_rows.size == 0:
+            break
+        matched[dup_rows] = control_pool[rng.integers(0, len(control_pool), (dup_rows.size, k))]
+    return matched
+
+def sample_matched_controls(ytrain, ztrain=None, match_number=20, seed=42, stratify=False,
+                            cache_dir='.', refresh=False):
+    """
+    Matched case-control sampling: for every case (y == 1) draw min(match_number, #controls) distinct
+    controls (y == 0), optionally restricted to controls from the case's sensitive group.
+    Returns the flat control indices (cases in ascending order, match_number per case), cached in
+    control_indices_seed<seed>_k<match_number>[_strat]_<hash of the case / control split>.npy.
+    """
+    y = ytrain.view(-1)
+    idx_case = torch.nonzero(y == 1, as_tuple=True)[0].numpy()
+    idx_control = torch.nonzero(y == 0, as_tuple=True)[0].numpy()
+    k = min(match_number, len(idx_control))
+    split_hash = hashlib.sha1(idx_case.astype(np.int64).tobytes() + b"|" + idx_control.astype(np.int64).tobytes())
+    if stratify and ztrain is not None:
+        split_hash.update(ztrain.view(-1).numpy().astype(np.int64).tobytes())
+    cache_file = os.path.join(cache_dir, f"control_indices_seed{seed}_k{match_number}{'_strat' if stratify else ''}"
+                                         f"_{split_hash.hexdigest()[:12]}.npy")
+    if not refresh and os.path.exists(cache_file):
+        matched = np.load(cache_file)
+        if matched.size == len(idx_case) * k and (matched.size == 0 or matched.max() < len(y)):
+            return matched.astype(np.int64)
+        print("Cached control indices do not match this training set; resampling.")
+    rng = np.random.default_rng(seed)
+    if not stratify or ztrain is None:
+        matched = _draw_controls(rng, idx_control, len(idx_case), k)
+    else:
+        z = ztrain.view(-1).numpy()
+        matched = np.empty((len(idx_case), k), dtype=np.int64)
+        case_groups = z[idx_case]
+        control_groups = z[idx_control]
+        for g in np.unique(case_groups):
+            rows = np.flatnonzero(case_groups == g)
+            pool = idx_control[control_groups == g]
+            if len(pool) < k:
+                print(f"Group {g}: only {len(pool)} controls for {len(rows)} cases, matching against all controls.")
+                pool = idx_control
+            matched[rows] = _draw_controls(rng, pool, len(rows), k)
+    matched = matched.reshape(-1)
+    dtype = np.int32 if len(y) < np.iinfo(np.int32).max else np.int64
+    # Parallel grid workers share the cache directory: write a private temp file, then rename it in place.
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, matched.astype(dtype))
+    os.replace(tmp_file, cache_file)
+    return matched.astype(np.int64)
 
 class Adv_Model(object):
     def __init__(self, params):
@@ -608,6 +680,9 @@ class Adv_Model(object):
         self.hyperparameters = self.params['hyperparameters']
         self.model = self.build_model()
         self.data = self.data_processing()
+        # Predictor / adversary snapshots go to model/<name>.safetensors and adv/<name>.safetensors.
+        self.checkpoints = CheckpointManager(".", manifest={"script": "04_AdvDebias", "method": self.method,
+                                                            "num_classes": self.num_classes})
 
     def get_indexes(self):
         num_models = []
@@ -704,31 +779,17 @@ class Adv_Model(object):
         for indexes in self.get_indexes():
             self.train_single_model(indexes)
 
-    def train_single_model(self, indexes):
-        model_dict = self.model[indexes]
-        model = model_dict['model']
-        loss_function = model_dict['loss_function']
-        optimizer = model_dict['optimizer']
+    def prepare_training_data(self):
+        """Matched case-control sampling and SMOTEENN resampling; shared by both training modes."""
         Xtrain = torch.tensor(self.params['Xtrain'].values).float()
         ytrain = torch.tensor(self.params['ytrain'].values).float().view(-1, 1)
-        Xvalid = torch.tensor(self.params['Xvalid'].values).float()
-        yvalid = torch.tensor(self.params['yvalid'].values).float().view(-1, 1)
         ztrain = torch.tensor(self.params['ztrain'].values).long().view(-1)
 
         if not use_data_as_is:
-            idx_case = [i for i in range(len(ytrain)) if ytrain[i] == 1]
-            idx_control = [i for i in range(len(ytrain)) if ytrain[i] == 0]
-            match_number = 20
-            if get_new_control_indices or not os.path.exists('control_indices.pkl'):
-                matched_cohort_indices = []
-                for i in idx_case:
-                    matched = random.sample(idx_control, min(match_number, len(idx_control)))
-                    matched_cohort_indices.extend(matched)
-                with open('control_indices.pkl', 'wb') as f:
-                    pickle.dump(matched_cohort_indices, f)
-            else:
-                with open('control_indices.pkl', 'rb') as f:
-                    matched_cohort_indices = pickle.load(f)
+            idx_case = torch.nonzero(ytrain.view(-1) == 1, as_tuple=True)[0]
+            matched_cohort_indices = torch.from_numpy(
+                sample_matched_controls(ytrain, ztrain, match_number=control_match_number, seed=control_seed,
+                                        stratify=stratify_controls, refresh=get_new_control_indices))
             Xtrain = torch.cat((Xtrain[matched_cohort_indices, :], Xtrain[idx_case, :]), dim=0)
             ytrain = torch.cat((ytrain[matched_cohort_indices, :], ytrain[idx_case, :]), dim=0)
             ztrain = torch.cat((ztrain[matched_cohort_indices], ztrain[idx_case]), dim=0)
@@ -744,11 +805,49 @@ class Adv_Model(object):
         ztrain = torch.tensor(Xz_res[:, -1]).long()
         ytrain = torch.tensor(ytrain_res).float().view(-1, 1)
 
+        return Xtrain, ytrain, ztrain
+
+    def train_single_model(self, indexes, training_mode=None, training_data=None):
+        """
+        training_mode: 'full_batch' (default, one pass over the whole resampled set per iteration) or
+        'minibatch' (DataLoader over the resampled tensors, validation every `eval_every` steps).
+        Both modes run num_iters optimizer steps. Returns (step, valid loss, elapsed seconds) per evaluation.
+        """
+        training_mode = training_mode or self.params.get('training_mode', 'full_batch')
+        model_dict = self.model[indexes]
+        model = model_dict['model']
+        Xtrain, ytrain, ztrain = training_data if training_data is not None else self.prepare_training_data()
+        Xvalid = torch.tensor(self.params['Xvalid'].values).float()
+        yvalid = torch.tensor(self.params['yvalid'].values).float().view(-1, 1)
+        if training_mode == 'minibatch':
+            history = self.train_minibatch(indexes, Xtrain, ytrain, ztrain, Xvalid, yvalid)
+        elif training_mode == 'full_batch':
+            history = self.train_full_batch(indexes, Xtrain, ytrain, ztrain, Xvalid, yvalid)
+        else:
+            raise ValueError(f"Unknown training_mode: {training_mode}")
+        self.save_checkpoint(indexes, model, "model/model-basic_final")
+        if self.adversarial:
+            self.save_checkpoint(indexes, model_dict['adversarial_model'], "adv/model-adv_final")
+        self.checkpoints.wait()
+        print("Training complete for hyperparameter setting:", self.params_tostring(indexes))
+        return history
+
+    def save_checkpoint(self, indexes, model, name, step=None):
+        return self.checkpoints.save(model, name, step=step, hyperparameters=self.params_tostring(indexes),
+                                     layers=[str(layer) for layer in model])
+
+    def train_full_batch(self, indexes, Xtrain, ytrain, ztrain, Xvalid, yvalid):
+        model_dict = self.model[indexes]
+        model = model_dict['model']
+        loss_function = model_dict['loss_function']
+        optimizer = model_dict['optimizer']
         if self.adversarial:
             adv_model = model_dict['adversarial_model']
             adv_loss_function = model_dict['adversarial_loss_function']
             adv_optimizer = model_dict['adversarial_optimizer']
 
+        start_time = time.time()
+        history = []
         num_iters = self.hyperparameters['num_iters'][indexes[1]]
         train_loss_list = []
         valid_loss_list = []
@@ -786,22 +885,130 @@ class Adv_Model(object):
             valid_loss_list.append(combined_loss_valid.item())
 
             if t % 100 == 0:
+                history.append((t, combined_loss_valid.item(), time.time() - start_time))
                 print(f"Iteration: {t}, Train Loss: {combined_loss_train.item():.4f}, Valid Loss: {combined_loss_valid.item():.4f}")
                 epoch_list.append(t)
             if t > 0 and t % 10000 == 0:
-                torch.save(model, "model/model-basic.pth")
+                self.save_checkpoint(indexes, model, "model/model-basic", step=t)
                 if self.adversarial:
-                    torch.save(adv_model, "adv/model-adv.pth")
+                    self.save_checkpoint(indexes, adv_model, "adv/model-adv", step=t)
 
+        if (num_iters - 1) % 100 != 0:
+            history.append((num_iters - 1, valid_loss_list[-1], time.time() - start_time))
         plt.plot(epoch_list, train_loss_list[:len(epoch_list)], color='blue', label="Train Loss")
         plt.plot(epoch_list, valid_loss_list[:len(epoch_list)], color='red', label="Valid Loss")
         plt.legend()
         plt.savefig("loss_metrics.png")
         plt.close()
-        torch.save(model, "model/model-basic_final.pth")
+        return history
+
+    def adversary_loss(self, adv_model, adv_loss_function, ypred, y, z):
+        zpred = adv_model(torch.cat((ypred, y), dim=1))
+        return adv_loss_function(zpred.squeeze(), z.float())
+
+    def train_minibatch(self, indexes, Xtrain, ytrain, ztrain, Xvalid, yvalid):
+        """
+        Mini-batch version of the full-batch loop. With an adversary, every step first updates the
+        adversary for `adv_steps` batches on detached predictions, then updates the predictor against it.
+        """
+        model_dict = self.model[indexes]
+        model = model_dict['model']
+        loss_function = model_dict['loss_function']
+        optimizer = model_dict['optimizer']
+        batch_size = self.params.get('batch_size', 256)
+        eval_every = self.params.get('eval_every', 100)
+        adv_steps = self.params.get('adv_steps', 1)
+        num_iters = self.hyperparameters['num_iters'][indexes[1]]
         if self.adversarial:
-            torch.save(adv_model, "adv/model-adv_final.pth")
-        print("Training complete for hyperparameter setting:", self.params_tostring(indexes))
+            adv_model = model_dict['adversarial_model']
+            adv_loss_function = model_dict['adversarial_loss_function']
+            adv_optimizer = model_dict['adversarial_optimizer']
+            alpha = self.hyperparameters['alpha'][indexes[5]]
+            zvalid = torch.tensor(self.params['zvalid'].values).long().view(-1)
+
+        loader = BatchLoader(TensorDataset(Xtrain, ytrain, ztrain), batch_size=batch_size, shuffle=True)
+        batches = iter(loader)
+        def next_batch():
+            nonlocal batches
+            try:
+                return next(batches)
+            except StopIteration:
+                batches = iter(loader)
+                return next(batches)
+
+        start_time = time.time()
+        history = []
+        train_loss_list = []
+        valid_loss_list = []
+        step_list = []
+        for t in range(num_iters):
+            model.train()
+            if self.adversarial:
+                adv_model.train()
+                for _ in range(adv_steps):
+                    xb, yb, zb = next_batch()
+                    with torch.no_grad():
+                        ypred_b = model(xb)
+                    adv_optimizer.zero_grad()
+                    self.adversary_loss(adv_model, adv_loss_function, ypred_b, yb, zb).backward()
+                    adv_optimizer.step()
+            xb, yb, zb = next_batch()
+            ypred_b = model(xb)
+            loss_train = loss_function(ypred_b, yb)
+            if self.adversarial:
+                adv_loss_train = self.adversary_loss(adv_model, adv_loss_function, ypred_b, yb, zb)
+                combined_loss_train = loss_train - alpha * adv_loss_train + loss_train / (adv_loss_train + 1e-8)
+            else:
+                combined_loss_train = loss_train
+            optimizer.zero_grad()
+            combined_loss_train.backward()
+            optimizer.step()
+
+            if t % eval_every == 0 or t == num_iters - 1:
+                model.eval()
+                with torch.no_grad():
+                    ypred_valid = model(Xvalid)
+                    loss_valid = loss_function(ypred_valid, yvalid)
+                    if self.adversarial:
+                        adv_model.eval()
+                        adv_loss_valid = self.adversary_loss(adv_model, adv_loss_function, ypred_valid, yvalid, zvalid)
+                        combined_loss_valid = loss_valid - alpha * adv_loss_valid + loss_valid / (adv_loss_valid + 1e-8)
+                    else:
+                        combined_loss_valid = loss_valid
+                train_loss_list.append(combined_loss_train.item())
+                valid_loss_list.append(combined_loss_valid.item())
+                step_list.append(t)
+                history.append((t, combined_loss_valid.item(), time.time() - start_time))
+                print(f"Step: {t}, Train Loss: {combined_loss_train.item():.4f}, Valid Loss: {combined_loss_valid.item():.4f}")
+            if t > 0 and t % 10000 == 0:
+                self.save_checkpoint(indexes, model, "model/model-basic", step=t)
+                if self.adversarial:
+                    self.save_checkpoint(indexes, adv_model, "adv/model-adv", step=t)
+
+        plt.plot(step_list, train_loss_list, color='blue', label="Train Loss")
+        plt.plot(step_list, valid_loss_list, color='red', label="Valid Loss")
+        plt.legend()
+        plt.savefig("loss_metrics_minibatch.png")
+        plt.close()
+        return history
+
+    def compare_training_modes(self, indexes, out_file='training_mode_comparison.csv'):
+        """Trains fresh copies of one configuration in both modes on the same resampled data and compares
+        wall-clock time and validation-loss convergence."""
+        training_data = self.prepare_training_data()
+        rows = []
+        for mode in ['full_batch', 'minibatch']:
+            self.model[indexes] = self.build_single_model(indexes)
+            history = self.train_single_model(indexes, training_mode=mode, training_data=training_data)
+            valid_losses = [h[1] for h in history]
+            best = int(np.argmin(valid_losses))
+            rows.append({'mode': mode, 'seconds': history[-1][2], 'final_valid_loss': valid_losses[-1],
+                         'best_valid_loss': valid_losses[best], 'best_step': history[best][0],
+                         'seconds_to_best': history[best][2]})
+        comparison = pd.DataFrame(rows)
+        comparison.to_csv(out_file, index=False)
+        print(comparison.to_string(index=False))
+        return comparison
 
     def evaluate(self):
         eval_file = 'metrics.csv'
@@ -853,6 +1060,31 @@ def get_metrics(ypred, y, z, hyperparameters, k=7, yselect=0, eval_file=None, zp
         metrics['roc_auc'] = float('nan')
     return metrics
 
+# Training options of train_single_model that --parallel forwards with every grid configuration.
+TRAINING_OPTIONS = {'training_mode': 'full_batch', 'batch_size': 256, 'eval_every': 100}
+
+def adv_grid_experiment(config, arrays, meta):
+    """
+    Entry point for grid_search.run_grid: trains and evaluates one Adv_Model configuration
+    on the shared (memmapped) train/valid arrays and returns its validation metrics.
+    """
+    def frame(name):
+        return pd.DataFrame(np.asarray(arrays[name]), columns=meta['columns'][name])
+    for d in ['model', 'adv']:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    params = {name: frame(name) for name in ['Xtrain', 'ytrain', 'Xvalid', 'yvalid', 'ztrain', 'zvalid']}
+    params['method'] = meta['method']
+    params['num_classes'] = meta['num_classes']
+    params['hyperparameters'] = {k: [config[k]] for k in hyperparameter_list}
+    for option, default in TRAINING_OPTIONS.items():
+        params[option] = config.get(option, default)
+    model = Adv_Model(params)
+    indexes = next(iter(model.get_indexes()))
+    model.train_single_model(indexes)
+    metrics = model.evaluate_single_model(indexes).iloc[0].to_dict()
+    return {k: v for k, v in metrics.items() if k not in hyperparameter_list}
+
 if __name__ == '__main__':
     structured_data = pd.read_csv('final_structured_common.csv')
     unstructured_data = pd.read_csv('final_unstructured_common.csv', low_memory=False)
@@ -992,9 +1224,9 @@ if __name__ == '__main__':
         torch.tensor(df_unique["mechanical_ventilation"].values.reshape(-1,1), dtype=torch.float32)
     ), test_idx)
 
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
 
     disease_mapping = {d: i for i, d in enumerate(df_unique["hadm_id"].unique())}
     NUM_DISEASES = len(disease_mapping)
@@ -1040,9 +1272,11 @@ if __name__ == '__main__':
 
     num_epochs = 20
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
     early_stop_patience = 5
-    best_model_path = "best_multimodal_model.pt"
+    best_model_name = "best_multimodal_model"
+    checkpoints = CheckpointManager(manifest={"script": "04_AdvDebias"})
 
     mortality_pos_weight = get_pos_weight(df_filtered["short_term_mortality"], device)
     los_pos_weight = get_pos_weight(df_filtered["los_binary"], device)
@@ -1072,7 +1306,8 @@ if __name__ == '__main__':
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(multimodal_model.state_dict(), best_model_path)
+            checkpoints.save(multimodal_model, best_model_name, metric=val_loss, step=epoch + 1)
+            best_saved = True
             print("  Validation loss improved. Saving model.")
         else:
             patience_counter += 1
@@ -1081,7 +1316,9 @@ if __name__ == '__main__':
                 print("Early stopping triggered.")
                 break
 
-    multimodal_model.load_state_dict(torch.load(best_model_path))
+    if best_saved:
+        checkpoints.load(multimodal_model, best_model_name)
+    checkpoints.close()
     print("\nEvaluating on test set...")
     metrics = evaluate_model_metrics(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True)
     print("\nFinal Evaluation Metrics on Test Set:")
@@ -1108,6 +1345,19 @@ if __name__ == '__main__':
     print("Training complete.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parallel", action="store_true",
+                        help="Train the Adv_Model grid on a process pool instead of one configuration after another.")
+    parser.add_argument("--shared_dir", default="adv_shared_inputs")
+    parser.add_argument("--results", default="adv_grid_results.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--training_mode", choices=["full_batch", "minibatch"], default="full_batch")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--eval_every", type=int, default=100, help="Validation interval (steps) in minibatch mode.")
+    parser.add_argument("--compare_modes", action="store_true",
+                        help="Train the first configuration in both modes and report time and convergence.")
+    args, _ = parser.parse_known_args()
     params = {
         'Xtrain': X_df.iloc[train_idx].reset_index(drop=True),
         'ytrain': y_df.iloc[train_idx].reset_index(drop=True),
@@ -1117,6 +1367,9 @@ if __name__ == "__main__":
         'zvalid': z_df.iloc[val_idx].reset_index(drop=True),
         'method': 'adv',  # adversarial debiasing
         'num_classes': 2,
+        'training_mode': args.training_mode,
+        'batch_size': args.batch_size,
+        'eval_every': args.eval_every,
         'hyperparameters': {
             'learning_rate': [1e-4, 5e-5],
             'num_iters': [1000, 2000],
@@ -1126,9 +1379,26 @@ if __name__ == "__main__":
             'alpha': [1, 2]
         }
     }
+    if args.parallel:
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from grid_search import run_grid, export_shared_arrays, shared_arrays_exist
+        frames = ['Xtrain', 'ytrain', 'Xvalid', 'yvalid', 'ztrain', 'zvalid']
+        if not shared_arrays_exist(args.shared_dir):
+            export_shared_arrays({name: params[name].values for name in frames}, args.shared_dir,
+                                 meta={'columns': {name: list(params[name].columns) for name in frames},
+                                       'method': params['method'], 'num_classes': params['num_classes']})
+        # The training options travel in each configuration rather than in the shared meta.json, which is only
+        # written when the arrays are first exported; they also keep results of different modes apart.
+        grid = dict(params['hyperparameters'], **{option: [params[option]] for option in TRAINING_OPTIONS})
+        run_grid(os.path.abspath(__file__), "adv_grid_experiment", grid, args.shared_dir,
+                 results_csv=args.results, n_workers=args.workers, threads_per_worker=args.threads_per_worker)
+        sys.exit(0)
     for d in ['model', 'adv', 'metrics']:
         if not os.path.exists(d):
             os.makedirs(d)
     adv_model = Adv_Model(params)
+    if args.compare_modes:
+        adv_model.compare_training_modes(next(iter(adv_model.get_indexes())))
+        sys.exit(0)
     adv_model.train()
     adv_model.evaluate()
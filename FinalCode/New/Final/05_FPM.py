@@ -9,7 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim import Adam, SGD, AdamW
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.utils.data import TensorDataset, DataLoader, Subset
+from torch.utils.data import TensorDataset, DataLoader, Subset, WeightedRandomSampler
 from transformers import BertModel, BertConfig, AutoTokenizer
 from sklearn.metrics import confusion_matrix, roc_auc_score, average_precision_score, f1_score, recall_score, precision_score
 from sklearn.linear_model import LogisticRegression
@@ -18,6 +18,9 @@ from sklearn.preprocessing import StandardScaler
 
 # Iterative stratification for multi-label splitting
 from iterstrat.ml_stratifiers import MultilabelStratifiedShuffleSplit
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from checkpoint import CheckpointManager
 
 DEBUG = True
 
@@ -67,10 +70,21 @@ def compute_frequency_dict(tensor):
     unique, counts = np.unique(arr, return_counts=True)
     return {int(u): int(c) for u, c in zip(unique, counts)}
 
-def compute_sample_weights(sensitive, freq_dict):
-    """For each sample, weight = 1 / frequency of its group."""
-    weights = [1.0 / freq_dict[int(s.item())] for s in sensitive]
-    return torch.tensor(weights, dtype=torch.float32, device=sensitive.device)
+def compute_group_weight_table(freq_dict, device=None):
+    """Lookup table indexed by group code: weight = 1 / frequency of the group (0 for unseen codes)."""
+    table = torch.zeros(max(freq_dict) + 1, dtype=torch.float32)
+    for group, count in freq_dict.items():
+        table[group] = 1.0 / count
+    return table.to(device) if device is not None else table
+
+def compute_sample_weights(sensitive, weight_table):
+    """For each sample, weight = 1 / frequency of its group, gathered on the sensitive tensor's device."""
+    return weight_table.to(sensitive.device)[sensitive]
+
+def build_group_balanced_sampler(sensitive, freq_dict):
+    """Samples each group with equal total probability, so rebalancing happens at sampling time."""
+    weights = compute_sample_weights(sensitive.cpu(), compute_group_weight_table(freq_dict))
+    return WeightedRandomSampler(weights.double(), num_samples=len(weights), replacement=True)
 
 def weighted_reconstruction_loss(x, x_recon, sample_weights):
     """Computes the weighted mean squared error loss."""
@@ -170,7 +184,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -283,19 +298,26 @@ class StackedDenoisingAutoencoder(nn.Module):
         return x_recon, z
 
 # FPM Pretraining Routine
-def pretrain_fpm_autoencoder(model, data_loader, optimizer, device, freq_dict):
+def pretrain_fpm_autoencoder(model, data_loader, optimizer, device, weight_table=None):
+    """
+    weight_table: per-group inverse-frequency weights (compute_group_weight_table) on `device`.
+    Pass None when the loader already rebalances groups with build_group_balanced_sampler.
+    """
     model.train()
-    running_loss = 0.0
+    running_loss = torch.zeros((), device=device)
     for batch in data_loader:
-        x_batch, sensitive_batch = [b.to(device) for b in batch]
+        x_batch, sensitive_batch = [b.to(device, non_blocking=True) for b in batch]
         optimizer.zero_grad()
         x_recon, _ = model(x_batch)
-        sample_weights = compute_sample_weights(sensitive_batch, freq_dict)
+        if weight_table is not None:
+            sample_weights = compute_sample_weights(sensitive_batch, weight_table)
+        else:
+            sample_weights = torch.ones(x_batch.size(0), device=device)
         loss = weighted_reconstruction_loss(x_batch, x_recon, sample_weights)
         loss.backward()
         optimizer.step()
-        running_loss += loss.item()
-    return running_loss / len(data_loader)
+        running_loss += loss.detach()
+    return running_loss.item() / len(data_loader)
 
 # Downstream Evaluation Functions
 def train_downstream_classifier(representations, labels):
@@ -472,7 +494,7 @@ def evaluate_model_metrics(model, dataloader, device, threshold=0.5, print_eddi=
     
     return metrics
 
-def train_pipeline():
+def train_pipeline(fpm_balancing="loss"):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("Using device:", device)
 
@@ -608,9 +630,9 @@ def train_pipeline():
     train_dataset = Subset(dataset, train_idx)
     val_dataset = Subset(dataset, val_idx)
     
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
     
     disease_mapping = {d: i for i, d in enumerate(df_unique["hadm_id"].unique())}
     NUM_DISEASES = len(disease_mapping)
@@ -659,9 +681,18 @@ def train_pipeline():
     num_epochs = 20
     print("Pre-training Fair Patient Model (FPM)...")
     fpm_dataset = TensorDataset(lab_features_tensor, sensitive_attribute)
-    fpm_loader = DataLoader(fpm_dataset, batch_size=32, shuffle=True)
+    if fpm_balancing == "sampler":
+        fpm_sampler = build_group_balanced_sampler(sensitive_attribute, freq_dict)
+        fpm_loader = BatchLoader(fpm_dataset, batch_size=32, sampler=fpm_sampler, device=device)
+        weight_table = None
+    elif fpm_balancing == "loss":
+        fpm_loader = BatchLoader(fpm_dataset, batch_size=32, shuffle=True, device=device)
+        weight_table = compute_group_weight_table(freq_dict, device)
+    else:
+        raise ValueError(f"Unknown fpm_balancing: {fpm_balancing}")
+    print("FPM group balancing:", fpm_balancing)
     for epoch in range(num_epochs):
-        loss = pretrain_fpm_autoencoder(fpm_model, fpm_loader, optimizer_fpm, device, freq_dict)
+        loss = pretrain_fpm_autoencoder(fpm_model, fpm_loader, optimizer_fpm, device, weight_table)
         print(f"[FPM Pretrain] Epoch {epoch+1}/{num_epochs} - Weighted Reconstruction Loss: {loss:.4f}")
     
     fpm_model.eval()
@@ -775,9 +806,9 @@ def train_pipeline():
     train_dataset = Subset(dataset, train_idx)
     val_dataset = Subset(dataset, val_idx)
     
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
     
     behrt_model = BEHRTModel(
         num_diseases=NUM_DISEASES,
@@ -839,9 +870,11 @@ def train_pipeline():
     
     num_epochs = 20
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
     early_stop_patience = 5
-    best_model_path = "best_multimodal_model.pt"
+    best_model_name = "best_multimodal_model"
+    checkpoints = CheckpointManager(manifest={"script": "05_FPM"})
     
     for epoch in range(num_epochs):
         multimodal_model.train()
@@ -884,7 +917,8 @@ def train_pipeline():
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(multimodal_model.state_dict(), best_model_path)
+            checkpoints.save(multimodal_model, best_model_name, metric=val_loss, step=epoch + 1)
+            best_saved = True
             print("  Validation loss improved. Saving model.")
         else:
             patience_counter += 1
@@ -893,7 +927,9 @@ def train_pipeline():
                 print("Early stopping triggered.")
                 break
     
-    multimodal_model.load_state_dict(torch.load(best_model_path))
+    if best_saved:
+        checkpoints.load(multimodal_model, best_model_name)
+    checkpoints.close()
     print("\nEvaluating on test set...")
     metrics = evaluate_model_metrics(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True)
     print("\nFinal Evaluation Metrics on Test Set:")
@@ -986,4 +1022,8 @@ def train_pipeline():
     print("FPM Baseline training, evaluation, and fairness analysis complete.")
 
 if __name__ == "__main__":
-    train_pipeline()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fpm_balancing", choices=["loss", "sampler"], default="loss",
+                        help="Rebalance ethnicity groups via inverse-frequency loss weights or a weighted sampler.")
+    args = parser.parse_args()
+    train_pipeline(fpm_balancing=args.fpm_balancing)
@@ -13,6 +13,12 @@ from torch.utils.data import TensorDataset, DataLoader, Subset, Dataset
 from transformers import BertModel, BertConfig, AutoTokenizer, AutoModel, RobertaModel
 from sklearn.metrics import confusion_matrix, roc_auc_score, average_precision_score, f1_score, recall_score, precision_score
 from iterstrat.ml_stratifiers import MultilabelStratifiedShuffleSplit
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from activation_memory import ActivationMemory, enable_gradient_checkpointing
+from lora import (apply_lora, merge_lora, save_lora_adapters, trainable_parameters, parameter_report,
+                  LORA_RANK, LORA_EPOCHS, LORA_LR)
+from checkpoint import CheckpointManager
 
 DEBUG = True
 
@@ -242,17 +248,26 @@ def generate_synthetic_longitudinal(long_tensor):
     return long_tensor + noise
 
 class BioClinicalBERT_FT(nn.Module):
-    def __init__(self, base_model, config, device):
+    def __init__(self, base_model, config, device, lora_rank=LORA_RANK):
         super(BioClinicalBERT_FT, self).__init__()
         self.BioBert = base_model
         self.device = device
+        if lora_rank:
+            # Base weights frozen, only the low-rank adapters are trained (see lora.py).
+            apply_lora(self.BioBert, r=lora_rank, alpha=2 * lora_rank)
+
+    def merge_adapters(self):
+        """Folds trained adapters into the BERT weights (needed before int8 / onnx text encoder backends)."""
+        merge_lora(self.BioBert)
+        return self
 
     def forward(self, input_ids, attention_mask):
         outputs = self.BioBert(input_ids=input_ids, attention_mask=attention_mask)
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -286,6 +301,47 @@ def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, d
     aggregated_embeddings = np.vstack(aggregated_embeddings)
     return aggregated_embeddings
 
+def finetune_text_encoder_lora(bert_ft, df, note_columns, tokenizer, device, train_rows, epochs=LORA_EPOCHS, lr=LORA_LR,
+                               batch_size=8, max_length=128, adapter_path="bioclinicalbert_lora.pt"):
+    """
+    Trains the LoRA adapters of bert_ft with a linear outcome head on the notes of the training rows of df
+    (each note labelled with its patient's three outcomes). Only the adapters and the head get optimizer state.
+    Saves the adapters alone, then merges them into BERT so the embedding backends see a plain encoder.
+    """
+    outcome_columns = ["short_term_mortality", "los_binary", "mechanical_ventilation"]
+    texts, targets = [], []
+    for _, row in df.iloc[train_rows].iterrows():
+        for col in note_columns:
+            if isinstance(row[col], str) and row[col].strip():
+                texts.append(row[col])
+                targets.append(row[outcome_columns].values.astype(np.float32))
+    targets = torch.tensor(np.array(targets), dtype=torch.float32)
+    head = nn.Linear(bert_ft.BioBert.config.hidden_size, len(outcome_columns)).to(device)
+    parameter_report(bert_ft)
+    memory = ActivationMemory.from_env(device, micro_batch_size=batch_size)
+    memory.prepare(bert_ft)
+    optimizer = torch.optim.AdamW(trainable_parameters(bert_ft) + list(head.parameters()), lr=lr)
+    criterion = nn.BCEWithLogitsLoss()
+    bert_ft.train()
+    for epoch in range(epochs):
+        order = np.random.permutation(len(texts))
+        running_loss = 0.0
+        for start in tqdm(range(0, len(texts), batch_size), desc=f"LoRA epoch {epoch+1}"):
+            idx = order[start:start + batch_size]
+            encoded = tokenizer([texts[i] for i in idx], padding="max_length", truncation=True,
+                                max_length=max_length, return_tensors="pt")
+            logits = head(bert_ft(encoded["input_ids"].to(device), encoded["attention_mask"].to(device)))
+            loss = criterion(logits, targets[idx].to(device))
+            memory.backward_step(loss, optimizer)
+            running_loss += loss.item()
+        memory.flush(optimizer)
+        print(f"[LoRA epoch {epoch+1}] note loss: {running_loss / max(1, -(-len(texts) // batch_size)):.4f}")
+    memory.report()
+    memory.close()
+    bert_ft.eval()
+    save_lora_adapters(bert_ft.BioBert, adapter_path)
+    return bert_ft.merge_adapters()
+
 class DemographicEncoder(nn.Module):
     def __init__(self, input_dim, hidden_dim):
         super(DemographicEncoder, self).__init__()
@@ -318,18 +374,91 @@ class LongitudinalEncoder(nn.Module):
         return out
 
 class NotesEncoder(nn.Module):
-    def __init__(self, model_name="roberta-large", output_dim=256):
+    def __init__(self, model_name="roberta-large", output_dim=256, gradient_checkpointing=False, lora_rank=LORA_RANK):
         super(NotesEncoder, self).__init__()
         self.roberta = AutoModel.from_pretrained(model_name)
+        if gradient_checkpointing:
+            # Recompute each layer's activations in backward instead of keeping them for the whole step.
+            enable_gradient_checkpointing(self.roberta)
+        if lora_rank:
+            # roberta is frozen and adapted through LoRA; the projection head below stays fully trainable.
+            apply_lora(self.roberta, r=lora_rank, alpha=2 * lora_rank)
         hidden_size = self.roberta.config.hidden_size
         self.proj = nn.Sequential(
             nn.Linear(hidden_size, output_dim),
             nn.ReLU()
         )
-    def forward(self, input_ids, attention_mask):
+    def encode_hidden(self, input_ids, attention_mask):
         outputs = self.roberta(input_ids=input_ids, attention_mask=attention_mask)
-        cls_emb = outputs.last_hidden_state[:, 0, :]
+        return outputs.last_hidden_state
+    def forward(self, input_ids, attention_mask):
+        cls_emb = self.encode_hidden(input_ids, attention_mask)[:, 0, :]
         return self.proj(cls_emb)
+    def merge_adapters(self):
+        merge_lora(self.roberta)
+        return self
+
+class NoteViewGenerator(nn.Module):
+    """
+    Builds the synthetic notes view in embedding space from the hidden states of a single
+    encoder pass, replacing the second NotesEncoder pass over `note + " [SYN]"`.
+    Modes:
+      - "noise":      CLS + gaussian noise (scaled by noise_std)
+      - "dropout":    feature dropout on the CLS vector
+      - "mixup":      CLS mixed with the CLS of a shuffled batch partner (lambda ~ Beta(alpha, alpha), kept >= 0.5)
+      - "token_mask": masked mean over a random subset of the observed token hidden states
+    In eval mode every mode returns the CLS vector, so validation and test passes are deterministic.
+    """
+    def __init__(self, mode="noise", noise_std=0.01, dropout_p=0.1, mixup_alpha=0.4, token_mask_p=0.15):
+        super(NoteViewGenerator, self).__init__()
+        if mode not in ("noise", "dropout", "mixup", "token_mask"):
+            raise ValueError(f"Unknown view generation mode: {mode}")
+        self.mode = mode
+        self.noise_std = noise_std
+        self.dropout_p = dropout_p
+        self.mixup_alpha = mixup_alpha
+        self.token_mask_p = token_mask_p
+
+    def forward(self, hidden_states, attention_mask=None):
+        # hidden_states: (batch, seq_len, hidden) from encode_hidden, or cached (batch, hidden) CLS vectors.
+        if hidden_states.dim() == 2:
+            if self.mode == "token_mask":
+                raise ValueError("token_mask views need token-level hidden states, not cached CLS vectors.")
+            cls_emb = hidden_states
+        else:
+            cls_emb = hidden_states[:, 0, :]
+        if not self.training:
+            return cls_emb
+        if self.mode == "noise":
+            return cls_emb + torch.randn_like(cls_emb) * self.noise_std
+        if self.mode == "dropout":
+            return F.dropout(cls_emb, p=self.dropout_p, training=True)
+        if self.mode == "mixup":
+            lam = np.random.beta(self.mixup_alpha, self.mixup_alpha)
+            lam = max(lam, 1.0 - lam)
+            perm = torch.randperm(cls_emb.size(0), device=cls_emb.device)
+            return lam * cls_emb + (1.0 - lam) * cls_emb[perm]
+        if attention_mask is None:
+            attention_mask = torch.ones(hidden_states.shape[:2], dtype=torch.long, device=hidden_states.device)
+        keep = (torch.rand(attention_mask.shape, device=hidden_states.device) >= self.token_mask_p)
+        keep = keep & attention_mask.bool()
+        keep[:, 0] = True  # always keep the CLS position so no row is empty
+        keep = keep.unsqueeze(-1).to(hidden_states.dtype)
+        return (hidden_states * keep).sum(dim=1) / keep.sum(dim=1)
+
+def cache_note_cls_embeddings(notes_encoder, input_ids, attention_mask, device, batch_size=32):
+    """
+    Runs a frozen NotesEncoder once over all notes and returns the CLS vectors on CPU.
+    The cache can then feed both the real and the synthetic view every epoch.
+    """
+    notes_encoder.eval()
+    cached = []
+    with torch.no_grad():
+        for start in range(0, input_ids.size(0), batch_size):
+            ids = input_ids[start:start + batch_size].to(device)
+            mask = attention_mask[start:start + batch_size].to(device)
+            cached.append(notes_encoder.encode_hidden(ids, mask)[:, 0, :].cpu())
+    return torch.cat(cached, dim=0)
 
 class FusionModule(nn.Module):
     def __init__(self, input_dim, fusion_dim):
@@ -450,33 +579,56 @@ class FairEHR_CLP(nn.Module):
                  num_long_features=20, long_embed_dim=256, conv_out=256,
                  transformer_hidden=512, nhead=8, num_layers=2,
                  notes_model_name="roberta-large", notes_out=256,
-                 fusion_dim=256, num_classes=2):
+                 fusion_dim=256, num_classes=2,
+                 view_mode="noise", view_kwargs=None, gradient_checkpointing=False, lora_rank=LORA_RANK):
         super(FairEHR_CLP, self).__init__()
         self.demo_encoder = DemographicEncoder(demo_input_dim, demo_hidden)
         self.long_encoder = LongitudinalEncoder(num_long_features, embed_dim=long_embed_dim,
                                                 conv_out_channels=conv_out,
                                                 transformer_hidden=transformer_hidden,
                                                 nhead=nhead, num_layers=num_layers)
-        self.notes_encoder = NotesEncoder(model_name=notes_model_name, output_dim=notes_out)
+        self.notes_encoder = NotesEncoder(model_name=notes_model_name, output_dim=notes_out,
+                                          gradient_checkpointing=gradient_checkpointing, lora_rank=lora_rank)
+        self.view_generator = NoteViewGenerator(mode=view_mode, **(view_kwargs or {}))
         fusion_input_dim = demo_hidden + long_embed_dim + notes_out
         self.fusion = FusionModule(fusion_input_dim, fusion_dim)
         self.dr = DynamicRelevance(fusion_dim)
         self.classifier = Classifier(fusion_dim, num_classes)
     def forward(self,
                 demo_real, long_real, notes_real_input_ids, notes_real_attention_mask,
-                demo_syn, long_syn, notes_syn_input_ids, notes_syn_attention_mask):
+                demo_syn=None, long_syn=None, notes_syn_input_ids=None, notes_syn_attention_mask=None,
+                notes_real_cls=None):
+        # The synthetic notes view is derived from the real hidden states, so roberta runs once per sample.
+        # Passing notes_syn_input_ids keeps the original two-pass behaviour; passing notes_real_cls
+        # (see cache_note_cls_embeddings) skips the encoder entirely for a frozen roberta.
+        if demo_syn is None:
+            demo_syn = generate_synthetic_demographics(demo_real)
+        if long_syn is None:
+            long_syn = generate_synthetic_longitudinal(long_real)
         ed_real = self.demo_encoder(demo_real)
         ed_syn = self.demo_encoder(demo_syn)
         el_real = self.long_encoder(long_real)
         el_syn = self.long_encoder(long_syn)
-        en_real = self.notes_encoder(notes_real_input_ids, notes_real_attention_mask)
-        en_syn = self.notes_encoder(notes_syn_input_ids, notes_syn_attention_mask)
+        if notes_real_cls is not None:
+            hidden = notes_real_cls.to(ed_real.dtype)
+            cls_emb = hidden
+        else:
+            hidden = self.notes_encoder.encode_hidden(notes_real_input_ids, notes_real_attention_mask)
+            cls_emb = hidden[:, 0, :]
+        en_real = self.notes_encoder.proj(cls_emb)
+        if notes_syn_input_ids is not None:
+            en_syn = self.notes_encoder(notes_syn_input_ids, notes_syn_attention_mask)
+        else:
+            en_syn = self.notes_encoder.proj(self.view_generator(hidden, notes_real_attention_mask))
         fused_real = self.fusion(torch.cat([ed_real, el_real, en_real], dim=1))
         fused_syn  = self.fusion(torch.cat([ed_syn, el_syn, en_syn], dim=1))
         e_adj = self.dr(fused_real)
         e_adj_syn = self.dr(fused_syn)
         logits = self.classifier(e_adj)
         return logits, e_adj, e_adj_syn
+    def merge_adapters(self):
+        self.notes_encoder.merge_adapters()
+        return self
 
 def contrastive_loss(e_real, e_syn, tau=0.5, gamma=0.1):
     batch_size = e_real.size(0)
@@ -687,9 +839,23 @@ def train_pipeline():
     if "segment" not in df_unique.columns:
         df_unique["segment"] = 0
 
+    labels_array = df_unique[["short_term_mortality", "los_binary", "mechanical_ventilation"]].values
+    msss = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=42)
+    train_val_idx, test_idx = next(msss.split(df_unique, labels_array))
+    print("Train/Val samples:", len(train_val_idx), "Test samples:", len(test_idx))
+    msss_val = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=0.05, random_state=42)
+    train_idx_rel, val_idx_rel = next(msss_val.split(np.zeros(len(train_val_idx)), labels_array[train_val_idx]))
+    train_idx = [train_val_idx[i] for i in train_idx_rel]
+    val_idx = [train_val_idx[i] for i in val_idx_rel]
+    print(f"Final split -> Train: {len(train_idx)}, Validation: {len(val_idx)}, Test: {len(test_idx)}")
+
     tokenizer = AutoTokenizer.from_pretrained("emilyalsentzer/Bio_ClinicalBERT")
     bioclinical_bert_base = BertModel.from_pretrained("emilyalsentzer/Bio_ClinicalBERT")
     bioclinical_bert_ft = BioClinicalBERT_FT(bioclinical_bert_base, bioclinical_bert_base.config, device).to(device)
+    if LORA_RANK:
+        # Adapters are fitted on the training patients only, then merged before the embeddings are extracted.
+        bioclinical_bert_ft = finetune_text_encoder_lora(bioclinical_bert_ft, df_unique, note_columns, tokenizer,
+                                                         device, train_idx)
     aggregated_text_embeddings_np = apply_bioclinicalbert_on_patient_notes(
         df_unique, note_columns, tokenizer, bioclinical_bert_ft, device, aggregation="mean"
     )
@@ -743,26 +909,15 @@ def train_pipeline():
         labels_mortality, labels_los, labels_vent
     )
     
-    labels_array = df_unique[["short_term_mortality", "los_binary", "mechanical_ventilation"]].values
-    msss = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=42)
-    train_val_idx, test_idx = next(msss.split(df_unique, labels_array))
-    print("Train/Val samples:", len(train_val_idx), "Test samples:", len(test_idx))
-    
     train_val_dataset = Subset(dataset, train_val_idx)
     test_dataset = Subset(dataset, test_idx)
     
-    msss_val = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=0.05, random_state=42)
-    train_idx_rel, val_idx_rel = next(msss_val.split(np.zeros(len(train_val_idx)), labels_array[train_val_idx]))
-    train_idx = [train_val_idx[i] for i in train_idx_rel]
-    val_idx = [train_val_idx[i] for i in val_idx_rel]
-    print(f"Final split -> Train: {len(train_idx)}, Validation: {len(val_idx)}, Test: {len(test_idx)}")
-    
     train_dataset = Subset(dataset, train_idx)
     val_dataset = Subset(dataset, val_idx)
     
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
     
     disease_mapping = {d: i for i, d in enumerate(df_unique["hadm_id"].unique())}
     NUM_DISEASES = len(disease_mapping)
@@ -803,18 +958,26 @@ def train_pipeline():
         hidden_size=512
     ).to(device)
     
+    # The fusion model runs on precomputed text embeddings and holds no transformers model, so only
+    # TARGET_BATCH_SIZE accumulation applies here; ACTIVATION_MEMORY=checkpoint acts on the BERT trained
+    # in finetune_text_encoder_lora.
+    memory = ActivationMemory.from_env(device, micro_batch_size=train_loader.batch_size)
+    multimodal_model = memory.prepare(multimodal_model)
     optimizer = torch.optim.Adam(multimodal_model.parameters(), lr=1e-4)
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
     
     num_epochs = 20
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
     early_stop_patience = 5
-    best_model_path = "best_multimodal_model.pt"
+    best_model_name = "best_multimodal_model"
+    checkpoints = CheckpointManager(manifest={"script": "06_FairEHR-CLP"})
     
     for epoch in range(num_epochs):
         multimodal_model.train()
         running_loss = 0.0
+        optimizer.zero_grad()
         for batch in tqdm(train_loader, desc=f"Epoch {epoch+1} Training"):
             (dummy_input_ids, dummy_attn_mask,
              age_ids, segment_ids, adm_loc_ids, discharge_loc_ids,
@@ -822,7 +985,6 @@ def train_pipeline():
              aggregated_text_embeddings,  # renamed for clarity
              labels_mortality, labels_los, labels_vent) = [x.to(device) for x in batch]
             
-            optimizer.zero_grad()
             mortality_logits, los_logits, vent_logits = multimodal_model(
                 dummy_input_ids, dummy_attn_mask,
                 age_ids, segment_ids, adm_loc_ids, discharge_loc_ids,
@@ -833,9 +995,9 @@ def train_pipeline():
             loss_los = criterion_los(los_logits, labels_los.unsqueeze(1))
             loss_vent = criterion_mech(vent_logits, labels_vent.unsqueeze(1))
             loss = loss_mort + loss_los + loss_vent
-            loss.backward()
-            optimizer.step()
+            memory.backward_step(loss, optimizer)
             running_loss += loss.item()
+        memory.flush(optimizer)
         train_loss = running_loss / len(train_loader)
         
         val_loss = evaluate_model_loss(multimodal_model, val_loader, device,
@@ -854,7 +1016,8 @@ def train_pipeline():
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(multimodal_model.state_dict(), best_model_path)
+            checkpoints.save(multimodal_model, best_model_name, metric=val_loss, step=epoch + 1)
+            best_saved = True
             print("  Validation loss improved. Saving model.")
         else:
             patience_counter += 1
@@ -863,7 +1026,11 @@ def train_pipeline():
                 print("Early stopping triggered.")
                 break
     
-    multimodal_model.load_state_dict(torch.load(best_model_path))
+    memory.report()
+    memory.close()
+    if best_saved:
+        checkpoints.load(multimodal_model, best_model_name)
+    checkpoints.close()
     print("\nEvaluating on test set...")
     metrics = evaluate_model_metrics(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True)
     print("\nFinal Evaluation Metrics on Test Set:")
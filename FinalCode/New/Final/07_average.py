@@ -13,6 +13,12 @@ from torch.utils.data import TensorDataset, DataLoader, Subset
 from transformers import BertModel, BertConfig, AutoTokenizer
 from sklearn.metrics import roc_auc_score, average_precision_score, f1_score, recall_score, precision_score
 from iterstrat.ml_stratifiers import MultilabelStratifiedShuffleSplit
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from bootstrap_ci import bootstrap_report, print_bootstrap_report, save_bootstrap_report, BOOTSTRAP_SAMPLES
+from intersectional import intersectional_report
+from perf_mode import PerfMode, record_perf_run
+from checkpoint import CheckpointManager
 
 DEBUG = True
 
@@ -110,7 +116,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -235,8 +242,10 @@ class MultimodalTransformer(nn.Module):
         return mortality_logits, los_logits, vent_logits
 
 # Training and Evaluation Functions
-def train_step(model, dataloader, optimizer, device, crit_mort, crit_los, crit_vent):
+def train_step(model, dataloader, optimizer, device, crit_mort, crit_los, crit_vent, perf=None):
     model.train()
+    if perf is None:
+        perf = PerfMode(device)
     running_loss = 0.0
     for batch in dataloader:
         (dummy_input_ids, dummy_attn_mask,
@@ -245,19 +254,20 @@ def train_step(model, dataloader, optimizer, device, crit_mort, crit_los, crit_v
          aggregated_text_embedding,
          labels_mortality, labels_los, labels_vent) = [x.to(device) for x in batch]
 
+        perf.start_step()
         optimizer.zero_grad()
-        mortality_logits, los_logits, vent_logits = model(
-            dummy_input_ids, dummy_attn_mask,
-            age_ids, segment_ids, adm_loc_ids, discharge_loc_ids,
-            gender_ids, ethnicity_ids, insurance_ids,
-            aggregated_text_embedding
-        )
-        loss_mort = crit_mort(mortality_logits, labels_mortality.unsqueeze(1))
-        loss_los = crit_los(los_logits, labels_los.unsqueeze(1))
-        loss_vent = crit_vent(vent_logits, labels_vent.unsqueeze(1))
-        loss = loss_mort + loss_los + loss_vent
-        loss.backward()
-        optimizer.step()
+        with perf.autocast():
+            mortality_logits, los_logits, vent_logits = model(
+                dummy_input_ids, dummy_attn_mask,
+                age_ids, segment_ids, adm_loc_ids, discharge_loc_ids,
+                gender_ids, ethnicity_ids, insurance_ids,
+                aggregated_text_embedding
+            )
+            loss_mort = crit_mort(mortality_logits, labels_mortality.unsqueeze(1))
+            loss_los = crit_los(los_logits, labels_los.unsqueeze(1))
+            loss_vent = crit_vent(vent_logits, labels_vent.unsqueeze(1))
+            loss = loss_mort + loss_los + loss_vent
+        perf.backward_step(loss, optimizer)
         running_loss += loss.item()
     return running_loss
 
@@ -285,7 +295,7 @@ def evaluate_model_loss(model, dataloader, device, crit_mort, crit_los, crit_ven
             running_loss += loss.item()
     return running_loss / len(dataloader)
 
-def evaluate_model_metrics(model, dataloader, device, threshold=0.5, print_eddi=False):
+def evaluate_model_metrics(model, dataloader, device, threshold=0.5, print_eddi=False, bootstrap=0, intersectional=False):
     model.eval()
     all_mort_logits = []
     all_los_logits = []
@@ -418,7 +428,21 @@ def evaluate_model_metrics(model, dataloader, device, threshold=0.5, print_eddi=
                 score = eddi["insurance_subgroup_eddi"].get(group, 0)
                 print(f"    {group}: {score:.4f}")
             print("  Final Overall {} EDDI: {:.4f}".format(task.capitalize(), eddi["final_EDDI"]))
-    
+
+    if bootstrap or intersectional:
+        sensitive = {
+            "age": np.array([get_age_bucket(a) for a in torch.cat(all_age, dim=0).numpy().squeeze()]),
+            "ethnicity": np.array([map_ethnicity(e) for e in torch.cat(all_ethnicity, dim=0).numpy().squeeze()]),
+            "insurance": np.array([map_insurance(i) for i in torch.cat(all_insurance, dim=0).numpy().squeeze()]),
+        }
+        all_labels_np = np.stack([labels_mort_np, labels_los_np, labels_mech_np], axis=1)
+        all_probs_np = np.stack([mort_probs, los_probs, mech_probs], axis=1)
+    if bootstrap:
+        metrics["bootstrap_ci"] = bootstrap_report(all_labels_np, all_probs_np, sensitive, threshold, n_boot=bootstrap)
+        print_bootstrap_report(metrics["bootstrap_ci"])
+        save_bootstrap_report(metrics["bootstrap_ci"])
+    if intersectional:
+        metrics["intersectional"], _ = intersectional_report(all_labels_np, all_probs_np, sensitive, threshold)
     return metrics
 
 def train_pipeline():
@@ -562,9 +586,9 @@ def train_pipeline():
     train_dataset = Subset(dataset, train_idx)
     val_dataset = Subset(dataset, val_idx)
     
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
     
     disease_mapping = {d: i for i, d in enumerate(df_unique["hadm_id"].unique())}
     NUM_DISEASES = len(disease_mapping)
@@ -604,20 +628,24 @@ def train_pipeline():
         device=device,
         hidden_size=512
     ).to(device)
+    perf = PerfMode.from_env(device)
+    multimodal_model = perf.compile(multimodal_model)
 
     optimizer = torch.optim.Adam(multimodal_model.parameters(), lr=1e-4)
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
 
     num_epochs = 20
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
     early_stop_patience = 5
-    best_model_path = "best_multimodal_model.pt"
+    best_model_name = "best_multimodal_model"
+    checkpoints = CheckpointManager(manifest={"script": "07_average"})
 
     for epoch in range(num_epochs):
         multimodal_model.train()
         running_loss = train_step(multimodal_model, train_loader, optimizer, device,
-                                  criterion_mortality, criterion_los, criterion_mech)
+                                  criterion_mortality, criterion_los, criterion_mech, perf=perf)
         train_loss = running_loss / len(train_loader)
         val_loss = evaluate_model_loss(multimodal_model, val_loader, device,
                                        criterion_mortality, criterion_los, criterion_mech)
@@ -637,7 +665,8 @@ def train_pipeline():
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(multimodal_model.state_dict(), best_model_path)
+            checkpoints.save(multimodal_model, best_model_name, metric=val_loss, step=epoch + 1)
+            best_saved = True
             print("  Validation loss improved. Saving model.")
         else:
             patience_counter += 1
@@ -647,9 +676,13 @@ def train_pipeline():
                 break
 
     # Load the best model for final evaluation
-    multimodal_model.load_state_dict(torch.load(best_model_path))
+    if best_saved:
+        checkpoints.load(multimodal_model, best_model_name)
+    checkpoints.close()
     print("\nEvaluating on test set...")
-    metrics = evaluate_model_metrics(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True)
+    metrics = evaluate_model_metrics(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True,
+                                     bootstrap=BOOTSTRAP_SAMPLES, intersectional=True)
+    record_perf_run("07_average", perf, {"best_val_loss": best_val_loss, "test": metrics})
     print("\nFinal Evaluation Metrics on Test Set:")
     for outcome in ["mortality", "los", "mechanical_ventilation"]:
         m = metrics[outcome]
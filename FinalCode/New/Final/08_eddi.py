@@ -15,6 +15,13 @@ from torch.utils.data import TensorDataset, DataLoader
 from transformers import BertModel, BertConfig, AutoTokenizer
 from sklearn.metrics import roc_auc_score, average_precision_score, f1_score, recall_score, precision_score, confusion_matrix
 from iterstrat.ml_stratifiers import MultilabelStratifiedShuffleSplit 
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from bootstrap_ci import bootstrap_report, print_bootstrap_report, save_bootstrap_report, BOOTSTRAP_SAMPLES
+from intersectional import intersectional_report
+from lab_encoder import build_lab_encoder, mark_missing_labs
+from perf_mode import PerfMode, record_perf_run
+from checkpoint import CheckpointManager
 
 DEBUG = True
 
@@ -104,7 +111,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -347,8 +355,10 @@ class MultimodalTransformer(nn.Module):
         return mort_logit, los_logit, mv_logit, eddi_details
 
 # Training, Validation, and Evaluation Steps
-def train_step(model, dataloader, optimizer, device, beta=0.3, loss_gamma=1.0, target=1.0, old_eddi_weights=None):
+def train_step(model, dataloader, optimizer, device, beta=0.3, loss_gamma=1.0, target=1.0, old_eddi_weights=None, perf=None):
     model.train()
+    if perf is None:
+        perf = PerfMode(device)
     running_loss = 0.0
     for batch in dataloader:
         (demo_dummy_ids, demo_attn_mask,
@@ -356,6 +366,7 @@ def train_step(model, dataloader, optimizer, device, beta=0.3, loss_gamma=1.0, t
          lab_features, aggregated_text_embedding,
          labels_mortality, labels_los, labels_mechvent) = [x.to(device) for x in batch]
 
+        perf.start_step()
         optimizer.zero_grad()
 
         # Create dictionaries for ground‐truth labels and sensitive attributes.
@@ -371,23 +382,22 @@ def train_step(model, dataloader, optimizer, device, beta=0.3, loss_gamma=1.0, t
             "mechanical_ventilation": gender_ids.cpu().numpy()
         }
 
-        mort_logit, los_logit, mv_logit, _ = model(
-            demo_dummy_ids, demo_attn_mask,
-            age_ids, gender_ids, ethnicity_ids, insurance_ids,
-            lab_features, aggregated_text_embedding, beta=beta,
-            y_true_dict=y_true_dict, sensitive_labels_dict=sensitive_labels_dict,
-            old_eddi_weights=old_eddi_weights
-        )
-        loss_mort = criterion_mortality(mort_logit, labels_mortality.unsqueeze(1))
-        loss_los = criterion_los(los_logit, labels_los.unsqueeze(1))
-        loss_mv = criterion_mech(mv_logit, labels_mechvent.unsqueeze(1))
-        # Example EDDI loss on the mortality branch (you may adjust this)
-        eddi_loss = ((mort_logit - target) ** 2).mean()
-        loss = loss_mort + loss_los + loss_mv + loss_gamma * eddi_loss
-
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-        optimizer.step()
+        with perf.autocast():
+            mort_logit, los_logit, mv_logit, _ = model(
+                demo_dummy_ids, demo_attn_mask,
+                age_ids, gender_ids, ethnicity_ids, insurance_ids,
+                lab_features, aggregated_text_embedding, beta=beta,
+                y_true_dict=y_true_dict, sensitive_labels_dict=sensitive_labels_dict,
+                old_eddi_weights=old_eddi_weights
+            )
+            loss_mort = criterion_mortality(mort_logit, labels_mortality.unsqueeze(1))
+            loss_los = criterion_los(los_logit, labels_los.unsqueeze(1))
+            loss_mv = criterion_mech(mv_logit, labels_mechvent.unsqueeze(1))
+            # Example EDDI loss on the mortality branch (you may adjust this)
+            eddi_loss = ((mort_logit - target) ** 2).mean()
+            loss = loss_mort + loss_los + loss_mv + loss_gamma * eddi_loss
+
+        perf.backward_step(loss, optimizer, model.parameters(), max_norm=1.0)
         running_loss += loss.item()
     return running_loss
 
@@ -429,7 +439,8 @@ def validate_step(model, dataloader, device, beta=0.3, loss_gamma=1.0, target=1.
             last_eddi_details = eddi_details
     return running_loss, last_eddi_details
 
-def evaluate_model_with_confusion(model, dataloader, device, threshold=0.5, old_eddi_weights=None):
+def evaluate_model_with_confusion(model, dataloader, device, threshold=0.5, old_eddi_weights=None, bootstrap=0,
+                                  intersectional=False):
     model.eval()
     all_mort_logits, all_los_logits, all_mv_logits = [], [], []
     all_labels_mort, all_labels_los, all_labels_mv = [], [], []
@@ -559,10 +570,23 @@ def evaluate_model_with_confusion(model, dataloader, device, threshold=0.5, old_
         "los": eddi_stats_los,
         "mechanical_ventilation": eddi_stats_mv
     }
+    if bootstrap:
+        metrics["bootstrap_ci"] = bootstrap_report(np.stack([labels_mort_np, labels_los_np, labels_mv_np], axis=1),
+                                                   np.stack([mort_probs, los_probs, mv_probs], axis=1),
+                                                   {"age": age_groups, "ethnicity": ethnicity_groups, "insurance": insurance_groups},
+                                                   threshold, n_boot=bootstrap)
+        print_bootstrap_report(metrics["bootstrap_ci"])
+        save_bootstrap_report(metrics["bootstrap_ci"])
+    if intersectional:
+        metrics["intersectional"], _ = intersectional_report(np.stack([labels_mort_np, labels_los_np, labels_mv_np], axis=1),
+                                                             np.stack([mort_probs, los_probs, mv_probs], axis=1),
+                                                             {"age": age_groups, "ethnicity": ethnicity_groups, "insurance": insurance_groups},
+                                                             threshold)
     return metrics
 
 def evaluate_model(model, dataloader, device, threshold=0.5, old_eddi_weights=None):
-    metrics = evaluate_model_with_confusion(model, dataloader, device, threshold, old_eddi_weights=old_eddi_weights)
+    metrics = evaluate_model_with_confusion(model, dataloader, device, threshold, old_eddi_weights=old_eddi_weights,
+                                            bootstrap=BOOTSTRAP_SAMPLES, intersectional=True)
     return metrics
 
 
@@ -648,21 +672,23 @@ def train_pipeline():
                            and pd.api.types.is_numeric_dtype(df_filtered[col])]
     print("Number of lab feature columns:", len(lab_feature_columns))
     
-    for df in [train_df, val_df, test_df]:
+    lab_missing = {}
+    for name, df in [("train", train_df), ("val", val_df), ("test", test_df)]:
+        lab_missing[name] = df[lab_feature_columns].isna().values
         df[lab_feature_columns] = df[lab_feature_columns].fillna(0)
 
     lab_features_train = train_df[lab_feature_columns].values.astype(np.float32)
     lab_mean = np.mean(lab_features_train, axis=0)
     lab_std = np.std(lab_features_train, axis=0) + 1e-6
 
-    def process_lab_features(df):
+    def process_lab_features(df, missing):
         lab_features = df[lab_feature_columns].values.astype(np.float32)
         lab_features = (lab_features - lab_mean) / lab_std
-        return lab_features
+        return mark_missing_labs(lab_features, missing)
 
-    lab_train = process_lab_features(train_df)
-    lab_val = process_lab_features(val_df)
-    lab_test = process_lab_features(test_df)
+    lab_train = process_lab_features(train_df, lab_missing["train"])
+    lab_val = process_lab_features(val_df, lab_missing["val"])
+    lab_test = process_lab_features(test_df, lab_missing["test"])
 
     def create_dataset(df, agg_text_np, lab_features_np):
         num_samples = len(df)
@@ -689,9 +715,9 @@ def train_pipeline():
     val_dataset = create_dataset(val_df, agg_text_val, lab_val)
     test_dataset = create_dataset(test_df, agg_text_test, lab_test)
 
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
 
     NUM_AGES = train_df["age"].nunique()
     NUM_GENDERS = train_df["GENDER"].nunique()
@@ -712,7 +738,8 @@ def train_pipeline():
         num_insurances=NUM_INSURANCES,
         hidden_size=768
     ).to(device)
-    behrt_lab = BEHRTModel_Lab(
+    behrt_lab = build_lab_encoder(
+        BEHRTModel_Lab,
         lab_token_count=NUM_LAB_FEATURES,
         hidden_size=768,
         nhead=8,
@@ -728,6 +755,8 @@ def train_pipeline():
         device=device,
         beta=beta_value
     ).to(device)
+    perf = PerfMode.from_env(device)
+    multimodal_model = perf.compile(multimodal_model)
 
     optimizer = torch.optim.Adam(multimodal_model.parameters(), lr=1e-5)
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
@@ -746,6 +775,8 @@ def train_pipeline():
     loss_gamma = 1.0
 
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
+    checkpoints = CheckpointManager(manifest={"script": "08_eddi"})
     epochs_no_improve = 0
 
     # Initialize old_eddi_weights as an empty dict.
@@ -754,7 +785,7 @@ def train_pipeline():
     for epoch in range(max_epochs):
         train_loss = train_step(multimodal_model, train_loader, optimizer, device,
                                 beta=beta_value, loss_gamma=loss_gamma, target=1.0,
-                                old_eddi_weights=old_eddi_weights)
+                                old_eddi_weights=old_eddi_weights, perf=perf)
         train_loss_epoch = train_loss / len(train_loader)
         
         val_loss, last_eddi_details = validate_step(multimodal_model, val_loader, device,
@@ -779,7 +810,8 @@ def train_pipeline():
         if val_loss_epoch < best_val_loss:
             best_val_loss = val_loss_epoch
             epochs_no_improve = 0
-            torch.save(multimodal_model.state_dict(), "best_model.pth")
+            checkpoints.save(multimodal_model, "best_model", metric=val_loss_epoch, step=epoch + 1)
+            best_saved = True
             print("Validation loss improved. Saving model...")
         else:
             epochs_no_improve += 1
@@ -799,8 +831,11 @@ def train_pipeline():
     
     print("Training complete.\n")
     
-    multimodal_model.load_state_dict(torch.load("best_model.pth"))
+    if best_saved:
+        checkpoints.load(multimodal_model, "best_model")
+    checkpoints.close()
     final_metrics = evaluate_model(multimodal_model, test_loader, device, threshold=0.5, old_eddi_weights=old_eddi_weights)
+    record_perf_run("08_eddi", perf, {"best_val_loss": best_val_loss, "test": final_metrics})
     
     print("\n--- Unique Subgroups (Fixed Order) ---")
     print("Age subgroups      :", ["15-29", "30-49", "50-69", "70-89", "Other"])
@@ -15,6 +15,11 @@ from torch.utils.data import TensorDataset, DataLoader
 
 from transformers import BertModel, BertConfig, AutoTokenizer
 from sklearn.metrics import roc_auc_score, average_precision_score, f1_score, precision_score, confusion_matrix
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from lab_encoder import build_lab_encoder, mark_missing_labs
+from perf_mode import PerfMode, record_perf_run
+from checkpoint import CheckpointManager
 
 DEBUG = True
 
@@ -108,7 +113,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -264,8 +270,10 @@ class MultimodalTransformer(nn.Module):
         return mortality_logits, los_logits, mech_logits, aggregated
 
 
-def train_step(model, dataloader, optimizer, device, criterion_mortality, criterion_los, criterion_mech):
+def train_step(model, dataloader, optimizer, device, criterion_mortality, criterion_los, criterion_mech, perf=None):
     model.train()
+    if perf is None:
+        perf = PerfMode(device)
     running_loss = 0.0
     for batch in dataloader:
         (demo_dummy_ids, demo_attn_mask,
@@ -274,19 +282,19 @@ def train_step(model, dataloader, optimizer, device, criterion_mortality, criter
          aggregated_text_embedding,
          labels_mortality, labels_los, labels_mech) = [x.to(device) for x in batch]
 
+        perf.start_step()
         optimizer.zero_grad()
-        mortality_logits, los_logits, mech_logits, _ = model(
-            demo_dummy_ids, demo_attn_mask,
-            age_ids, gender_ids, ethnicity_ids, insurance_ids,
-            lab_features, aggregated_text_embedding
-        )
-        loss_mort = criterion_mortality(mortality_logits, labels_mortality.unsqueeze(1))
-        loss_los = criterion_los(los_logits, labels_los.unsqueeze(1))
-        loss_mech = criterion_mech(mech_logits, labels_mech.unsqueeze(1))
-        loss = loss_mort + loss_los + loss_mech
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-        optimizer.step()
+        with perf.autocast():
+            mortality_logits, los_logits, mech_logits, _ = model(
+                demo_dummy_ids, demo_attn_mask,
+                age_ids, gender_ids, ethnicity_ids, insurance_ids,
+                lab_features, aggregated_text_embedding
+            )
+            loss_mort = criterion_mortality(mortality_logits, labels_mortality.unsqueeze(1))
+            loss_los = criterion_los(los_logits, labels_los.unsqueeze(1))
+            loss_mech = criterion_mech(mech_logits, labels_mech.unsqueeze(1))
+            loss = loss_mort + loss_los + loss_mech
+        perf.backward_step(loss, optimizer, model.parameters(), max_norm=1.0)
         running_loss += loss.item()
     return running_loss / len(dataloader)
 
@@ -528,6 +536,7 @@ def train_pipeline():
                            if col not in exclude_cols and not col.startswith("note_") 
                            and pd.api.types.is_numeric_dtype(df_filtered[col])]
     print("Number of lab feature columns:", len(lab_feature_columns))
+    lab_missing = df_filtered[lab_feature_columns].isna().values
     df_filtered[lab_feature_columns] = df_filtered[lab_feature_columns].fillna(0)
 
     # Normalize Lab Features.
@@ -535,6 +544,7 @@ def train_pipeline():
     lab_mean = np.mean(lab_features_np, axis=0)
     lab_std = np.std(lab_features_np, axis=0)
     lab_features_np = (lab_features_np - lab_mean) / (lab_std + 1e-6)
+    lab_features_np = mark_missing_labs(lab_features_np, lab_missing)
     
     # Split df_filtered indices into train (80%) and test (20%)
     train_val_df, test_df = train_test_split(df_filtered, test_size=0.20, random_state=42, stratify=df_filtered["short_term_mortality"])
@@ -569,9 +579,9 @@ def train_pipeline():
     val_dataset = build_dataset(val_df, aggregated_text_embeddings_np)
     test_dataset = build_dataset(test_df, aggregated_text_embeddings_np)
 
-    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=16, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=16, shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=16, shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=16, shuffle=False, device=device)
 
     NUM_AGES = df_filtered["age"].nunique()
     NUM_GENDERS = df_filtered["GENDER"].nunique()
@@ -593,7 +603,8 @@ def train_pipeline():
         num_insurances=NUM_INSURANCES,
         hidden_size=768
     ).to(device)
-    behrt_lab = BEHRTModel_Lab(
+    behrt_lab = build_lab_encoder(
+        BEHRTModel_Lab,
         lab_token_count=NUM_LAB_FEATURES,
         hidden_size=768,
         nhead=8,
@@ -607,6 +618,8 @@ def train_pipeline():
         device=device,
         hidden_size=512
     ).to(device)
+    perf = PerfMode.from_env(device)
+    multimodal_model = perf.compile(multimodal_model)
 
     optimizer = torch.optim.Adam(multimodal_model.parameters(), lr=1e-5)
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
@@ -621,12 +634,14 @@ def train_pipeline():
 
     num_epochs = 20
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
+    checkpoints = CheckpointManager(manifest={"script": "09_sigmoid"})
     patience = 5
     epochs_no_improve = 0
 
     for epoch in range(num_epochs):
         train_loss = train_step(multimodal_model, train_loader, optimizer, device,
-                                criterion_mortality, criterion_los, criterion_mech)
+                                criterion_mortality, criterion_los, criterion_mech, perf=perf)
         val_loss = validate_step(multimodal_model, val_loader, device,
                                  criterion_mortality, criterion_los, criterion_mech)
         print(f"[Epoch {epoch+1}] Train Loss: {train_loss:.4f} | Validation Loss: {val_loss:.4f}")
@@ -637,7 +652,8 @@ def train_pipeline():
             best_val_loss = val_loss
             epochs_no_improve = 0
             # Save the best model.
-            torch.save(multimodal_model.state_dict(), "best_multimodal_model.pt")
+            checkpoints.save(multimodal_model, "best_multimodal_model", metric=val_loss, step=epoch + 1)
+            best_saved = True
             print("Best model saved!")
         else:
             epochs_no_improve += 1
@@ -646,8 +662,11 @@ def train_pipeline():
                 break
 
     # Load best model for testing.
-    multimodal_model.load_state_dict(torch.load("best_multimodal_model.pt"))
+    if best_saved:
+        checkpoints.load(multimodal_model, "best_multimodal_model")
+    checkpoints.close()
     test_metrics = evaluate_model(multimodal_model, test_loader, device, threshold=0.5, print_eddi=True)
+    record_perf_run("09_sigmoid", perf, {"best_val_loss": best_val_loss, "test": test_metrics})
     print("\nFinal Evaluation on Test Set:")
     for outcome in ["mortality", "los", "mechanical_ventilation"]:
         m = test_metrics[outcome]
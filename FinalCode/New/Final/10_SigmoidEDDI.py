@@ -26,6 +26,14 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import json
 import csv
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from bootstrap_ci import bootstrap_report, print_bootstrap_report, save_bootstrap_report, BOOTSTRAP_SAMPLES
+from intersectional import intersectional_report
+from lab_encoder import build_lab_encoder, mark_missing_labs, LAB_ENCODER
+from perf_mode import PerfMode, record_perf_run
+from checkpoint import CheckpointManager, category_codes
 
 DEBUG = True
 
@@ -114,7 +122,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -370,8 +379,10 @@ def update_dynamic_weights(model, dataloader, device, old_eddi_weights, beta, th
     print(f"[Weight Update] New dynamic weights (normalized): demo={new_weight_demo:.4f}, lab={new_weight_lab:.4f}, text={new_weight_text:.4f}")
     return {"demo": new_weight_demo, "lab": new_weight_lab, "text": new_weight_text}
 
-def train_step(model, dataloader, optimizer, device, criterion, beta=1.0, lambda_edd=1.0, lambda_l1=0.01, target=1.0, threshold=0.5, old_eddi_weights=None):
+def train_step(model, dataloader, optimizer, device, criterion, beta=1.0, lambda_edd=1.0, lambda_l1=0.01, target=1.0, threshold=0.5, old_eddi_weights=None, perf=None):
     model.train()
+    if perf is None:
+        perf = PerfMode(device)
     running_loss = 0.0
     for batch in dataloader:
         (demo_dummy_ids, demo_attn_mask,
@@ -379,32 +390,32 @@ def train_step(model, dataloader, optimizer, device, criterion, beta=1.0, lambda
          lab_features, aggregated_text_embedding,
          labels) = [x.to(device) for x in batch]
 
+        perf.start_step()
         optimizer.zero_grad()
-        outputs = model(
-            demo_dummy_ids, demo_attn_mask,
-            age_ids, gender_ids, ethnicity_ids, insurance_ids,
-            lab_features, aggregated_text_embedding,
-            beta=beta, old_eddi_weights=old_eddi_weights, return_modality_logits=True
-        )
-        fused_logits = outputs["fused_logits"]
-        modality_logits = outputs["modality_logits"]
+        with perf.autocast():
+            outputs = model(
+                demo_dummy_ids, demo_attn_mask,
+                age_ids, gender_ids, ethnicity_ids, insurance_ids,
+                lab_features, aggregated_text_embedding,
+                beta=beta, old_eddi_weights=old_eddi_weights, return_modality_logits=True
+            )
+            fused_logits = outputs["fused_logits"]
+            modality_logits = outputs["modality_logits"]
 
-        bce_loss = criterion(fused_logits, labels)
+            bce_loss = criterion(fused_logits, labels)
 
-        eddi_losses = []
-        for modality in ['demo', 'lab', 'text']:
-            eddi_loss_mod = ((modality_logits[modality].squeeze() - target) ** 2).mean()
-            eddi_losses.append(eddi_loss_mod)
-        eddi_loss = torch.stack(eddi_losses).mean()
+            eddi_losses = []
+            for modality in ['demo', 'lab', 'text']:
+                eddi_loss_mod = ((modality_logits[modality].squeeze() - target) ** 2).mean()
+                eddi_losses.append(eddi_loss_mod)
+            eddi_loss = torch.stack(eddi_losses).mean()
 
-        # L1 regularization on the sigmoid gating vector.
-        l1_reg = lambda_l1 * torch.sum(torch.abs(model.sig_weights))
+            # L1 regularization on the sigmoid gating vector.
+            l1_reg = lambda_l1 * torch.sum(torch.abs(model.sig_weights))
 
-        loss = bce_loss + lambda_edd * eddi_loss + l1_reg
+            loss = bce_loss + lambda_edd * eddi_loss + l1_reg
 
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-        optimizer.step()
+        perf.backward_step(loss, optimizer, model.parameters(), max_norm=1.0)
         running_loss += loss.item()
     return running_loss
 
@@ -447,7 +458,7 @@ def calibrate_thresholds(model, dataloader, device):
         thresholds[outcome] = best_thresh
     return thresholds
 
-def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False):
+def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False, bootstrap=0, intersectional=False):
     model.eval()
     all_logits = []
     all_labels = []
@@ -508,10 +519,20 @@ def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False
                             "precision": precision_val, "fpr": fpr,
                             "optimal_threshold": thresh}
     # Return both metrics and sensitive attribute arrays.
+    if bootstrap:
+        ci_rows = bootstrap_report(all_labels.numpy(), torch.sigmoid(all_logits).numpy(),
+                                   {"age": all_age, "ethnicity": all_ethnicity, "insurance": all_insurance},
+                                   thresholds, outcome_names, n_boot=bootstrap)
+        print_bootstrap_report(ci_rows)
+        save_bootstrap_report(ci_rows)
+    if intersectional:
+        intersectional_report(all_labels.numpy(), torch.sigmoid(all_logits).numpy(),
+                              {"age": all_age, "ethnicity": all_ethnicity, "insurance": all_insurance},
+                              thresholds, outcome_names)
     return metrics, all_logits.numpy(), all_labels.numpy(), all_age, all_ethnicity, all_insurance
 
 def evaluate_model(model, dataloader, device, threshold=0.5, old_eddi_weights=None):
-    metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model_multi(model, dataloader, device, thresholds=threshold, print_eddi=True)
+    metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model_multi(model, dataloader, device, thresholds=threshold, print_eddi=True, bootstrap=BOOTSTRAP_SAMPLES, intersectional=True)
     return metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all
 
 # -----------------------------
@@ -574,12 +595,13 @@ def run_experiment(hparams):
 
     # Process demographic columns.
     demographics_cols = ["age", "GENDER", "ETHNICITY", "INSURANCE"]
+    code_tables = {}
     for col in demographics_cols:
         if col not in df_filtered.columns:
             print(f"Column {col} not found; creating default values.")
             df_filtered[col] = 0
         elif df_filtered[col].dtype == object:
-            df_filtered[col] = df_filtered[col].astype("category").cat.codes
+            df_filtered[col] = category_codes(df_filtered[col], code_tables, col.lower())
 
     exclude_cols = set(["subject_id", "ROW_ID", "hadm_id", "ICUSTAY_ID",
                         "short_term_mortality", "los_binary", "mechanical_ventilation",
@@ -588,12 +610,14 @@ def run_experiment(hparams):
                            if col not in exclude_cols and not col.startswith("note_") 
                            and pd.api.types.is_numeric_dtype(df_filtered[col])]
     print("Number of lab feature columns:", len(lab_feature_columns))
+    lab_missing = df_filtered[lab_feature_columns].isna().values
     df_filtered[lab_feature_columns] = df_filtered[lab_feature_columns].fillna(0)
 
     lab_features_np = df_filtered[lab_feature_columns].values.astype(np.float32)
     lab_mean = np.mean(lab_features_np, axis=0)
     lab_std = np.std(lab_features_np, axis=0)
     lab_features_np = (lab_features_np - lab_mean) / (lab_std + 1e-6)
+    lab_features_np = mark_missing_labs(lab_features_np, lab_missing)
 
     num_samples = len(df_filtered)
     demo_dummy_ids = torch.zeros((num_samples, 1), dtype=torch.long)
@@ -637,9 +661,9 @@ def run_experiment(hparams):
     val_dataset = create_dataset(val_idx)
     test_dataset = create_dataset(test_idx)
 
-    train_loader = DataLoader(train_dataset, batch_size=hparams['batch_size'], shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=hparams['batch_size'], shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=hparams['batch_size'], shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=hparams['batch_size'], shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=hparams['batch_size'], shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=hparams['batch_size'], shuffle=False, device=device)
 
     train_df = df_filtered.iloc[train_idx]
     pos_weight_mort = compute_class_weights(train_df, "short_term_mortality")[1]
@@ -667,7 +691,8 @@ def run_experiment(hparams):
         num_insurances=NUM_INSURANCES,
         hidden_size=768
     ).to(device)
-    behrt_lab = BEHRTModel_Lab(
+    behrt_lab = build_lab_encoder(
+        BEHRTModel_Lab,
         lab_token_count=NUM_LAB_FEATURES,
         hidden_size=768,
         nhead=8,
@@ -684,13 +709,25 @@ def run_experiment(hparams):
         fusion_hidden=512,
         beta=beta_value
     ).to(device)
+    perf = PerfMode.from_env(device)
+    multimodal_model = perf.compile(multimodal_model)
 
     optimizer = AdamW(multimodal_model.parameters(), lr=hparams['lr'], weight_decay=hparams['weight_decay'])
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
     
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
-    best_model_state = None
+    checkpoints = CheckpointManager(manifest={
+        "script": "10_SigmoidEDDI", "model": "MultimodalTransformer_EDDI_Sigmoid", "config": hparams,
+        "text_max_length": 512,
+        "architecture": {"text_embed_size": 768, "hidden_size": 768, "fusion_hidden": 512,
+                         "num_ages": NUM_AGES, "num_genders": NUM_GENDERS, "num_ethnicities": NUM_ETHNICITIES,
+                         "num_insurances": NUM_INSURANCES, "num_lab_features": NUM_LAB_FEATURES,
+                         "lab_encoder": LAB_ENCODER},
+        "code_tables": code_tables,
+        "label_columns": ["short_term_mortality", "los_binary", "mechanical_ventilation"],
+        "normalizer": {"lab_columns": lab_feature_columns, "mean": lab_mean.tolist(), "std": lab_std.tolist(), "eps": 1e-6}})
 
     old_eddi_weights = {"demo": 0.33, "lab": 0.33, "text": 0.33}
     
@@ -707,7 +744,7 @@ def run_experiment(hparams):
         train_loss = train_step(multimodal_model, train_loader, optimizer, device,
                                 criterion, beta=beta_value, lambda_edd=hparams['lambda_edd'],
                                 lambda_l1=hparams['lambda_l1'], target=1.0, threshold=hparams['threshold'],
-                                old_eddi_weights=old_eddi_weights)
+                                old_eddi_weights=old_eddi_weights, perf=perf)
         avg_train_loss = train_loss / len(train_loader)
         
         multimodal_model.eval()
@@ -734,7 +771,8 @@ def run_experiment(hparams):
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             patience_counter = 0
-            best_model_state = multimodal_model.state_dict()
+            checkpoints.save(multimodal_model, "best_model", metric=avg_val_loss, step=epoch + 1)
+            best_saved = True
             print("Validation loss improved. Saving model...")
         else:
             patience_counter += 1
@@ -759,16 +797,20 @@ def run_experiment(hparams):
     
     print("Training complete.\n")
     
-    if best_model_state is not None:
-        multimodal_model.load_state_dict(best_model_state)
+    if best_saved:
+        checkpoints.load(multimodal_model, "best_model")
 
     val_thresholds = calibrate_thresholds(multimodal_model, val_loader, device)
     print("\nOptimal thresholds from validation:")
     for outcome, thresh in val_thresholds.items():
         print(f"{outcome}: {thresh:.2f}")
+    if best_saved:
+        checkpoints.annotate("best_model", thresholds={k: float(v) for k, v in val_thresholds.items()})
+    checkpoints.close()
 
     # Evaluate model on test set and also retrieve sensitive attribute arrays.
     final_metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model(multimodal_model, test_loader, device, threshold=val_thresholds)
+    record_perf_run("10_SigmoidEDDI", perf, {"best_val_loss": best_val_loss, "test": final_metrics})
     
     print("\n--- Final Evaluation Metrics on Test Set ---")
     for outcome, m in final_metrics.items():
@@ -25,6 +25,14 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import json
 import csv
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from bootstrap_ci import bootstrap_report, print_bootstrap_report, save_bootstrap_report, BOOTSTRAP_SAMPLES
+from intersectional import intersectional_report
+from lab_encoder import build_lab_encoder, mark_missing_labs, LAB_ENCODER
+from perf_mode import PerfMode, record_perf_run
+from checkpoint import CheckpointManager, category_codes
 
 DEBUG = True
 
@@ -179,7 +187,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -477,54 +486,56 @@ def update_dynamic_weights_all_tasks(model, dataloader, device, old_eddi_weights
 
 def train_step(model, dataloader, optimizer, device, criterion, beta=1.0,
                lambda_edd=1.0, lambda_l1=0.01, target=1.0, threshold=0.5,
-               old_eddi_weights=None):
+               old_eddi_weights=None, perf=None):
     model.train()
+    if perf is None:
+        perf = PerfMode(device)
     running_loss = 0.0
     running_bce_loss = 0.0
     for batch in dataloader:
         (demo_dummy_ids, demo_attn_mask,
          age_ids, gender_ids, ethnicity_ids, insurance_ids,
          lab_features, aggregated_text_embedding, labels) = [x.to(device) for x in batch]
+        perf.start_step()
         optimizer.zero_grad()
-        outputs = model(demo_dummy_ids, demo_attn_mask,
-                        age_ids, gender_ids, ethnicity_ids, insurance_ids,
-                        lab_features, aggregated_text_embedding,
-                        beta=beta, old_eddi_weights=old_eddi_weights,
-                        return_modality_logits=True)
-        fused_logits = outputs["fused_logits"]
-        modality_logits = outputs["modality_logits"]
-
-        bce_loss = criterion(fused_logits, labels)
-        running_bce_loss += bce_loss.item()
-
-        l1_reg = lambda_l1 * torch.sum(torch.abs(model.sig_weights))
-        fused_probs = torch.sigmoid(fused_logits)
-        leddi_losses = []
-        num_outcomes = fused_probs.shape[1]
-        for i in range(num_outcomes):
-            p_i = fused_probs[:, i]
-            y_i = labels[:, i]
-            overall_err = torch.mean(torch.abs(p_i - y_i))
-            for sens_tensor in [age_ids, ethnicity_ids, insurance_ids]:
-                unique_groups = torch.unique(sens_tensor)
-                group_diffs = []
-                for group in unique_groups:
-                    mask = (sens_tensor == group)
-                    if mask.sum() > 0:
-                        subgroup_err = torch.mean(torch.abs(p_i[mask] - y_i[mask]))
-                        group_diffs.append((subgroup_err - overall_err) ** 2)
-                if group_diffs:
-                    rmse = torch.sqrt(torch.mean(torch.stack(group_diffs)) + 1e-8)
-                    leddi_losses.append(rmse)
-        if leddi_losses:
-            leddi_loss = torch.mean(torch.stack(leddi_losses))
-        else:
-            leddi_loss = 0.0
+        with perf.autocast():
+            outputs = model(demo_dummy_ids, demo_attn_mask,
+                            age_ids, gender_ids, ethnicity_ids, insurance_ids,
+                            lab_features, aggregated_text_embedding,
+                            beta=beta, old_eddi_weights=old_eddi_weights,
+                            return_modality_logits=True)
+            fused_logits = outputs["fused_logits"]
+            modality_logits = outputs["modality_logits"]
 
-        total_loss = bce_loss + lambda_edd * (10 * leddi_loss) + l1_reg
-        total_loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-        optimizer.step()
+            bce_loss = criterion(fused_logits, labels)
+            running_bce_loss += bce_loss.item()
+
+            l1_reg = lambda_l1 * torch.sum(torch.abs(model.sig_weights))
+            fused_probs = torch.sigmoid(fused_logits)
+            leddi_losses = []
+            num_outcomes = fused_probs.shape[1]
+            for i in range(num_outcomes):
+                p_i = fused_probs[:, i]
+                y_i = labels[:, i]
+                overall_err = torch.mean(torch.abs(p_i - y_i))
+                for sens_tensor in [age_ids, ethnicity_ids, insurance_ids]:
+                    unique_groups = torch.unique(sens_tensor)
+                    group_diffs = []
+                    for group in unique_groups:
+                        mask = (sens_tensor == group)
+                        if mask.sum() > 0:
+                            subgroup_err = torch.mean(torch.abs(p_i[mask] - y_i[mask]))
+                            group_diffs.append((subgroup_err - overall_err) ** 2)
+                    if group_diffs:
+                        rmse = torch.sqrt(torch.mean(torch.stack(group_diffs)) + 1e-8)
+                        leddi_losses.append(rmse)
+            if leddi_losses:
+                leddi_loss = torch.mean(torch.stack(leddi_losses))
+            else:
+                leddi_loss = 0.0
+
+            total_loss = bce_loss + lambda_edd * (10 * leddi_loss) + l1_reg
+        perf.backward_step(total_loss, optimizer, model.parameters(), max_norm=1.0)
         running_loss += total_loss.item()
     return running_loss, running_bce_loss
 
@@ -561,7 +572,7 @@ def calibrate_thresholds(model, dataloader, device):
         thresholds[outcome] = best_thresh
     return thresholds
 
-def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False):
+def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False, bootstrap=0, intersectional=False):
     model.eval()
     all_logits = []
     all_labels = []
@@ -618,10 +629,20 @@ def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False
                             "recall (TPR)": recall_val, "TPR": tpr,
                             "precision": precision_val, "fpr": fpr,
                             "optimal_threshold": thresh}
+    if bootstrap:
+        ci_rows = bootstrap_report(all_labels.numpy(), torch.sigmoid(all_logits).numpy(),
+                                   {"age": all_age, "ethnicity": all_ethnicity, "insurance": all_insurance},
+                                   thresholds, outcome_names, n_boot=bootstrap)
+        print_bootstrap_report(ci_rows)
+        save_bootstrap_report(ci_rows)
+    if intersectional:
+        intersectional_report(all_labels.numpy(), torch.sigmoid(all_logits).numpy(),
+                              {"age": all_age, "ethnicity": all_ethnicity, "insurance": all_insurance},
+                              thresholds, outcome_names)
     return metrics, all_logits.numpy(), all_labels.numpy(), all_age, all_ethnicity, all_insurance
 
 def evaluate_model(model, dataloader, device, threshold=0.5, old_eddi_weights=None):
-    metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model_multi(model, dataloader, device, thresholds=threshold, print_eddi=True)
+    metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model_multi(model, dataloader, device, thresholds=threshold, print_eddi=True, bootstrap=BOOTSTRAP_SAMPLES, intersectional=True)
     return metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all
 
 def extract_gated_vectors(model, dataloader, device, save_path="gated_vectors.npz"):
@@ -655,10 +676,12 @@ def extract_gated_vectors(model, dataloader, device, save_path="gated_vectors.np
     print("Gated vectors and associated labels saved to", save_path)
     return all_gated, all_labels, all_age, all_ethnicity, all_insurance
 
-def run_experiment(hparams):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("\nUsing device:", device)
-
+def prepare_experiment_data(device):
+    """
+    Builds everything run_experiment needs that does not depend on hyperparameters:
+    demographic codes, normalized lab features, aggregated text embeddings, labels and split indices.
+    Returns (arrays, meta) so the result can be exported once and shared by a grid search.
+    """
     structured_data = pd.read_csv("final_structured_common.csv", low_memory=False)
     unstructured_data = pd.read_csv("final_unstructured_common.csv", low_memory=False)
     print("\n--- Debug Info: Before Merge ---")
@@ -695,48 +718,42 @@ def run_experiment(hparams):
 
     df_filtered['age'] = df_filtered['age'].apply(get_age_bucket)
     # Convert age to category codes (expected: 0,1,2,3 for 15-29, 30-49, 50-69, 70-89)
-    df_filtered['age'] = df_filtered['age'].astype("category").cat.codes
+    code_tables = {}
+    df_filtered['age'] = category_codes(df_filtered['age'], code_tables, "age")
 
     if "ETHNICITY" in df_filtered.columns:
         df_filtered["ETHNICITY"] = df_filtered["ETHNICITY"].apply(map_ethnicity)
-        df_filtered["ETHNICITY"] = df_filtered["ETHNICITY"].astype("category").cat.codes
+        df_filtered["ETHNICITY"] = category_codes(df_filtered["ETHNICITY"], code_tables, "ethnicity")
     else:
         df_filtered["ETHNICITY"] = 0
 
     if "INSURANCE" in df_filtered.columns:
         df_filtered["INSURANCE"] = df_filtered["INSURANCE"].apply(map_insurance)
-        df_filtered["INSURANCE"] = df_filtered["INSURANCE"].astype("category").cat.codes
+        df_filtered["INSURANCE"] = category_codes(df_filtered["INSURANCE"], code_tables, "insurance")
     else:
         df_filtered["INSURANCE"] = 0
 
     if "GENDER" in df_filtered.columns and df_filtered["GENDER"].dtype == object:
-        df_filtered["GENDER"] = df_filtered["GENDER"].astype("category").cat.codes
+        df_filtered["GENDER"] = category_codes(df_filtered["GENDER"], code_tables, "gender")
     else:
         gender_col = "GENDERS" if "GENDERS" in df_filtered.columns else "GENDER"
-        df_filtered[gender_col] = df_filtered[gender_col].astype("category").cat.codes
+        df_filtered[gender_col] = category_codes(df_filtered[gender_col], code_tables, "gender")
 
     exclude_cols = set(["subject_id", "ROW_ID", "hadm_id", "ICUSTAY_ID",
                         "short_term_mortality", "los_binary", "mechanical_ventilation",
                         "age", "GENDER", "GENDERS", "ETHNICITY", "INSURANCE"])
     lab_feature_columns = [col for col in df_filtered.columns if col not in exclude_cols and not col.startswith("note_") and pd.api.types.is_numeric_dtype(df_filtered[col])]
     print("Number of lab feature columns:", len(lab_feature_columns))
+    lab_missing = df_filtered[lab_feature_columns].isna().values
     df_filtered[lab_feature_columns] = df_filtered[lab_feature_columns].fillna(0)
 
     lab_features_np = df_filtered[lab_feature_columns].values.astype(np.float32)
     lab_mean = np.mean(lab_features_np, axis=0)
     lab_std = np.std(lab_features_np, axis=0)
     lab_features_np = (lab_features_np - lab_mean) / (lab_std + 1e-6)
+    lab_features_np = mark_missing_labs(lab_features_np, lab_missing)
 
-    num_samples = len(df_filtered)
-    demo_dummy_ids = torch.zeros((num_samples, 1), dtype=torch.long)
-    demo_attn_mask = torch.ones((num_samples, 1), dtype=torch.long)
-    age_ids = torch.tensor(df_filtered["age"].values, dtype=torch.long)
-    gender_ids = torch.tensor(df_filtered["GENDER"].values, dtype=torch.long)
-    ethnicity_ids = torch.tensor(df_filtered["ETHNICITY"].values, dtype=torch.long)
-    insurance_ids = torch.tensor(df_filtered["INSURANCE"].values, dtype=torch.long)
-    lab_features_t = torch.tensor(lab_features_np, dtype=torch.float32)
     labels_np = df_filtered[["short_term_mortality", "los_binary", "mechanical_ventilation"]].values.astype(np.float32)
-    labels = torch.tensor(labels_np, dtype=torch.float32)
 
     print("Computing aggregated text embeddings for each patient...")
     tokenizer = AutoTokenizer.from_pretrained("emilyalsentzer/Bio_ClinicalBERT")
@@ -744,7 +761,6 @@ def run_experiment(hparams):
     bioclinical_bert_ft = BioClinicalBERT_FT(bioclinical_bert_base, bioclinical_bert_base.config, device).to(device)
     aggregated_text_embeddings_np = apply_bioclinicalbert_on_patient_notes(df_filtered, note_columns, tokenizer, bioclinical_bert_ft, device, aggregation="mean")
     print("Aggregated text embeddings shape:", aggregated_text_embeddings_np.shape)
-    aggregated_text_embeddings_t = torch.tensor(aggregated_text_embeddings_np, dtype=torch.float32)
 
     msss = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=0.20, random_state=42)
     labels_multilabel = df_filtered[['short_term_mortality', 'los_binary', 'mechanical_ventilation']].values
@@ -756,42 +772,79 @@ def run_experiment(hparams):
         train_df = train_val_df.iloc[train_idx]
         val_df = train_val_df.iloc[val_idx]
     print(f"Train size: {len(train_df)}, Validation size: {len(val_df)}, Test size: {len(test_df)}")
-    
+
+    train_df = df_filtered.iloc[train_idx]
+    arrays = {
+        "age_ids": df_filtered["age"].values.astype(np.int64),
+        "gender_ids": df_filtered["GENDER"].values.astype(np.int64),
+        "ethnicity_ids": df_filtered["ETHNICITY"].values.astype(np.int64),
+        "insurance_ids": df_filtered["INSURANCE"].values.astype(np.int64),
+        "lab_features": lab_features_np,
+        "text_embeddings": aggregated_text_embeddings_np.astype(np.float32),
+        "labels": labels_np,
+        "train_idx": np.asarray(train_idx, dtype=np.int64),
+        "val_idx": np.asarray(val_idx, dtype=np.int64),
+        "test_idx": np.asarray(test_idx, dtype=np.int64),
+    }
+    meta = {
+        "num_ages": int(df_filtered["age"].nunique()),
+        "num_genders": int(df_filtered["GENDERS"].nunique() if "GENDERS" in df_filtered.columns else df_filtered["GENDER"].nunique()),
+        "num_ethnicities": int(df_filtered["ETHNICITY"].nunique()),
+        "num_insurances": int(df_filtered["INSURANCE"].nunique()),
+        "num_lab_features": len(lab_feature_columns),
+        "pos_weight": [float(compute_class_weights(train_df, col)[1])
+                       for col in ["short_term_mortality", "los_binary", "mechanical_ventilation"]],
+        "code_tables": code_tables,
+        "label_columns": ["short_term_mortality", "los_binary", "mechanical_ventilation"],
+        "normalizer": {"lab_columns": lab_feature_columns, "mean": lab_mean.tolist(), "std": lab_std.tolist(), "eps": 1e-6},
+    }
+    return arrays, meta
+
+def run_experiment(hparams, arrays=None, meta=None):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("\nUsing device:", device)
+    if arrays is None:
+        arrays, meta = prepare_experiment_data(device)
+    train_idx, val_idx, test_idx = arrays["train_idx"], arrays["val_idx"], arrays["test_idx"]
+
     def create_dataset(indices):
-        return TensorDataset(demo_dummy_ids[indices], demo_attn_mask[indices],
-                             age_ids[indices], gender_ids[indices], ethnicity_ids[indices], insurance_ids[indices],
-                             lab_features_t[indices], aggregated_text_embeddings_t[indices], labels[indices])
+        # Index the (possibly memmapped) arrays first so only the subset is materialized.
+        n = len(indices)
+        return TensorDataset(torch.zeros((n, 1), dtype=torch.long), torch.ones((n, 1), dtype=torch.long),
+                             torch.tensor(arrays["age_ids"][indices], dtype=torch.long),
+                             torch.tensor(arrays["gender_ids"][indices], dtype=torch.long),
+                             torch.tensor(arrays["ethnicity_ids"][indices], dtype=torch.long),
+                             torch.tensor(arrays["insurance_ids"][indices], dtype=torch.long),
+                             torch.tensor(arrays["lab_features"][indices], dtype=torch.float32),
+                             torch.tensor(arrays["text_embeddings"][indices], dtype=torch.float32),
+                             torch.tensor(arrays["labels"][indices], dtype=torch.float32))
     train_dataset = create_dataset(train_idx)
     val_dataset = create_dataset(val_idx)
     test_dataset = create_dataset(test_idx)
-    train_loader = DataLoader(train_dataset, batch_size=hparams['batch_size'], shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=hparams['batch_size'], shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=hparams['batch_size'], shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=hparams['batch_size'], shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=hparams['batch_size'], shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=hparams['batch_size'], shuffle=False, device=device)
 
-    train_df = df_filtered.iloc[train_idx]
-    pos_weight_mort = compute_class_weights(train_df, "short_term_mortality")[1]
-    pos_weight_los = compute_class_weights(train_df, "los_binary")[1]
-    pos_weight_mech = compute_class_weights(train_df, "mechanical_ventilation")[1]
-    pos_weight = torch.tensor([pos_weight_mort, pos_weight_los, pos_weight_mech], dtype=torch.float32, device=device)
+    pos_weight = torch.tensor(meta["pos_weight"], dtype=torch.float32, device=device)
     criterion = nn.BCEWithLogitsLoss(pos_weight=pos_weight)
 
-    NUM_AGES = df_filtered["age"].nunique()   
-    NUM_GENDERS = df_filtered["GENDERS"].nunique() if "GENDERS" in df_filtered.columns else df_filtered["GENDER"].nunique()
-    NUM_ETHNICITIES = df_filtered["ETHNICITY"].nunique()  
-    NUM_INSURANCES = df_filtered["INSURANCE"].nunique()    
+    NUM_AGES = meta["num_ages"]
+    NUM_GENDERS = meta["num_genders"]
+    NUM_ETHNICITIES = meta["num_ethnicities"]
+    NUM_INSURANCES = meta["num_insurances"]
     print("\n--- Demographics Hyperparameters ---")
     print("NUM_AGES:", NUM_AGES)
     print("NUM_GENDERS:", NUM_GENDERS)
     print("NUM_ETHNICITIES:", NUM_ETHNICITIES)
     print("NUM_INSURANCES:", NUM_INSURANCES)
-    NUM_LAB_FEATURES = len(lab_feature_columns)
+    NUM_LAB_FEATURES = meta["num_lab_features"]
     print("NUM_LAB_FEATURES (tokens):", NUM_LAB_FEATURES)
 
     behrt_demo = BEHRTModel_Demo(num_ages=NUM_AGES, num_genders=NUM_GENDERS,
                                  num_ethnicities=NUM_ETHNICITIES, num_insurances=NUM_INSURANCES,
                                  hidden_size=768).to(device)
-    behrt_lab = BEHRTModel_Lab(lab_token_count=NUM_LAB_FEATURES, hidden_size=768,
-                               nhead=8, num_layers=2).to(device)
+    behrt_lab = build_lab_encoder(BEHRTModel_Lab, lab_token_count=NUM_LAB_FEATURES, hidden_size=768,
+                                  nhead=8, num_layers=2).to(device)
     beta_value = hparams['beta']
     multimodal_model = MultimodalTransformer_EDDI_Sigmoid(text_embed_size=768,
                                                           behrt_demo=behrt_demo,
@@ -799,12 +852,25 @@ def run_experiment(hparams):
                                                           device=device,
                                                           fusion_hidden=512,
                                                           beta=beta_value).to(device)
+    perf = PerfMode.from_env(device)
+    multimodal_model = perf.compile(multimodal_model)
     optimizer = AdamW(multimodal_model.parameters(), lr=hparams['lr'], weight_decay=hparams['weight_decay'])
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
 
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
-    best_model_state = None
+    checkpoints = CheckpointManager(manifest={
+        "script": "FAME", "model": "MultimodalTransformer_EDDI_Sigmoid", "config": hparams,
+        "text_max_length": 512,
+        "architecture": {"text_embed_size": 768, "hidden_size": 768, "fusion_hidden": 512,
+                         "num_ages": NUM_AGES, "num_genders": NUM_GENDERS, "num_ethnicities": NUM_ETHNICITIES,
+                         "num_insurances": NUM_INSURANCES, "num_lab_features": NUM_LAB_FEATURES,
+                         "lab_encoder": LAB_ENCODER},
+        # Raw age / ethnicity / insurance go through FAME.py's get_age_bucket / map_* before the code tables.
+        "demographic_mapping": "FAME",
+        "code_tables": meta.get("code_tables", {}), "label_columns": meta.get("label_columns"),
+        "normalizer": meta.get("normalizer")})
     # Initialize dynamic weights.
     old_eddi_weights = {
         "mortality": {"demo": 0.33, "lab": 0.33, "text": 0.33},
@@ -824,7 +890,7 @@ def run_experiment(hparams):
         train_loss, bce_loss = train_step(multimodal_model, train_loader, optimizer, device,
                                           criterion, beta=beta_value, lambda_edd=hparams['lambda_edd'],
                                           lambda_l1=hparams['lambda_l1'], target=1.0, threshold=hparams['threshold'],
-                                          old_eddi_weights=old_eddi_weights)
+                                          old_eddi_weights=old_eddi_weights, perf=perf)
         avg_train_loss = train_loss / len(train_loader)
         avg_bce_loss = bce_loss / len(train_loader)
         multimodal_model.eval()
@@ -847,7 +913,8 @@ def run_experiment(hparams):
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             patience_counter = 0
-            best_model_state = multimodal_model.state_dict()
+            checkpoints.save(multimodal_model, "best_model", metric=avg_val_loss, step=epoch + 1)
+            best_saved = True
             print("Validation loss improved. Saving model...")
         else:
             patience_counter += 1
@@ -873,13 +940,17 @@ def run_experiment(hparams):
         tracked_sigmoid_weights.append(torch.sigmoid(multimodal_model.sig_weights).detach().cpu().numpy())
 
     print("Training complete.\n")
-    if best_model_state is not None:
-        multimodal_model.load_state_dict(best_model_state)
+    if best_saved:
+        checkpoints.load(multimodal_model, "best_model")
     val_thresholds = calibrate_thresholds(multimodal_model, val_loader, device)
     print("\nOptimal thresholds from validation:")
     for outcome, thresh in val_thresholds.items():
         print(f"{outcome}: {thresh:.2f}")
+    if best_saved:
+        checkpoints.annotate("best_model", thresholds={k: float(v) for k, v in val_thresholds.items()})
+    checkpoints.close()
     final_metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model(multimodal_model, test_loader, device, threshold=val_thresholds)
+    record_perf_run("FAME", perf, {"best_val_loss": best_val_loss, "test": final_metrics})
     print("\n--- Final Evaluation Metrics on Test Set ---")
     for outcome, m in final_metrics.items():
         print(f"\nOutcome: {outcome}")
@@ -900,6 +971,7 @@ def run_experiment(hparams):
     outcome_names = ["mortality", "los", "mechanical_ventilation"]
     print("\n--- Sensitive Subgroup EDDI Statistics ---")
     combined_eddi = {}
+    attribute_eddi = {}
     for i, outcome in enumerate(outcome_names):
         probs = torch.sigmoid(torch.tensor(logits_all))[:, i].numpy().squeeze()
         true_vals = labels_all[:, i]
@@ -911,6 +983,7 @@ def run_experiment(hparams):
         overall_combined = np.sqrt(eddi_age**2 + eddi_ethnicity**2 + eddi_insurance**2) / 3.0
 
         combined_eddi[outcome] = overall_combined
+        attribute_eddi[outcome] = {"eddi_age": eddi_age, "eddi_ethnicity": eddi_ethnicity, "eddi_insurance": eddi_insurance}
         print(" Age EDDI:")
         print("  Overall:", eddi_age)
         print("  Subgroups:", subgroup_age)
@@ -964,12 +1037,63 @@ def run_experiment(hparams):
     # Save tracked weights.
     np.save("tracked_dynamic_weights.npy", tracked_dynamic_weights)
     np.save("tracked_sigmoid_weights.npy", np.array(tracked_sigmoid_weights))
-    
+    for outcome in outcome_names:
+        final_metrics[outcome]["combined_eddi"] = combined_eddi[outcome]
+        final_metrics[outcome].update(attribute_eddi[outcome])
+    return final_metrics
+
+def grid_experiment(hparams, arrays, meta):
+    """Entry point for grid_search.run_grid: one configuration -> one flat row of test metrics."""
+    final_metrics = run_experiment(hparams, arrays, meta)
+    row = {}
+    for outcome, m in final_metrics.items():
+        for name in ["aucroc", "auprc", "f1", "combined_eddi", "eddi_age", "eddi_ethnicity", "eddi_insurance"]:
+            row[f"{outcome}_{name}"] = float(m[name])
+    return row
+
+def cv_experiment(config, arrays, meta):
+    """Entry point for cross_validation.run_cv: trains on fold config['fold'] of the shared CV inputs."""
+    from cross_validation import fold_arrays, fold_pos_weight
+    hparams = dict(config)
+    fold = hparams.pop("fold")
+    arrays = fold_arrays(arrays, fold)
+    meta = dict(meta, pos_weight=fold_pos_weight(arrays["labels"], arrays["train_idx"]))
+    return grid_experiment(hparams, arrays, meta)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parallel", action="store_true",
+                        help="Run the grid on a process pool over data prepared once in --shared_dir.")
+    parser.add_argument("--shared_dir", default="fame_shared_inputs")
+    parser.add_argument("--results", default="fame_grid_results.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--cv", type=int, default=0,
+                        help="Run K-fold cross-validation (K > 1) over inputs prepared once in --shared_dir.")
+    args = parser.parse_args()
+
     hyperparameter_grid = [
         {'lr': 1e-5, 'num_epochs': 50, 'lambda_edd': 1.0, 'lambda_l1': 0.01,
          'batch_size': 16, 'threshold': 0.50, 'weight_decay': 0.01, 'beta': 1.0},
     ]
+    if args.cv > 1:
+        from cross_validation import prepare_cv_inputs, run_cv
+        shared_dir = args.shared_dir + f"_cv{args.cv}"
+        prepare_cv_inputs(lambda: prepare_experiment_data(torch.device("cuda" if torch.cuda.is_available() else "cpu")),
+                          shared_dir, n_folds=args.cv)
+        run_cv(os.path.abspath(__file__), "cv_experiment", hyperparameter_grid, shared_dir, n_folds=args.cv,
+               results_csv=f"fame_cv{args.cv}_results.csv", summary_csv=f"fame_cv{args.cv}_summary.csv",
+               n_workers=args.workers, threads_per_worker=args.threads_per_worker)
+        sys.exit(0)
+    if args.parallel:
+        from grid_search import run_grid, export_shared_arrays, shared_arrays_exist
+        if not shared_arrays_exist(args.shared_dir):
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            arrays, meta = prepare_experiment_data(device)
+            export_shared_arrays(arrays, args.shared_dir, meta)
+        run_grid(os.path.abspath(__file__), "grid_experiment", hyperparameter_grid, args.shared_dir,
+                 results_csv=args.results, n_workers=args.workers, threads_per_worker=args.threads_per_worker)
+        sys.exit(0)
     results = {}
     for idx, hparams in enumerate(hyperparameter_grid):
         print("\n==============================")
@@ -28,6 +28,13 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import json
 import csv
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from text_encoder import prepare_text_encoder, TEXT_ENCODER_BACKEND
+from batch_loader import BatchLoader
+from bootstrap_ci import bootstrap_report, print_bootstrap_report, save_bootstrap_report, BOOTSTRAP_SAMPLES
+from intersectional import intersectional_report
+from checkpoint import CheckpointManager, category_codes
+from lab_encoder import build_lab_encoder, mark_missing_labs, LAB_ENCODER
 
 DEBUG = True
 
@@ -158,7 +165,8 @@ class BioClinicalBERT_FT(nn.Module):
         cls_embedding = outputs.last_hidden_state[:, 0, :]
         return cls_embedding
 
-def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean"):
+def apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device, aggregation="mean", backend=TEXT_ENCODER_BACKEND):
+    model, device = prepare_text_encoder(model, backend, device)
     patient_ids = df["subject_id"].unique()
     aggregated_embeddings = []
     for pid in tqdm(patient_ids, desc="Aggregating text embeddings"):
@@ -520,7 +528,7 @@ def calibrate_thresholds(model, dataloader, device):
         thresholds[outcome] = best_thresh
     return thresholds
 
-def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False):
+def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False, bootstrap=0, intersectional=False):
     """
     Evaluate the model on multiple outcomes and compute fairness metrics.
     For each outcome, subgroup fairness metrics (TPR, FPR) are computed per sensitive attribute
@@ -589,11 +597,22 @@ def evaluate_model_multi(model, dataloader, device, thresholds, print_eddi=False
             print_fairness_metrics(labels_np, preds, dem_values, sensitive_attr_name=attr_name)
             avg_tpr_diff, avg_fpr_diff = print_fairness_metrics(labels_np, preds, dem_values, sensitive_attr_name=attr_name)
             fairness_details[outcome][attr_name] = {"avg_tpr_diff": avg_tpr_diff, "avg_fpr_diff": avg_fpr_diff}
+    if bootstrap:
+        ci_rows = bootstrap_report(all_labels.numpy(), torch.sigmoid(all_logits).numpy(),
+                                   {"age": all_age, "ethnicity": all_ethnicity, "insurance": all_insurance},
+                                   thresholds, outcome_names, n_boot=bootstrap)
+        print_bootstrap_report(ci_rows)
+        save_bootstrap_report(ci_rows)
+    if intersectional:
+        intersectional_report(all_labels.numpy(), torch.sigmoid(all_logits).numpy(),
+                              {"age": all_age, "ethnicity": all_ethnicity, "insurance": all_insurance},
+                              thresholds, outcome_names)
     return metrics, all_logits.numpy(), all_labels.numpy(), all_age, all_ethnicity, all_insurance
 
 def evaluate_model(model, dataloader, device, threshold=0.5, old_eddi_weights=None):
     metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model_multi(
-        model, dataloader, device, thresholds=threshold, print_eddi=True)
+        model, dataloader, device, thresholds=threshold, print_eddi=True, bootstrap=BOOTSTRAP_SAMPLES,
+        intersectional=True)
     return metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all
 
 
@@ -702,7 +721,8 @@ def run_experiment(hparams):
         else:
             return "Other"
     df_filtered['age'] = df_filtered['age'].apply(get_age_bucket)
-    df_filtered['age'] = df_filtered['age'].astype("category").cat.codes
+    code_tables = {}
+    df_filtered['age'] = category_codes(df_filtered['age'], code_tables, "age")
 
     def map_ethnicity(e):
         try:
@@ -715,7 +735,7 @@ def run_experiment(hparams):
             return mapping.get(e, "Other")
     if "ETHNICITY" in df_filtered.columns:
         df_filtered["ETHNICITY"] = df_filtered["ETHNICITY"].apply(map_ethnicity)
-        df_filtered["ETHNICITY"] = df_filtered["ETHNICITY"].astype("category").cat.codes
+        df_filtered["ETHNICITY"] = category_codes(df_filtered["ETHNICITY"], code_tables, "ethnicity")
     else:
         df_filtered["ETHNICITY"] = 0
 
@@ -731,15 +751,15 @@ def run_experiment(hparams):
             return mapping.get(i, "Other")
     if "INSURANCE" in df_filtered.columns:
         df_filtered["INSURANCE"] = df_filtered["INSURANCE"].apply(map_insurance)
-        df_filtered["INSURANCE"] = df_filtered["INSURANCE"].astype("category").cat.codes
+        df_filtered["INSURANCE"] = category_codes(df_filtered["INSURANCE"], code_tables, "insurance")
     else:
         df_filtered["INSURANCE"] = 0
 
     if "GENDER" in df_filtered.columns and df_filtered["GENDER"].dtype == object:
-        df_filtered["GENDER"] = df_filtered["GENDER"].astype("category").cat.codes
+        df_filtered["GENDER"] = category_codes(df_filtered["GENDER"], code_tables, "gender")
     else:
         gender_col = "GENDERS" if "GENDERS" in df_filtered.columns else "GENDER"
-        df_filtered[gender_col] = df_filtered[gender_col].astype("category").cat.codes
+        df_filtered[gender_col] = category_codes(df_filtered[gender_col], code_tables, "gender")
 
     # Identify lab feature columns.
     exclude_cols = set(["subject_id", "ROW_ID", "hadm_id", "ICUSTAY_ID",
@@ -749,12 +769,14 @@ def run_experiment(hparams):
                            and not col.startswith("note_")
                            and pd.api.types.is_numeric_dtype(df_filtered[col])]
     print("Number of lab feature columns:", len(lab_feature_columns))
+    lab_missing = df_filtered[lab_feature_columns].isna().values
     df_filtered[lab_feature_columns] = df_filtered[lab_feature_columns].fillna(0)
 
     lab_features_np = df_filtered[lab_feature_columns].values.astype(np.float32)
     lab_mean = np.mean(lab_features_np, axis=0)
     lab_std = np.std(lab_features_np, axis=0)
     lab_features_np = (lab_features_np - lab_mean) / (lab_std + 1e-6)
+    lab_features_np = mark_missing_labs(lab_features_np, lab_missing)
 
     num_samples = len(df_filtered)
     demo_dummy_ids = torch.zeros((num_samples, 1), dtype=torch.long)
@@ -793,9 +815,9 @@ def run_experiment(hparams):
     train_dataset = create_dataset(train_idx)
     val_dataset = create_dataset(val_idx)
     test_dataset = create_dataset(test_idx)
-    train_loader = DataLoader(train_dataset, batch_size=hparams['batch_size'], shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=hparams['batch_size'], shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=hparams['batch_size'], shuffle=False)
+    train_loader = BatchLoader(train_dataset, batch_size=hparams['batch_size'], shuffle=True, device=device)
+    val_loader = BatchLoader(val_dataset, batch_size=hparams['batch_size'], shuffle=False, device=device)
+    test_loader = BatchLoader(test_dataset, batch_size=hparams['batch_size'], shuffle=False, device=device)
 
     train_df = df_filtered.iloc[train_idx]
     pos_weight_mort = compute_class_weights(train_df, "short_term_mortality")[1]
@@ -819,8 +841,8 @@ def run_experiment(hparams):
     behrt_demo = BEHRTModel_Demo(num_ages=NUM_AGES, num_genders=NUM_GENDERS,
                                  num_ethnicities=NUM_ETHNICITIES, num_insurances=NUM_INSURANCES,
                                  hidden_size=768).to(device)
-    behrt_lab = BEHRTModel_Lab(lab_token_count=NUM_LAB_FEATURES, hidden_size=768,
-                               nhead=8, num_layers=2).to(device)
+    behrt_lab = build_lab_encoder(BEHRTModel_Lab, lab_token_count=NUM_LAB_FEATURES, hidden_size=768,
+                                  nhead=8, num_layers=2).to(device)
     beta_value = hparams['beta']
     multimodal_model = MultimodalTransformer_EDDI_Sigmoid(text_embed_size=768,
                                                           behrt_demo=behrt_demo,
@@ -832,8 +854,22 @@ def run_experiment(hparams):
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=2, verbose=True)
     
     best_val_loss = float('inf')
+    best_saved = False  # checkpoints/ may hold a best model of an earlier run
     patience_counter = 0
-    best_model_state = None
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    best_model_name = f"best_model_{timestamp}"
+    checkpoints = CheckpointManager(manifest={
+        "script": "Updat_Fame", "model": "MultimodalTransformer_EDDI_Sigmoid", "config": hparams,
+        "text_max_length": 512,
+        "architecture": {"text_embed_size": 768, "hidden_size": 768, "fusion_hidden": 512,
+                         "num_ages": NUM_AGES, "num_genders": NUM_GENDERS, "num_ethnicities": NUM_ETHNICITIES,
+                         "num_insurances": NUM_INSURANCES, "num_lab_features": NUM_LAB_FEATURES,
+                         "lab_encoder": LAB_ENCODER},
+        # Raw age / ethnicity / insurance go through FAME.py's get_age_bucket / map_* before the code tables.
+        "demographic_mapping": "FAME",
+        "code_tables": code_tables,
+        "label_columns": ["short_term_mortality", "los_binary", "mechanical_ventilation"],
+        "normalizer": {"lab_columns": lab_feature_columns, "mean": lab_mean.tolist(), "std": lab_std.tolist(), "eps": 1e-6}})
     old_eddi_weights = {
         "mortality": {"demo": 0.33, "lab": 0.33, "text": 0.33},
         "los": {"demo": 0.33, "lab": 0.33, "text": 0.33},
@@ -875,7 +911,8 @@ def run_experiment(hparams):
         if avg_val_loss < best_val_loss:
             best_val_loss = avg_val_loss
             patience_counter = 0
-            best_model_state = multimodal_model.state_dict()
+            checkpoints.save(multimodal_model, best_model_name, metric=avg_val_loss, step=epoch + 1)
+            best_saved = True
             print("Validation loss improved. Saving model...")
         else:
             patience_counter += 1
@@ -901,12 +938,9 @@ def run_experiment(hparams):
         tracked_sigmoid_weights.append(torch.sigmoid(multimodal_model.sig_weights).detach().cpu().numpy())
     
     print("Training complete.\n")
-    if best_model_state is not None:
-        multimodal_model.load_state_dict(best_model_state)
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        best_model_filename = f"best_model_{timestamp}.pt"
-        torch.save(best_model_state, best_model_filename)
-        print("Saved best model to", best_model_filename)
+    if best_saved:
+        checkpoints.load(multimodal_model, best_model_name)
+        print("Saved best model to", checkpoints.path(best_model_name) + ".safetensors")
         extracted_save_path = f"extracted_vectors_{timestamp}.npz"
         extract_and_save_vectors(multimodal_model, test_loader, device, save_path=extracted_save_path)
         
@@ -914,6 +948,9 @@ def run_experiment(hparams):
     print("\nOptimal thresholds from validation:")
     for outcome, thresh in val_thresholds.items():
         print(f"{outcome}: {thresh:.2f}")
+    if best_saved:
+        checkpoints.annotate(best_model_name, thresholds={k: float(v) for k, v in val_thresholds.items()})
+    checkpoints.close()
     final_metrics, logits_all, labels_all, age_all, ethnicity_all, insurance_all = evaluate_model(
         multimodal_model, test_loader, device, threshold=val_thresholds)
     print("\n--- Final Evaluation Metrics on Test Set ---")
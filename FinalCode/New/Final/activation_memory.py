@@ -0,0 +1,130 @@
+import os
+import sys
+import math
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # FinalCode/New: benchmark.py
+from benchmark import MemorySampler
+
+# Activation-memory management for end-to-end fine-tuning of the text encoders
+# (NotesEncoder / roberta-large in 06_FairEHR-CLP.py, BERT inside the fusion models).
+# Selected with environment variables:
+#   ACTIVATION_MEMORY  - off (default) | checkpoint: HF gradient checkpointing on every transformers model
+#                        inside the trained module (activations of each layer are recomputed in backward)
+#   TARGET_BATCH_SIZE  - effective batch size; gradients of ceil(target / loader batch) micro-batches are
+#                        accumulated before each optimizer step (0 = one step per batch, unchanged behaviour)
+# Peak memory (CUDA max allocated, or RSS sampled every 10 ms on CPU) is recorded per optimizer step and
+# summarised by report().
+ACTIVATION_MEMORY = os.environ.get("ACTIVATION_MEMORY", "off")
+TARGET_BATCH_SIZE = int(os.environ.get("TARGET_BATCH_SIZE", "0"))
+
+def enable_gradient_checkpointing(model):
+    """Turns on gradient checkpointing for every transformers model inside `model`; returns how many."""
+    enabled = 0
+    for module in model.modules():
+        if getattr(module, "supports_gradient_checkpointing", False) and hasattr(module, "gradient_checkpointing_enable"):
+            try:
+                # Non-reentrant checkpointing also works when the inputs do not require grad.
+                module.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+            except TypeError:
+                module.gradient_checkpointing_enable()
+            if hasattr(module.config, "use_cache"):
+                module.config.use_cache = False
+            enabled += 1
+    return enabled
+
+def accumulation_steps(target_batch_size, micro_batch_size):
+    if not target_batch_size or target_batch_size <= micro_batch_size:
+        return 1
+    return int(math.ceil(target_batch_size / float(micro_batch_size)))
+
+class ActivationMemory(object):
+    def __init__(self, device, checkpointing=False, target_batch_size=0, micro_batch_size=16, log_every=50):
+        self.device = device
+        self.checkpointing = checkpointing
+        self.micro_batch_size = micro_batch_size
+        self.accumulation_steps = accumulation_steps(target_batch_size, micro_batch_size)
+        self.log_every = log_every
+        self.step_peaks_mb = []
+        self._micro_steps = 0
+        self._rss = MemorySampler().start() if device.type != "cuda" else None
+
+    @classmethod
+    def from_env(cls, device, micro_batch_size):
+        if ACTIVATION_MEMORY not in ("off", "checkpoint"):
+            raise ValueError(f"Unknown ACTIVATION_MEMORY: {ACTIVATION_MEMORY}")
+        memory = cls(device, checkpointing=ACTIVATION_MEMORY == "checkpoint",
+                     target_batch_size=TARGET_BATCH_SIZE, micro_batch_size=micro_batch_size)
+        if memory.checkpointing or memory.accumulation_steps > 1:
+            print(f"Activation memory: checkpointing={'on' if memory.checkpointing else 'off'}, "
+                  f"micro-batch {micro_batch_size} x {memory.accumulation_steps} accumulation steps "
+                  f"= effective batch {memory.effective_batch_size}")
+        return memory
+
+    @property
+    def effective_batch_size(self):
+        return self.micro_batch_size * self.accumulation_steps
+
+    def prepare(self, model):
+        if self.checkpointing:
+            print(f"Gradient checkpointing enabled on {enable_gradient_checkpointing(model)} transformer model(s).")
+        self._reset_peak()
+        return model
+
+    def _reset_peak(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._rss.reset()
+
+    def _peak_mb(self):
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        return self._rss.peak()
+
+    def backward_step(self, loss, optimizer, parameters=None, max_norm=None):
+        """
+        Backward of loss / accumulation_steps; every accumulation_steps micro-batches the gradients are
+        (optionally) clipped, the optimizer steps and the gradients are cleared. Returns True on a step.
+        """
+        (loss / self.accumulation_steps).backward()
+        self._micro_steps += 1
+        if self._micro_steps % self.accumulation_steps != 0:
+            return False
+        return self._step(optimizer, parameters, max_norm)
+
+    def flush(self, optimizer, parameters=None, max_norm=None):
+        """Steps on gradients left over from an epoch that did not end on an accumulation boundary."""
+        if self._micro_steps % self.accumulation_steps == 0:
+            return False
+        self._micro_steps = 0
+        return self._step(optimizer, parameters, max_norm)
+
+    def _step(self, optimizer, parameters, max_norm):
+        if max_norm is not None:
+            torch.nn.utils.clip_grad_norm_(parameters, max_norm=max_norm)
+        optimizer.step()
+        optimizer.zero_grad()
+        self.step_peaks_mb.append(self._peak_mb())
+        if self.log_every and len(self.step_peaks_mb) % self.log_every == 0:
+            print(f"  step {len(self.step_peaks_mb)}: peak memory {self.step_peaks_mb[-1]:.0f} MB")
+        self._reset_peak()
+        return True
+
+    def report(self):
+        if not self.step_peaks_mb:
+            return {}
+        peaks = np.asarray(self.step_peaks_mb)
+        summary = {"checkpointing": self.checkpointing, "micro_batch_size": self.micro_batch_size,
+                   "accumulation_steps": self.accumulation_steps, "effective_batch_size": self.effective_batch_size,
+                   "steps": len(peaks), "peak_mb_max": float(peaks.max()), "peak_mb_median": float(np.median(peaks))}
+        kind = "CUDA allocated" if self.device.type == "cuda" else "RSS"
+        print(f"Peak memory per optimizer step ({kind}): max {summary['peak_mb_max']:.0f} MB, "
+              f"median {summary['peak_mb_median']:.0f} MB over {summary['steps']} steps "
+              f"(effective batch {self.effective_batch_size})")
+        return summary
+
+    def close(self):
+        if self._rss is not None:
+            self._rss.close()
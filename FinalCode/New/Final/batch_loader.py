@@ -0,0 +1,128 @@
+import queue
+import threading
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset, Subset, BatchSampler, RandomSampler, SequentialSampler
+
+# Columnar replacement for DataLoader(TensorDataset / Subset(TensorDataset)) in the training scripts.
+# The default DataLoader fetches every sample separately (dataset[i] -> tuple of 0-d / 1-d tensors) and
+# collates them again with torch.stack, so each batch pays per-row Python overhead. BatchLoader keeps one
+# contiguous tensor per column and builds a whole batch with a single index_select per column.
+# Batches are assembled (and pinned) in a background thread, then copied to the device with non_blocking=True,
+# so `[x.to(device) for x in batch]` in the training loops becomes a no-op.
+
+class ColumnarDataset(object):
+    """
+    A set of equally long columns (torch tensors or numpy arrays, including np.memmap).
+    numpy columns are only converted for the rows of each batch, so memmaps stay on disk.
+    """
+    def __init__(self, *columns):
+        lengths = set(len(c) for c in columns)
+        if len(lengths) != 1:
+            raise ValueError(f"All columns must have the same length, got {sorted(lengths)}")
+        self.columns = [c.contiguous() if torch.is_tensor(c) else c for c in columns]
+        self.indices = None
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """TensorDataset, Subset(TensorDataset) or ColumnarDataset -> ColumnarDataset."""
+        if isinstance(dataset, cls):
+            return dataset
+        if isinstance(dataset, TensorDataset):
+            return cls(*dataset.tensors)
+        if isinstance(dataset, Subset):
+            return cls.from_dataset(dataset.dataset).subset(dataset.indices)
+        raise TypeError(f"Cannot build a columnar dataset from {type(dataset).__name__}")
+
+    def subset(self, indices):
+        """Row subset, materialized once as contiguous columns. Keeps .indices like torch's Subset."""
+        indices = np.asarray(indices, dtype=np.int64)
+        sub = ColumnarDataset(*[self._take(c, indices) for c in self.columns])
+        sub.indices = indices if self.indices is None else self.indices[indices]
+        return sub
+
+    @staticmethod
+    def _take(column, indices):
+        if torch.is_tensor(column):
+            return column.index_select(0, torch.as_tensor(indices, dtype=torch.long))
+        return torch.from_numpy(np.ascontiguousarray(column[indices]))
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, idx):
+        return tuple(c[idx] for c in self.columns)
+
+    def get_batch(self, indices):
+        return tuple(self._take(c, indices) for c in self.columns)
+
+class BatchLoader(object):
+    """
+    DataLoader-compatible iterator (len(), .dataset, `for batch in loader`) over a ColumnarDataset.
+    A sampler (e.g. WeightedRandomSampler) replaces shuffle, as in DataLoader.
+    """
+    def __init__(self, dataset, batch_size=16, shuffle=False, sampler=None, drop_last=False,
+                 device=None, pin_memory=None, prefetch=2):
+        self.dataset = ColumnarDataset.from_dataset(dataset)
+        if sampler is None:
+            sampler = RandomSampler(range(len(self.dataset))) if shuffle else SequentialSampler(range(len(self.dataset)))
+        self.batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.batch_size = batch_size
+        self.device = device
+        if pin_memory is None:
+            pin_memory = device is not None and torch.device(device).type == "cuda"
+        self.pin_memory = pin_memory
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _make_batch(self, indices):
+        batch = self.dataset.get_batch(np.asarray(indices, dtype=np.int64))
+        if self.pin_memory:
+            batch = tuple(x.pin_memory() for x in batch)
+        return batch
+
+    def _to_device(self, batch):
+        if self.device is None:
+            return batch
+        return tuple(x.to(self.device, non_blocking=self.pin_memory) for x in batch)
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for indices in self.batch_sampler:
+                yield self._to_device(self._make_batch(indices))
+            return
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def producer():
+            try:
+                for indices in self.batch_sampler:
+                    if stop.is_set():
+                        return
+                    batches.put(self._make_batch(indices))
+            except Exception as e:
+                batches.put(e)
+                return
+            batches.put(done)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield self._to_device(batch)
+        finally:
+            # Early exit (break in the training loop): unblock and stop the producer.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.01)
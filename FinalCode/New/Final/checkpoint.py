@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import mmap
+import queue
+import struct
+import threading
+import torch
+
+# Model checkpoints of the training scripts: safetensors weights plus a JSON manifest.
+#   <CHECKPOINT_DIR>/<name>.safetensors  tensors under the stable key schema below
+#   <CHECKPOINT_DIR>/<name>.json         manifest: config, label / group code tables, normalizer stats,
+#                                        metric and step of the snapshot, thresholds added by annotate()
+# CheckpointManager.save() does not block the training loop: CUDA tensors are copied into pinned host
+# buffers on a side stream (the default stream waits for that copy before touching the weights again, the
+# host does not), CPU tensors are cloned, and a background thread waits for the copy, serializes and
+# renames the files into place. A newer save of the same name supersedes a queued one, so best-model
+# tracking only ever writes the latest best. load() memory-maps the file: tensors are views of the
+# (copy-on-write) mapping, assigned directly into a CPU model or copied once to the model's device.
+# Key schema: module attribute paths without wrapper prefixes (torch.compile "_orig_mod", DataParallel /
+# DistributedDataParallel "module."), applied on save and on load, so a checkpoint restores into the bare,
+# compiled or wrapped model alike and no key remapping is needed.
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", "checkpoints")
+KEY_SCHEMA_VERSION = 1
+
+SAFETENSORS_DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+                      "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+                      "U8": torch.uint8, "BOOL": torch.bool}
+
+def canonical_key(key):
+    parts = [p for p in key.split(".") if p != "_orig_mod"]
+    while parts and parts[0] == "module":
+        parts = parts[1:]
+    return ".".join(parts)
+
+def snapshot_state_dict(model):
+    """
+    CPU copy of model.state_dict() under canonical keys; returns (state, ready) where ready is a CUDA event
+    to synchronize on before reading the copies (None when everything was copied synchronously).
+    """
+    state = model.state_dict()
+    cuda_tensors = [t for t in state.values() if t.is_cuda]
+    snapshot = {}
+    ready = None
+    if cuda_tensors:
+        main_stream = torch.cuda.current_stream(cuda_tensors[0].device)
+        copy_stream = torch.cuda.Stream(device=cuda_tensors[0].device)
+        copy_stream.wait_stream(main_stream)
+        with torch.cuda.stream(copy_stream):
+            for key, tensor in state.items():
+                if tensor.is_cuda:
+                    buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                    buffer.copy_(tensor.detach(), non_blocking=True)
+                    snapshot[canonical_key(key)] = buffer
+            ready = torch.cuda.Event()
+            ready.record(copy_stream)
+        # Later optimizer steps must not overwrite the weights before the copy has read them.
+        main_stream.wait_stream(copy_stream)
+    for key, tensor in state.items():
+        if not tensor.is_cuda:
+            snapshot[canonical_key(key)] = tensor.detach().clone().contiguous()
+    return snapshot, ready
+
+def write_checkpoint(path, state, manifest):
+    """Writes <path>.safetensors and <path>.json through temporary files and atomic renames."""
+    from safetensors.torch import save_file
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    save_file(state, path + ".safetensors.tmp",
+              metadata={"key_schema": str(KEY_SCHEMA_VERSION), "name": os.path.basename(path)})
+    os.replace(path + ".safetensors.tmp", path + ".safetensors")
+    write_manifest(path, manifest)
+
+def write_manifest(path, manifest):
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(path + ".json.tmp", path + ".json")
+
+def read_manifest(path):
+    with open(path + ".json") as f:
+        return json.load(f)
+
+def mmap_state_dict(path):
+    """Tensors of a .safetensors file as zero-copy views of a private memory mapping."""
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        header.pop("__metadata__", None)
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) if header else None
+    data_start = 8 + header_len
+    state = {}
+    for key, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            state[key] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        state[key] = torch.frombuffer(mapping, dtype=dtype, count=count, offset=data_start + begin).view(info["shape"])
+    return state
+
+def load_state_dict(model, state, strict=True):
+    """Loads a canonical-key state dict into `model` (bare, compiled or wrapped); returns (missing, unexpected)."""
+    model_keys = {canonical_key(key): key for key in model.state_dict().keys()}
+    missing = sorted(set(model_keys) - set(state))
+    unexpected = sorted(set(state) - set(model_keys))
+    if strict and (missing or unexpected):
+        raise KeyError(f"Checkpoint does not match the model: missing {missing[:5]}, unexpected {unexpected[:5]}")
+    renamed = {model_keys[key]: tensor for key, tensor in state.items() if key in model_keys}
+    on_cpu = all(not t.is_cuda for t in model.state_dict().values())
+    try:
+        model.load_state_dict(renamed, strict=False, assign=on_cpu)
+    except TypeError:
+        model.load_state_dict(renamed, strict=False)
+    return missing, unexpected
+
+class CheckpointManager(object):
+    def __init__(self, directory=CHECKPOINT_DIR, manifest=None, async_write=True):
+        """`manifest` holds the fields written with every checkpoint (config, code tables, normalizer, ...)."""
+        self.directory = directory
+        self.manifest = dict(manifest or {})
+        self.async_write = async_write
+        self._latest = {}
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = None
+        if async_write:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self, model, name="best", metric=None, step=None, **fields):
+        """Snapshots `model` and writes it in the background; returns the path prefix of the checkpoint."""
+        self._raise_pending_error()
+        state, ready = snapshot_state_dict(model)
+        manifest = dict(self.manifest)
+        manifest.update(fields)
+        manifest.update({"name": name, "key_schema": KEY_SCHEMA_VERSION, "metric": metric, "step": step,
+                         "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"), "num_tensors": len(state)})
+        self._latest[name] = self._latest.get(name, 0) + 1
+        job = (name, self._latest[name], state, ready, manifest)
+        if self.async_write:
+            self._queue.put(job)
+        else:
+            self._write(job)
+        return self.path(name)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is not None and job[1] == self._latest[job[0]]:
+                    self._write(job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+            if job is None:
+                return
+
+    def _write(self, job):
+        name, _, state, ready, manifest = job
+        if ready is not None:
+            ready.synchronize()
+        write_checkpoint(self.path(name), state, manifest)
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk."""
+        if self.async_write:
+            self._queue.join()
+        self._raise_pending_error()
+
+    def exists(self, name="best"):
+        self.wait()
+        return os.path.exists(self.path(name) + ".safetensors")
+
+    def annotate(self, name="best", **fields):
+        """Adds fields (e.g. calibrated thresholds) to the manifest of a written checkpoint."""
+        self.wait()
+        manifest = read_manifest(self.path(name))
+        manifest.update(fields)
+        write_manifest(self.path(name), manifest)
+        return manifest
+
+    def load(self, model, name="best", strict=True):
+        """Restores checkpoint `name` into `model` (after pending writes finish); returns its manifest."""
+        self.wait()
+        missing, unexpected = load_state_dict(model, mmap_state_dict(self.path(name) + ".safetensors"), strict=strict)
+        if missing or unexpected:
+            print(f"Loaded {name} with {len(missing)} missing and {len(unexpected)} unexpected keys.")
+        return read_manifest(self.path(name))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.async_write = False
+        self._raise_pending_error()
+
+def category_codes(series, code_tables, name):
+    """Category codes of a pandas Series; the code -> label table is recorded in code_tables[name]."""
+    categorical = series.astype("category")
+    code_tables[name] = [str(c) for c in categorical.cat.categories]
+    return categorical.cat.codes
@@ -0,0 +1,135 @@
+import csv
+import argparse
+from collections import defaultdict
+
+import numpy as np
+from scipy import stats
+from iterstrat.ml_stratifiers import MultilabelStratifiedKFold, MultilabelStratifiedShuffleSplit
+
+from grid_search import run_grid, export_shared_arrays, load_shared_arrays, shared_arrays_exist, config_key
+
+# K-fold cross-validation on top of grid_search.py.
+# Features and text embeddings are computed once by the script's prepare function and exported
+# to a shared directory together with the fold indices (fold<k>_train_idx / _val_idx / _test_idx).
+# Every (configuration, fold) pair is then one job of grid_search.run_grid, so folds run in parallel
+# processes over the same memmapped arrays and only the training is repeated K times.
+# summarize_cv turns the per-fold rows into mean ± t-based confidence interval tables.
+
+def make_cv_folds(labels, n_folds=5, val_fraction=0.05, seed=42):
+    """
+    Multilabel-stratified K folds over `labels` (n_samples, n_outcomes). Each fold is the test set once;
+    a stratified val_fraction of the remaining rows is held out for early stopping, as in the single split.
+    """
+    labels = np.asarray(labels)
+    folds = []
+    mskf = MultilabelStratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    for train_val_idx, test_idx in mskf.split(np.zeros(len(labels)), labels):
+        msss_val = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=val_fraction, random_state=seed)
+        train_rel, val_rel = next(msss_val.split(np.zeros(len(train_val_idx)), labels[train_val_idx]))
+        folds.append({"train_idx": np.asarray(train_val_idx[train_rel], dtype=np.int64),
+                      "val_idx": np.asarray(train_val_idx[val_rel], dtype=np.int64),
+                      "test_idx": np.asarray(test_idx, dtype=np.int64)})
+    return folds
+
+def add_folds(arrays, meta, folds):
+    """Stores the fold indices next to the shared arrays (fold<k>_train_idx, ...)."""
+    arrays = dict(arrays)
+    for k, fold in enumerate(folds):
+        for name, idx in fold.items():
+            arrays[f"fold{k}_{name}"] = idx
+    meta = dict(meta or {})
+    meta["n_folds"] = len(folds)
+    return arrays, meta
+
+def fold_arrays(arrays, fold):
+    """View of the shared arrays with train_idx / val_idx / test_idx replaced by those of `fold`."""
+    arrays = dict(arrays)
+    for name in ["train_idx", "val_idx", "test_idx"]:
+        arrays[name] = np.asarray(arrays[f"fold{fold}_{name}"])
+    return arrays
+
+def fold_pos_weight(labels, train_idx):
+    """n / (2 * n_pos) per outcome on the fold's training rows (same weighting as compute_class_weights)."""
+    train_labels = np.asarray(labels)[train_idx]
+    n_pos = np.maximum(train_labels.sum(axis=0), 1)
+    return (len(train_labels) / (2.0 * n_pos)).tolist()
+
+def prepare_cv_inputs(prepare_fn, shared_dir, n_folds=5, val_fraction=0.05, seed=42, label_key="labels"):
+    """Runs prepare_fn() -> (arrays, meta) once, adds the folds and exports everything to shared_dir."""
+    if shared_arrays_exist(shared_dir):
+        arrays, meta = load_shared_arrays(shared_dir)
+        if meta.get("n_folds") == n_folds and meta.get("cv_seed") == seed:
+            print(f"Reusing shared CV inputs in {shared_dir}")
+            return shared_dir
+        print(f"{shared_dir} was built for a different fold setup; adding new folds.")
+        arrays = {name: np.array(arr) for name, arr in arrays.items() if not name.startswith("fold")}
+    else:
+        arrays, meta = prepare_fn()
+    folds = make_cv_folds(arrays[label_key], n_folds=n_folds, val_fraction=val_fraction, seed=seed)
+    arrays, meta = add_folds(arrays, meta, folds)
+    meta["cv_seed"] = seed
+    return export_shared_arrays(arrays, shared_dir, meta)
+
+def run_cv(script_path, func_name, hparams_list, shared_dir, n_folds=5, results_csv="cv_results.csv",
+           summary_csv="cv_summary.csv", runs_dir="cv_runs", n_workers=None, threads_per_worker=None,
+           confidence=0.95):
+    """
+    Runs func_name(config, arrays, meta) of script_path for every configuration and fold; the fold number is
+    passed as config["fold"]. Results are resumable per (configuration, fold) like any grid run.
+    """
+    jobs = [dict(hparams, fold=k) for hparams in hparams_list for k in range(n_folds)]
+    run_grid(script_path, func_name, jobs, shared_dir, results_csv=results_csv, runs_dir=runs_dir,
+             n_workers=n_workers, threads_per_worker=threads_per_worker)
+    return summarize_cv(results_csv, summary_csv, confidence=confidence)
+
+def mean_ci(values, confidence=0.95):
+    """Mean and half-width of the t-based confidence interval over folds."""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan, np.nan
+    if len(values) == 1:
+        return float(values[0]), np.nan
+    half_width = stats.t.ppf(0.5 + confidence / 2.0, len(values) - 1) * values.std(ddof=1) / np.sqrt(len(values))
+    return float(values.mean()), float(half_width)
+
+def summarize_cv(results_csv, summary_csv="cv_summary.csv", confidence=0.95):
+    """Groups the per-fold rows by configuration and writes mean, CI half-width and bounds per metric."""
+    with open(results_csv, newline="") as f:
+        rows = [row for row in csv.DictReader(f) if row.get("status") == "ok"]
+    groups = defaultdict(list)
+    for row in rows:
+        hparams = {k[3:]: v for k, v in row.items() if k.startswith("hp_") and k != "hp_fold"}
+        groups[config_key(hparams)].append((hparams, row))
+    skip = {"config_key", "status", "seconds", "error"}
+    summary = []
+    for key, members in groups.items():
+        hparams = members[0][0]
+        metrics = [k for k in members[0][1].keys() if k not in skip and not k.startswith("hp_")]
+        print(f"\n=== {len(members)} folds, {hparams} ===")
+        for name in metrics:
+            values = [float(r[name]) if r.get(name) not in (None, "") else np.nan for _, r in members]
+            mean, half = mean_ci(values, confidence)
+            print(f"  {name}: {mean:.4f} ± {half:.4f}")
+            row = {"config": key, "metric": name, "n_folds": len(members), "mean": mean,
+                   "ci_half_width": half, "ci_lower": mean - half, "ci_upper": mean + half}
+            row.update({f"hp_{k}": v for k, v in hparams.items()})
+            summary.append(row)
+    if summary:
+        fieldnames = []
+        for row in summary:
+            fieldnames += [k for k in row.keys() if k not in fieldnames]
+        with open(summary_csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(summary)
+        print(f"\nCV summary ({int(confidence * 100)}% CI) written to {summary_csv}")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-print the mean ± CI table of an existing CV results file.")
+    parser.add_argument("results", help="Per-fold CSV written by run_cv")
+    parser.add_argument("--summary", default="cv_summary.csv")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    args = parser.parse_args()
+    summarize_cv(args.results, args.summary, confidence=args.confidence)
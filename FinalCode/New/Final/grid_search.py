@@ -0,0 +1,157 @@
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import itertools
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Grid/search executor shared by FAME.py and 04_AdvDebias.py.
+# Read-only inputs (features, embeddings, labels, split indices) are written once as .npy files
+# and opened as memmaps in every worker, so a configuration never rebuilds or copies the data.
+# Each configuration runs in its own directory under `runs/`, and its metrics are appended to a
+# single results CSV as soon as it finishes; re-running the same grid skips configurations already
+# present in that CSV.
+
+SHARED_META_FILE = "meta.json"
+
+def expand_grid(grid):
+    """{'lr': [1e-4, 1e-5], 'alpha': [1, 2]} -> list of 4 config dicts (list input is returned as-is)."""
+    if isinstance(grid, (list, tuple)):
+        return [dict(cfg) for cfg in grid]
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+def config_key(config):
+    """Stable short id for a configuration, used for run directories and resume bookkeeping."""
+    payload = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+def export_shared_arrays(arrays, out_dir, meta=None):
+    """Writes each numpy array to <out_dir>/<name>.npy plus a meta.json for scalars (counts, column names, ...)."""
+    os.makedirs(out_dir, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(out_dir, name + ".npy"), np.ascontiguousarray(arr))
+    with open(os.path.join(out_dir, SHARED_META_FILE), "w") as f:
+        json.dump({"arrays": sorted(arrays.keys()), "meta": meta or {}}, f, indent=2, default=str)
+    return out_dir
+
+def load_shared_arrays(shared_dir):
+    """Opens the arrays written by export_shared_arrays as read-only memmaps; returns (arrays, meta)."""
+    with open(os.path.join(shared_dir, SHARED_META_FILE)) as f:
+        manifest = json.load(f)
+    arrays = {name: np.load(os.path.join(shared_dir, name + ".npy"), mmap_mode="r")
+              for name in manifest["arrays"]}
+    return arrays, manifest["meta"]
+
+def shared_arrays_exist(shared_dir):
+    return os.path.exists(os.path.join(shared_dir, SHARED_META_FILE))
+
+def load_function(script_path, func_name):
+    """Loads `func_name` from a script path; the numbered scripts cannot be imported by module name."""
+    script_path = os.path.abspath(script_path)
+    module_name = "grid_target_" + os.path.splitext(os.path.basename(script_path))[0].replace("-", "_")
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return getattr(sys.modules[module_name], func_name)
+
+def completed_keys(results_csv):
+    if not os.path.exists(results_csv):
+        return set()
+    with open(results_csv, newline="") as f:
+        return {row["config_key"] for row in csv.DictReader(f) if row.get("status") == "ok"}
+
+def append_result(results_csv, row):
+    # The header is the union of keys seen so far, rewritten only when a new column appears.
+    rows = []
+    fieldnames = []
+    if os.path.exists(results_csv):
+        with open(results_csv, newline="") as f:
+            reader = csv.DictReader(f)
+            fieldnames = list(reader.fieldnames or [])
+            rows = list(reader)
+    new_fields = [k for k in row.keys() if k not in fieldnames]
+    if new_fields or not rows:
+        fieldnames = fieldnames + new_fields
+        rows.append(row)
+        with open(results_csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(results_csv, "a", newline="") as f:
+            csv.DictWriter(f, fieldnames=fieldnames).writerow(row)
+
+def limit_threads(num_threads):
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]:
+        os.environ[var] = str(num_threads)
+    import torch
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set in this process
+
+_WORKER_STATE = {}
+
+def _init_worker(shared_dir, script_path, func_name, threads_per_worker):
+    limit_threads(threads_per_worker)
+    _WORKER_STATE["shared"] = load_shared_arrays(shared_dir)
+    _WORKER_STATE["func"] = load_function(script_path, func_name)
+
+def _run_config(config, run_dir):
+    os.makedirs(run_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(run_dir)  # per-run checkpoints, plots and csv files never collide
+    start = time.time()
+    try:
+        arrays, meta = _WORKER_STATE["shared"]
+        metrics = _WORKER_STATE["func"](dict(config), arrays, meta) or {}
+        status = "ok"
+    except Exception as e:
+        metrics = {"error": repr(e)}
+        status = "failed"
+    finally:
+        os.chdir(cwd)
+    return metrics, status, time.time() - start
+
+def run_grid(script_path, func_name, grid, shared_dir, results_csv="grid_results.csv",
+             runs_dir="runs", n_workers=None, threads_per_worker=None):
+    """
+    Dispatches every configuration in `grid` to a process pool.
+    `func_name` in `script_path` is called as func(config, arrays, meta) and must return a flat dict of metrics.
+    By default all cores are used: n_workers = min(#configs, cores) and threads_per_worker = cores // n_workers.
+    """
+    configs = expand_grid(grid)
+    done = completed_keys(results_csv)
+    pending = [cfg for cfg in configs if config_key(cfg) not in done]
+    print(f"Grid: {len(configs)} configurations, {len(configs) - len(pending)} already in {results_csv}, {len(pending)} to run.")
+    if not pending:
+        return results_csv
+    cores = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = max(1, min(len(pending), cores))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cores // n_workers)
+    print(f"Using {n_workers} worker processes x {threads_per_worker} threads.")
+    shared_dir = os.path.abspath(shared_dir)
+    runs_dir = os.path.abspath(runs_dir)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(shared_dir, script_path, func_name, threads_per_worker)) as pool:
+        futures = {pool.submit(_run_config, cfg, os.path.join(runs_dir, config_key(cfg))): cfg for cfg in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            cfg = futures[future]
+            metrics, status, elapsed = future.result()
+            row = {"config_key": config_key(cfg), "status": status, "seconds": round(elapsed, 2)}
+            row.update({f"hp_{k}": v for k, v in cfg.items()})
+            row.update(metrics)
+            append_result(results_csv, row)
+            print(f"[{i}/{len(pending)}] {status} in {elapsed:.1f}s: {cfg}")
+    return results_csv
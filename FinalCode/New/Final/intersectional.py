@@ -0,0 +1,133 @@
+import csv
+import itertools
+import numpy as np
+
+# Intersectional subgroup fairness (e.g. 70-89 x black x Medicaid) for the test-set evaluation.
+# Each patient's combination of attribute levels is encoded as one mixed-radix integer
+# (code = sum_k level_k * prod_{j>k} radix_j), and the confusion counts of every intersection cell come
+# from a single np.bincount over code * 4 + (2 * y_true + y_pred). Coarser views (one attribute, pairs, ...)
+# are marginals of that table, obtained by summing axes of the reshaped count array, so no masks are built.
+# Reporting drills down lazily: single attributes first, then only the cells of a finer level that refine
+# a cell which exceeded the disparity threshold. Cells below min_support are suppressed.
+MIN_SUPPORT = 30
+DISPARITY_THRESHOLD = 0.1
+INTERSECTIONAL_FILE = "intersectional_fairness.csv"
+
+def encode_intersections(sensitive):
+    """{attribute: (n,) labels} -> (codes (n,), attribute names, list of level names per attribute, radices)."""
+    attributes = list(sensitive.keys())
+    levels = []
+    level_codes = []
+    for attr in attributes:
+        names, codes = np.unique(np.asarray(sensitive[attr]).astype(str), return_inverse=True)
+        levels.append(names)
+        level_codes.append(codes.reshape(-1).astype(np.int64))
+    radices = [len(names) for names in levels]
+    codes = np.zeros(len(level_codes[0]), dtype=np.int64)
+    for codes_k, radix in zip(level_codes, radices):
+        codes = codes * radix + codes_k
+    return codes, attributes, levels, radices
+
+def intersection_counts(y_true, y_pred, codes, radices):
+    """Confusion counts of every full intersection cell, shape radices + (4,) with last axis (tn, fp, fn, tp)."""
+    n_cells = int(np.prod(radices))
+    outcome = 2 * np.asarray(y_true).astype(np.int64) + np.asarray(y_pred).astype(np.int64)
+    counts = np.bincount(codes * 4 + outcome, minlength=n_cells * 4)
+    return counts.reshape(tuple(radices) + (4,))
+
+def marginal_counts(table, keep_axes):
+    """Confusion counts over the attributes in keep_axes only (sum over the others)."""
+    drop = tuple(axis for axis in range(table.ndim - 1) if axis not in keep_axes)
+    return table.sum(axis=drop) if drop else table
+
+def cell_metrics(counts, overall_error, denom):
+    """counts (..., 4) -> support, error rate, EDDI, TPR, FPR arrays of shape (...)."""
+    tn, fp, fn, tp = [counts[..., k].astype(np.float64) for k in range(4)]
+    support = tn + fp + fn + tp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error_rate = np.where(support > 0, (fp + fn) / support, np.nan)
+        tpr = np.where(tp + fn > 0, tp / (tp + fn), np.nan)
+        fpr = np.where(fp + tn > 0, fp / (fp + tn), np.nan)
+    eddi = (error_rate - overall_error) / denom
+    return support, error_rate, eddi, tpr, fpr
+
+def intersectional_fairness(y_true, y_pred, sensitive, min_support=MIN_SUPPORT,
+                            disparity_threshold=DISPARITY_THRESHOLD, max_depth=None):
+    """
+    Returns (rows, summary). Each row is one reported cell: attributes, levels, support, positives, error rate,
+    EDDI, TPR, FPR, and whether its |EDDI| exceeds disparity_threshold (flagged cells are drilled into).
+    summary holds the intersectional EDDI over all supported full intersections (sqrt of summed squares / #cells).
+    """
+    y_true = np.asarray(y_true).astype(np.int64).reshape(-1)
+    y_pred = np.asarray(y_pred).astype(np.int64).reshape(-1)
+    codes, attributes, levels, radices = encode_intersections(sensitive)
+    table = intersection_counts(y_true, y_pred, codes, radices)
+    overall_error = float(np.mean(y_true != y_pred))
+    denom = max(overall_error, 1 - overall_error) if overall_error not in [0, 1] else 1.0
+    max_depth = len(attributes) if max_depth is None else min(max_depth, len(attributes))
+
+    rows = []
+    flagged = {}  # axes tuple -> set of level tuples that exceeded the threshold
+    for depth in range(1, max_depth + 1):
+        for axes in itertools.combinations(range(len(attributes)), depth):
+            if depth > 1:
+                # Only attribute combinations with a flagged parent one level up are computed.
+                parents = [axes[:i] + axes[i + 1:] for i in range(depth)]
+                if not any(flagged.get(p) for p in parents):
+                    continue
+            counts = marginal_counts(table, axes)
+            support, error_rate, eddi, tpr, fpr = cell_metrics(counts, overall_error, denom)
+            positives = counts[..., 2] + counts[..., 3]
+            for cell in zip(*np.nonzero(support >= min_support)):
+                cell = tuple(int(c) for c in cell)
+                # Drill down: a finer cell is reported only below a flagged parent cell.
+                if depth > 1 and not any(cell[:i] + cell[i + 1:] in flagged.get(axes[:i] + axes[i + 1:], ())
+                                         for i in range(depth)):
+                    continue
+                is_flagged = bool(abs(eddi[cell]) > disparity_threshold)
+                if is_flagged:
+                    flagged.setdefault(axes, set()).add(cell)
+                rows.append({"depth": depth,
+                             "attributes": " x ".join(attributes[a] for a in axes),
+                             "cell": " | ".join(str(levels[a][c]) for a, c in zip(axes, cell)),
+                             "support": int(support[cell]), "positives": int(positives[cell]),
+                             "error_rate": float(error_rate[cell]), "eddi": float(eddi[cell]),
+                             "tpr": float(tpr[cell]), "fpr": float(fpr[cell]), "flagged": is_flagged})
+    full_support, _, full_eddi, _, _ = cell_metrics(table, overall_error, denom)
+    supported_eddi = full_eddi[full_support >= min_support]
+    summary = {"overall_error": overall_error,
+               "cells_total": int(np.prod(radices)),
+               "cells_nonempty": int((full_support > 0).sum()),
+               "cells_supported": int((full_support >= min_support).sum()),
+               "intersectional_eddi": float(np.sqrt(np.sum(supported_eddi ** 2)) / len(supported_eddi)) if len(supported_eddi) else float("nan")}
+    return rows, summary
+
+def intersectional_report(y_true, probs, sensitive, thresholds=0.5, outcome_names=("mortality", "los", "mechanical_ventilation"),
+                          min_support=MIN_SUPPORT, disparity_threshold=DISPARITY_THRESHOLD, out_file=INTERSECTIONAL_FILE):
+    """Runs intersectional_fairness per outcome, prints the flagged cells and saves every reported cell to out_file."""
+    y_true = np.asarray(y_true).reshape(len(y_true), -1)
+    probs = np.asarray(probs).reshape(len(probs), -1)
+    all_rows = []
+    summaries = {}
+    for i, outcome in enumerate(outcome_names):
+        thresh = thresholds[outcome] if isinstance(thresholds, dict) else thresholds
+        rows, summary = intersectional_fairness(y_true[:, i], (probs[:, i] > thresh).astype(int), sensitive,
+                                                min_support=min_support, disparity_threshold=disparity_threshold)
+        summaries[outcome] = summary
+        print(f"\n--- Intersectional fairness: {outcome} (min support {min_support}, |EDDI| > {disparity_threshold}) ---")
+        print(f"  {summary['cells_supported']} of {summary['cells_nonempty']} non-empty intersections have enough support; "
+              f"intersectional EDDI {summary['intersectional_eddi']:.4f}")
+        for row in rows:
+            if row["flagged"]:
+                print(f"  {row['attributes']:<32} {row['cell']:<36} n={row['support']:<6} EDDI={row['eddi']:+.4f} "
+                      f"TPR={row['tpr']:.4f} FPR={row['fpr']:.4f}")
+            row["outcome"] = outcome
+        all_rows.extend(rows)
+    if out_file and all_rows:
+        fieldnames = ["outcome"] + [k for k in all_rows[0].keys() if k != "outcome"]
+        with open(out_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(all_rows)
+        print("Intersectional fairness cells saved to", out_file)
+    return all_rows, summaries
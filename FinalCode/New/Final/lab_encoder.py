@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Lab encoders for the fusion scripts (FAME.py, 08_eddi.py, 09_sigmoid.py, 10_SigmoidEDDI.py).
+# Selected with the LAB_ENCODER environment variable:
+#   dense  - the scripts' BEHRTModel_Lab: one token per lab column, seq-first attention over all columns (default)
+#   sparse - SparseLabEncoder: batch_first attention over the observed labs only
+# In sparse mode the pipelines keep missing labs as NaN (mark_missing_labs) instead of the normalized 0 fill,
+# which is how the encoder tells observed from missing measurements.
+LAB_ENCODER = os.environ.get("LAB_ENCODER", "dense")
+
+class SparseLabEncoder(nn.Module):
+    """
+    Each observed lab becomes one token: value projection + learned item embedding of its column.
+    Observed tokens are compacted to the front of the sequence, so the sequence length is the largest
+    observed count in the batch, and padding is excluded with src_key_padding_mask. In eval mode the
+    TransformerEncoder converts the padded batch to a nested tensor, so attention cost follows each
+    patient's own number of observed labs.
+    """
+    def __init__(self, lab_token_count, hidden_size=768, nhead=8, num_layers=2, dropout=0.1):
+        super(SparseLabEncoder, self).__init__()
+        self.hidden_size = hidden_size
+        self.value_embedding = nn.Linear(1, hidden_size)
+        self.item_embedding = nn.Embedding(lab_token_count, hidden_size)
+        encoder_layer = nn.TransformerEncoderLayer(d_model=hidden_size, nhead=nhead, dropout=dropout, batch_first=True)
+        self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers, enable_nested_tensor=True)
+
+    def forward(self, lab_features, observed_mask=None):
+        # lab_features: (batch, lab_token_count), NaN where the lab was not measured.
+        if observed_mask is None:
+            observed_mask = ~torch.isnan(lab_features)
+        values = torch.nan_to_num(lab_features, nan=0.0)
+        counts = observed_mask.sum(dim=1)
+        seq_len = max(int(counts.max().item()), 1)
+        # Stable sort puts observed columns first, in column order.
+        item_ids = torch.argsort((~observed_mask).to(torch.int8), dim=1, stable=True)[:, :seq_len]
+        token_values = values.gather(1, item_ids)
+        padding_mask = torch.arange(seq_len, device=lab_features.device).unsqueeze(0) >= counts.unsqueeze(1)
+        empty = counts == 0
+        padding_mask[empty, 0] = False  # keep one token so fully-missing rows do not produce NaNs
+
+        x = self.value_embedding(token_values.unsqueeze(-1)) + self.item_embedding(item_ids)
+        x = self.transformer_encoder(x, src_key_padding_mask=padding_mask)
+        keep = (~padding_mask).unsqueeze(-1).to(x.dtype)
+        keep[empty] = 0.0
+        lab_embedding = (x * keep).sum(dim=1) / keep.sum(dim=1).clamp(min=1.0)
+        return lab_embedding
+
+def build_lab_encoder(dense_cls, lab_token_count, hidden_size=768, nhead=8, num_layers=2, encoder=None):
+    """dense_cls is the calling script's BEHRTModel_Lab."""
+    encoder = encoder or LAB_ENCODER
+    if encoder == "sparse":
+        return SparseLabEncoder(lab_token_count, hidden_size=hidden_size, nhead=nhead, num_layers=num_layers)
+    if encoder == "dense":
+        return dense_cls(lab_token_count=lab_token_count, hidden_size=hidden_size, nhead=nhead, num_layers=num_layers)
+    raise ValueError(f"Unknown LAB_ENCODER: {encoder}")
+
+def mark_missing_labs(lab_features_np, missing_mask, encoder=None):
+    """Sets missing labs back to NaN for the sparse encoder; returns the array unchanged for the dense one."""
+    if (encoder or LAB_ENCODER) != "sparse":
+        return lab_features_np
+    lab_features_np = lab_features_np.copy()
+    lab_features_np[missing_mask] = np.nan
+    print(f"Sparse lab encoder: {100.0 * missing_mask.mean():.1f}% of lab tokens are missing and skipped.")
+    return lab_features_np
@@ -0,0 +1,124 @@
+import os
+import math
+import argparse
+import torch
+import torch.nn as nn
+
+# Low-rank adapters (LoRA) for the clinical text encoders (BioClinicalBERT_FT.BioBert, NotesEncoder.roberta).
+# apply_lora replaces the attention projections (query / value by default) with LoRALinear:
+#   y = W x + (alpha / r) * B A x,   W frozen, A (r x in) and B (out x r) trained, B initialised to 0
+# so training starts from the pretrained encoder. Every other encoder weight is frozen; only the adapters
+# (plus modules listed in `trainable`, e.g. a projection head) receive gradients and optimizer state.
+# save_lora_adapters writes just those tensors (a few MB instead of 0.4-1.4 GB), and merge_lora folds
+# B A into W for inference so the merged encoder has the original architecture and speed.
+# LORA_RANK (environment, default 0 = off) is the default adapter rank of the 06_FairEHR-CLP text encoders;
+# with LORA_RANK > 0 its train_pipeline fine-tunes the Bio_ClinicalBERT adapters for LORA_EPOCHS epochs at
+# learning rate LORA_LR before the note embeddings are extracted.
+LORA_RANK = int(os.environ.get("LORA_RANK", "0"))
+LORA_EPOCHS = int(os.environ.get("LORA_EPOCHS", "1"))
+LORA_LR = float(os.environ.get("LORA_LR", "2e-4"))
+LORA_TARGETS = ("query", "value")
+
+class LoRALinear(nn.Module):
+    def __init__(self, base, r=8, alpha=16, dropout=0.05):
+        super(LoRALinear, self).__init__()
+        self.base = base
+        self.r = r
+        self.scaling = alpha / float(r)
+        self.lora_A = nn.Parameter(torch.empty(r, base.in_features, dtype=base.weight.dtype, device=base.weight.device))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, r, dtype=base.weight.dtype, device=base.weight.device))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+        for p in self.base.parameters():
+            p.requires_grad = False
+
+    def forward(self, x):
+        return self.base(x) + (self.dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merged(self):
+        """The base nn.Linear with B A added to its weight."""
+        with torch.no_grad():
+            self.base.weight += (self.lora_B @ self.lora_A) * self.scaling
+        return self.base
+
+def apply_lora(model, r=8, alpha=16, dropout=0.05, target_modules=LORA_TARGETS, trainable=()):
+    """
+    Freezes `model` and wraps every nn.Linear whose name ends with one of target_modules in a LoRALinear.
+    Parameters under a submodule named in `trainable` stay fully trainable. Returns the number of wrapped layers.
+    """
+    for name, p in model.named_parameters():
+        p.requires_grad = any(t in name.split(".") for t in trainable)
+    targets = [(name, module) for name, module in model.named_modules()
+               if isinstance(module, nn.Linear) and name.split(".")[-1] in target_modules]
+    for name, module in targets:
+        parent_name, _, child = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child, LoRALinear(module, r=r, alpha=alpha, dropout=dropout))
+    model.lora_config = {"r": r, "alpha": alpha, "dropout": dropout,
+                         "target_modules": list(target_modules), "trainable": list(trainable)}
+    return len(targets)
+
+def merge_lora(model):
+    """Replaces every LoRALinear by its merged nn.Linear (in place); returns the model."""
+    wrapped = [(name, module) for name, module in model.named_modules() if isinstance(module, LoRALinear)]
+    for name, module in wrapped:
+        parent_name, _, child = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child, module.merged())
+    return model
+
+def lora_state_dict(model):
+    """Only the trained tensors: adapter matrices and the parameters left trainable by apply_lora."""
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    return {name: tensor.detach().cpu() for name, tensor in model.state_dict().items()
+            if name in trainable or "lora_A" in name or "lora_B" in name}
+
+def save_lora_adapters(model, path):
+    state = lora_state_dict(model)
+    torch.save({"config": getattr(model, "lora_config", {}), "state_dict": state}, path)
+    size_mb = os.path.getsize(path) / 2 ** 20
+    print(f"Saved {len(state)} adapter tensors ({size_mb:.1f} MB) to {path}")
+    return path
+
+def load_lora_adapters(model, path, map_location="cpu"):
+    """Loads adapters saved by save_lora_adapters into a model prepared with the same apply_lora call."""
+    checkpoint = torch.load(path, map_location=map_location)
+    missing, unexpected = model.load_state_dict(checkpoint["state_dict"], strict=False)
+    if unexpected:
+        raise KeyError(f"Adapter tensors not found in the model: {unexpected[:5]}")
+    return checkpoint["config"]
+
+def trainable_parameters(model):
+    return [p for p in model.parameters() if p.requires_grad]
+
+def parameter_report(model, optimizer_states=2):
+    """Trainable vs total parameters and the Adam state they need (optimizer_states fp32 tensors each)."""
+    total = sum(p.numel() for p in model.parameters())
+    trained = sum(p.numel() for p in trainable_parameters(model))
+    print(f"Trainable parameters: {trained:,} of {total:,} ({100.0 * trained / max(total, 1):.2f}%), "
+          f"optimizer state {trained * optimizer_states * 4 / 2 ** 20:.1f} MB "
+          f"(full fine-tuning: {total * optimizer_states * 4 / 2 ** 20:.1f} MB)")
+    return trained, total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parameter, optimizer-state and checkpoint size of a LoRA text encoder.")
+    parser.add_argument("--model", default="emilyalsentzer/Bio_ClinicalBERT", help="e.g. roberta-large for NotesEncoder")
+    parser.add_argument("--r", type=int, default=8)
+    parser.add_argument("--alpha", type=int, default=16)
+    parser.add_argument("--out", default="lora_adapters.pt")
+    args = parser.parse_args()
+    from transformers import AutoModel, AutoTokenizer
+    encoder = AutoModel.from_pretrained(args.model)
+    encoder.eval()
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    batch = tokenizer(["patient intubated overnight, extubated this morning"], return_tensors="pt")
+    with torch.no_grad():
+        reference = encoder(**batch).last_hidden_state[:, 0, :]
+    print(f"Wrapped {apply_lora(encoder, r=args.r, alpha=args.alpha)} layers of {args.model}")
+    parameter_report(encoder)
+    save_lora_adapters(encoder, args.out)
+    # B starts at zero, so the merged encoder must reproduce the pretrained CLS vector.
+    merge_lora(encoder)
+    with torch.no_grad():
+        merged = encoder(**batch).last_hidden_state[:, 0, :]
+    print(f"Max |CLS difference| after merge: {(merged - reference).abs().max().item():.2e}")
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import contextlib
+import numpy as np
+import torch
+
+# Opt-in performance mode for the multimodal fusion training loops
+# (FAME.py, 03_DfC.py, 07_average.py, 08_eddi.py, 09_sigmoid.py, 10_SigmoidEDDI.py).
+# Selected with the PERF_MODE environment variable:
+#   off          - fp32 eager (default, unchanged behaviour)
+#   bf16         - forward + loss under torch.autocast (bf16 on CPU and on GPUs that support it, fp16 + GradScaler otherwise)
+#   compile      - torch.compile of the fusion model (in place, state_dict keys are unchanged)
+#   bf16+compile - both
+# Every run appends its mean step time and validation/test metrics to PERF_RUNS_FILE (default
+# perf_mode_runs.json next to this module, so grid / CV runs that chdir into runs/<key> share it); runs
+# with a mode other than "off" are reported against the latest fp32 run of the same script.
+PERF_MODE = os.environ.get("PERF_MODE", "off")
+PERF_TIME_EVERY = int(os.environ.get("PERF_TIME_EVERY", "20"))  # time one step in every N
+PERF_RUNS_FILE = os.environ.get("PERF_RUNS_FILE",
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), "perf_mode_runs.json"))
+
+class PerfMode(object):
+    def __init__(self, device, mode="off", max_bad_steps=3, time_every=PERF_TIME_EVERY):
+        if mode not in ("off", "bf16", "compile", "bf16+compile"):
+            raise ValueError(f"Unknown PERF_MODE: {mode}")
+        self.device = device
+        self.mode = mode
+        self.use_autocast = "bf16" in mode
+        self.use_compile = "compile" in mode
+        self.dtype = torch.bfloat16
+        if device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            self.dtype = torch.float16
+        # Loss scaling is only needed for fp16; bf16 has the fp32 exponent range.
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_autocast and self.dtype == torch.float16)
+        self.max_bad_steps = max_bad_steps
+        self.bad_steps = 0
+        self.skipped_steps = 0
+        self.step_times = []
+        self.time_every = max(1, time_every)
+        self._steps = 0
+        self._step_start = None
+
+    @classmethod
+    def from_env(cls, device):
+        perf = cls(device, PERF_MODE)
+        if perf.mode != "off":
+            print(f"Performance mode: {perf.mode} (autocast dtype {perf.dtype})")
+        return perf
+
+    def compile(self, model):
+        if self.use_compile:
+            model.compile()
+        return model
+
+    def autocast(self):
+        if not self.use_autocast:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def start_step(self):
+        # Only every time_every-th step is synchronized and timed, so the loop (fp32 included) rarely stalls the host.
+        self._steps += 1
+        if self._steps % self.time_every:
+            return
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+        self._step_start = time.perf_counter()
+
+    def backward_step(self, loss, optimizer, parameters=None, max_norm=None):
+        """
+        backward + (optional) grad clipping + optimizer step.
+        Numerics guard (autocast only, so fp32 steps have no extra host sync): a non-finite loss skips
+        the update; after max_bad_steps consecutive non-finite losses autocast is switched off and
+        training continues in fp32.
+        """
+        if self.use_autocast and not torch.isfinite(loss.detach()):
+            optimizer.zero_grad()
+            self._step_start = None
+            self.skipped_steps += 1
+            self.bad_steps += 1
+            print(f"Non-finite loss ({loss.item()}), skipping step.")
+            if self.bad_steps >= self.max_bad_steps:
+                print(f"{self.bad_steps} consecutive non-finite losses under {self.dtype}; falling back to fp32.")
+                self.use_autocast = False
+            return False
+        self.bad_steps = 0
+        self.scaler.scale(loss).backward()
+        if max_norm is not None:
+            self.scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(parameters, max_norm=max_norm)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+        if self._step_start is not None:
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+            self.step_times.append(time.perf_counter() - self._step_start)
+            self._step_start = None
+        return True
+
+    def mean_step_ms(self):
+        # Timed steps come every time_every steps; the first one may include compilation / warm-up and is
+        # excluded when possible.
+        times = self.step_times[1:] if len(self.step_times) > 2 else self.step_times
+        return 1000.0 * float(np.mean(times)) if times else float("nan")
+
+def flatten_metrics(metrics, prefix=""):
+    """Nested dicts of metrics -> {"outcome/name": float} (non-numeric values are dropped)."""
+    flat = {}
+    if isinstance(metrics, dict):
+        for key, value in metrics.items():
+            flat.update(flatten_metrics(value, f"{prefix}{key}/"))
+    elif isinstance(metrics, (int, float, np.floating, np.integer)) and not isinstance(metrics, bool):
+        flat[prefix.rstrip("/")] = float(metrics)
+    return flat
+
+def record_perf_run(script, perf, metrics, runs_file=PERF_RUNS_FILE):
+    """Stores this run and, for non-fp32 modes, prints step-time speedup and metric drift vs the last fp32 run."""
+    runs = []
+    if os.path.exists(runs_file):
+        with open(runs_file) as f:
+            runs = json.load(f)
+    run = {"script": script, "mode": perf.mode, "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "mean_step_ms": perf.mean_step_ms(), "skipped_steps": perf.skipped_steps,
+           "metrics": flatten_metrics(metrics)}
+    runs.append(run)
+    with open(runs_file, "w") as f:
+        json.dump(runs, f, indent=2)
+    print(f"\nMean train step: {run['mean_step_ms']:.1f} ms ({perf.mode}), skipped steps: {perf.skipped_steps}")
+    if perf.mode == "off":
+        return run
+    baseline = [r for r in runs[:-1] if r["script"] == script and r["mode"] == "off"]
+    if not baseline:
+        print("No fp32 run of", script, "in", runs_file, "to compare against; run once with PERF_MODE=off.")
+        return run
+    baseline = baseline[-1]
+    print(f"--- {perf.mode} vs fp32 ({baseline['time']}) ---")
+    print(f"Step-time speedup: {baseline['mean_step_ms'] / run['mean_step_ms']:.2f}x")
+    for name, value in run["metrics"].items():
+        if name in baseline["metrics"]:
+            print(f"  {name}: {value:.4f} (fp32 {baseline['metrics'][name]:.4f}, drift {value - baseline['metrics'][name]:+.4f})")
+    return run
@@ -0,0 +1,463 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from checkpoint import CheckpointManager, read_manifest
+from grid_search import load_function
+from lab_encoder import build_lab_encoder
+from text_encoder import CLSExtractor, prepare_text_encoder, TEXT_ENCODER_BACKEND, BIOCLINICALBERT_NAME
+
+# Local scoring service for checkpoints written by CheckpointManager (checkpoint.py):
+# MultimodalTransformer_EDDI_Sigmoid (FAME.py, 10_SigmoidEDDI.py, Updat_Fame.py) or MultimodalTransformer_DfC
+# (03_DfC.py). The model, the code tables, the lab normalizer and the calibrated thresholds are read from
+# the checkpoint and its manifest once at startup; nothing is retrained or re-read from CSV.
+#   python scoring_service.py --checkpoint checkpoints/best_model --port 8000
+#   python scoring_service.py --checkpoint checkpoints/best_model --unix_socket /tmp/fame.sock
+# Endpoints (JSON):
+#   POST /score   one patient, or {"patients": [...]}
+#   GET  /stats   requests, batches, mean batch size, p50 / p99 latency (ms) and throughput (requests/s)
+#   GET  /health  model and checkpoint being served
+# Patient payload (EDDI / FAME models): {"age": 67, "gender": "M", "ethnicity": "WHITE", "insurance": "Medicare",
+#   "labs": {"<lab column of final_structured_common.csv>": value, ...}, "notes": ["note chunk", ...]}
+# DfC models take {"segment": 0, "first_wardid": 12, "last_wardid": 14, "notes": [...]} instead of
+# demographics and labs. "text_embedding" (768 floats) may replace "notes". Missing labs are treated as the
+# training pipelines treat them (0 before normalization, NaN for the sparse lab encoder).
+# Requests are queued and coalesced into micro-batches: a batch runs as soon as max_batch_size requests are
+# waiting or the oldest one has waited max_latency_ms, so the queueing delay of a request is bounded.
+OUTCOMES = ["mortality", "los", "mechanical_ventilation"]
+FINAL_DIR = os.path.dirname(os.path.abspath(__file__))
+EDDI_MODEL = "MultimodalTransformer_EDDI_Sigmoid"
+DFC_MODEL = "MultimodalTransformer_DfC"
+DEMOGRAPHIC_SIZES = {"age": "num_ages", "gender": "num_genders", "ethnicity": "num_ethnicities", "insurance": "num_insurances"}
+
+def build_model(manifest):
+    """Instantiates the checkpointed architecture from the classes of the script that trained it."""
+    script = os.path.join(FINAL_DIR, manifest["script"] + ".py")
+    arch = manifest["architecture"]
+    device = torch.device("cpu")  # weights are restored on CPU first, then moved
+    if manifest["model"] == EDDI_MODEL:
+        behrt_demo = load_function(script, "BEHRTModel_Demo")(
+            num_ages=arch["num_ages"], num_genders=arch["num_genders"], num_ethnicities=arch["num_ethnicities"],
+            num_insurances=arch["num_insurances"], hidden_size=arch["hidden_size"])
+        behrt_lab = build_lab_encoder(load_function(script, "BEHRTModel_Lab"), lab_token_count=arch["num_lab_features"],
+                                      hidden_size=arch["hidden_size"], nhead=8, num_layers=2,
+                                      encoder=arch.get("lab_encoder", "dense"))
+        return load_function(script, EDDI_MODEL)(text_embed_size=arch["text_embed_size"], behrt_demo=behrt_demo,
+                                                 behrt_lab=behrt_lab, device=device, fusion_hidden=arch["fusion_hidden"],
+                                                 beta=manifest.get("config", {}).get("beta", 1.0))
+    if manifest["model"] == DFC_MODEL:
+        behrt = load_function(script, "BEHRTModel_DfC")(
+            num_diseases=arch["num_diseases"], num_segments=arch["num_segments"],
+            num_admission_locs=arch["num_admission_locs"], num_discharge_locs=arch["num_discharge_locs"],
+            hidden_size=arch["behrt_hidden_size"])
+        return load_function(script, DFC_MODEL)(text_embed_size=arch["text_embed_size"], BEHRT=behrt,
+                                                device=device, hidden_size=arch["hidden_size"])
+    raise ValueError(f"No scoring support for model {manifest['model']}")
+
+def load_checkpointed_model(checkpoint_path, device):
+    """checkpoint_path is the CheckpointManager path prefix (without .safetensors); returns (model, manifest)."""
+    manifest = read_manifest(checkpoint_path)
+    model = build_model(manifest)
+    CheckpointManager(os.path.dirname(checkpoint_path) or ".", async_write=False).load(model, os.path.basename(checkpoint_path))
+    for module in model.modules():
+        if hasattr(module, "device") and isinstance(module.device, torch.device):
+            module.device = device
+    return model.to(device).eval(), manifest
+
+class NoteEncoder(object):
+    """Mean Bio_ClinicalBERT CLS vector over a patient's note chunks, as apply_bioclinicalbert_on_patient_notes computes it."""
+    def __init__(self, device, backend=TEXT_ENCODER_BACKEND, batch_size=32, max_length=512):
+        from transformers import AutoModel, AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(BIOCLINICALBERT_NAME)
+        base = CLSExtractor(AutoModel.from_pretrained(BIOCLINICALBERT_NAME)).to(device)
+        self.encoder, self.device = prepare_text_encoder(base, backend, device)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def encode(self, texts):
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                     max_length=self.max_length, return_tensors="pt")
+            with torch.no_grad():
+                emb = self.encoder(encoded["input_ids"].to(self.device), encoded["attention_mask"].to(self.device))
+            rows.append(emb.float().cpu().numpy())
+        return np.vstack(rows)
+
+class FeatureEncoder(object):
+    """Turns patient payloads into model inputs with the manifest's code tables and lab normalizer."""
+    def __init__(self, manifest, note_encoder=None):
+        self.model_name = manifest["model"]
+        self.arch = manifest["architecture"]
+        self.code_tables = {name: {label: code for code, label in enumerate(labels)}
+                            for name, labels in manifest.get("code_tables", {}).items()}
+        self.mappers = {}
+        if manifest.get("demographic_mapping"):
+            script = os.path.join(FINAL_DIR, manifest["demographic_mapping"] + ".py")
+            self.mappers = {"age": load_function(script, "get_age_bucket"),
+                            "ethnicity": load_function(script, "map_ethnicity"),
+                            "insurance": load_function(script, "map_insurance")}
+        normalizer = manifest.get("normalizer") or {}
+        self.lab_columns = normalizer.get("lab_columns", [])
+        self.lab_index = {col: j for j, col in enumerate(self.lab_columns)}
+        self.lab_mean = np.asarray(normalizer.get("mean", []), dtype=np.float32)
+        self.lab_std = np.asarray(normalizer.get("std", []), dtype=np.float32)
+        self.lab_eps = normalizer.get("eps", 1e-6)
+        self.note_encoder = note_encoder
+
+    def demographic_code(self, name, value):
+        if value is None:
+            raise ValueError(f"Missing field: {name}")
+        if name in self.mappers:
+            value = self.mappers[name](value)
+        table = self.code_tables.get(name)
+        if table is None:
+            # The training script fed this column to the embedding as a numeric code.
+            size = self.arch[DEMOGRAPHIC_SIZES[name]]
+            code = int(value)
+            if not 0 <= code < size:
+                raise ValueError(f"{name} {value!r} is outside the trained code range 0..{size - 1}")
+            return code
+        if str(value) not in table:
+            raise ValueError(f"Unknown {name} {value!r}; expected one of {sorted(table)}")
+        return table[str(value)]
+
+    def index_field(self, payload, name, size):
+        value = int(payload.get(name, 0))
+        if not 0 <= value < size:
+            raise ValueError(f"{name} {value} is outside the trained range 0..{size - 1}")
+        return value
+
+    def categorical_row(self, payload):
+        """Validates one payload; returns its categorical ids (raises ValueError on bad input)."""
+        if self.model_name == DFC_MODEL:
+            return [self.index_field(payload, "segment", self.arch["num_segments"]),
+                    self.index_field(payload, "first_wardid", self.arch["num_admission_locs"]),
+                    self.index_field(payload, "last_wardid", self.arch["num_discharge_locs"])]
+        return [self.demographic_code(name, payload.get(name)) for name in ["age", "gender", "ethnicity", "insurance"]]
+
+    def lab_row(self, payload):
+        """Validates one payload's labs; returns (values, missing) rows before normalization."""
+        values = np.zeros(len(self.lab_columns), dtype=np.float32)
+        missing = np.ones(len(self.lab_columns), dtype=bool)
+        labs = payload.get("labs") or {}
+        if not isinstance(labs, dict):
+            raise ValueError("labs must be an object of {lab column: value}")
+        for col, value in labs.items():
+            j = self.lab_index.get(col)
+            if j is not None and value is not None:
+                value = float(value)
+                if not np.isfinite(value):
+                    raise ValueError(f"Lab {col} is not a finite number: {value!r}")
+                values[j] = value
+                missing[j] = False
+        return values, missing
+
+    def lab_features(self, lab_rows):
+        values = np.stack([v for v, _ in lab_rows]) if lab_rows else np.zeros((0, len(self.lab_columns)), dtype=np.float32)
+        missing = np.stack([m for _, m in lab_rows]) if lab_rows else np.zeros(values.shape, dtype=bool)
+        values = (values - self.lab_mean) / (self.lab_std + self.lab_eps)
+        if self.arch.get("lab_encoder") == "sparse":
+            values[missing] = np.nan
+        return values
+
+    def text_input(self, payload):
+        """Validates one payload's text; returns its embedding or its list of note chunks."""
+        if payload.get("text_embedding") is not None:
+            embedding = np.asarray(payload["text_embedding"], dtype=np.float32)
+            if embedding.shape != (self.arch["text_embed_size"],):
+                raise ValueError(f"text_embedding must have {self.arch['text_embed_size']} values, got shape {embedding.shape}")
+            if not np.isfinite(embedding).all():
+                raise ValueError("text_embedding has non-finite values")
+            return embedding
+        notes = [n for n in payload.get("notes") or [] if isinstance(n, str) and n.strip()]
+        if notes and self.note_encoder is None:
+            raise ValueError("Notes were sent but the service runs without a text encoder; send text_embedding")
+        return notes
+
+    def text_embeddings(self, text_inputs):
+        out = np.zeros((len(text_inputs), self.arch["text_embed_size"]), dtype=np.float32)
+        chunks = []
+        owners = []
+        for i, text in enumerate(text_inputs):
+            if isinstance(text, np.ndarray):
+                out[i] = text
+                continue
+            chunks.extend(text)
+            owners.extend([i] * len(text))
+        if chunks:
+            emb = self.note_encoder.encode(chunks)
+            owners = np.asarray(owners)
+            sums = np.zeros_like(out)
+            np.add.at(sums, owners, emb)
+            counts = np.bincount(owners, minlength=len(text_inputs))
+            has_notes = counts > 0
+            out[has_notes] = sums[has_notes] / counts[has_notes, None]
+        return out
+
+class FusionScorer(object):
+    """Scores a list of payloads in one forward pass; invalid payloads get an error entry instead of failing the batch."""
+    def __init__(self, model, manifest, features, device):
+        self.model = model
+        self.manifest = manifest
+        self.features = features
+        self.device = device
+        thresholds = manifest.get("thresholds")
+        self.calibrated = thresholds is not None
+        self.thresholds = {o: float((thresholds or {}).get(o, 0.5)) for o in OUTCOMES}
+
+    def __call__(self, payloads):
+        results = [None] * len(payloads)
+        uses_labs = self.manifest["model"] != DFC_MODEL
+        valid = []
+        categorical = []
+        lab_rows = []
+        text_inputs = []
+        for i, payload in enumerate(payloads):
+            # Every per-payload conversion happens here, so a bad payload never reaches the batch tensors.
+            if not isinstance(payload, dict):
+                results[i] = {"error": f"Expected a patient object, got {type(payload).__name__}"}
+                continue
+            try:
+                row = self.features.categorical_row(payload)
+                labs = self.features.lab_row(payload) if uses_labs else None
+                text = self.features.text_input(payload)
+            except (ValueError, TypeError) as e:
+                results[i] = {"error": str(e)}
+                continue
+            except Exception as e:
+                results[i] = {"error": f"{type(e).__name__}: {e}"}
+                continue
+            valid.append(i)
+            categorical.append(row)
+            lab_rows.append(labs)
+            text_inputs.append(text)
+        if not valid:
+            return results
+        n = len(valid)
+        ids = torch.tensor(categorical, dtype=torch.long, device=self.device)
+        dummy_ids = torch.zeros((n, 1), dtype=torch.long, device=self.device)
+        attn_mask = torch.ones((n, 1), dtype=torch.long, device=self.device)
+        text = torch.tensor(self.features.text_embeddings(text_inputs), dtype=torch.float32, device=self.device)
+        with torch.no_grad():
+            if not uses_labs:
+                logits = torch.cat(self.model(dummy_ids, attn_mask, ids[:, 0], ids[:, 1], ids[:, 2], text), dim=1)
+            else:
+                labs = torch.tensor(self.features.lab_features(lab_rows), dtype=torch.float32, device=self.device)
+                logits = self.model(dummy_ids, attn_mask, ids[:, 0], ids[:, 1], ids[:, 2], ids[:, 3], labs, text)["fused_logits"]
+        probs = torch.sigmoid(logits).float().cpu().numpy()
+        for row, i in enumerate(valid):
+            results[i] = {"probabilities": {o: float(probs[row, k]) for k, o in enumerate(OUTCOMES)},
+                          "predictions": {o: int(probs[row, k] > self.thresholds[o]) for k, o in enumerate(OUTCOMES)},
+                          "thresholds": self.thresholds, "calibrated": self.calibrated}
+        return results
+
+class ServiceStats(object):
+    """Request / batch counters and a sliding window of per-request latencies."""
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self.latencies_ms = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def record_batch(self, latencies_s, errors):
+        with self._lock:
+            self.latencies_ms.extend(1000.0 * t for t in latencies_s)
+            self.requests += len(latencies_s)
+            self.batches += 1
+            self.errors += errors
+
+    def snapshot(self):
+        with self._lock:
+            latencies = np.asarray(self.latencies_ms)
+            uptime = time.time() - self.started
+            summary = {"requests": self.requests, "batches": self.batches, "errors": self.errors,
+                       "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                       "uptime_s": uptime, "throughput_rps": self.requests / uptime if uptime > 0 else 0.0}
+        if len(latencies):
+            summary["latency_ms"] = {"p50": float(np.percentile(latencies, 50)), "p99": float(np.percentile(latencies, 99)),
+                                     "max": float(latencies.max()), "window": int(len(latencies))}
+        return summary
+
+class PendingRequest(object):
+    __slots__ = ("payload", "arrived", "done", "result")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.arrived = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+
+class MicroBatcher(object):
+    """Coalesces concurrent requests into batches of at most max_batch_size, waiting at most max_latency_ms."""
+    def __init__(self, score_fn, max_batch_size=32, max_latency_ms=10.0, stats=None):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.stats = stats or ServiceStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit_many(self, payloads):
+        pending = [PendingRequest(p) for p in payloads]
+        for request in pending:
+            self._queue.put(request)
+        for request in pending:
+            request.done.wait()
+        return [request.result for request in pending]
+
+    def submit(self, payload):
+        return self.submit_many([payload])[0]
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrived + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Past the deadline only requests that are already queued join the batch.
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                results = self.score_fn([request.payload for request in batch])
+            except Exception as e:
+                results = [{"error": f"{type(e).__name__}: {e}"}] * len(batch)
+            now = time.perf_counter()
+            for request, result in zip(batch, results):
+                request.result = result
+                request.done.set()
+            self.stats.record_batch([now - request.arrived for request in batch],
+                                    sum(1 for result in results if "error" in result))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+class ScoringService(object):
+    def __init__(self, checkpoint_path, device, max_batch_size=32, max_latency_ms=10.0, text_encoder=True):
+        self.checkpoint_path = checkpoint_path
+        self.model, self.manifest = load_checkpointed_model(checkpoint_path, device)
+        # Notes are truncated as the training script truncated them when it built its text embeddings.
+        note_encoder = NoteEncoder(device, max_length=self.manifest.get("text_max_length", 512)) if text_encoder else None
+        self.scorer = FusionScorer(self.model, self.manifest, FeatureEncoder(self.manifest, note_encoder), device)
+        self.stats = ServiceStats()
+        self.batcher = MicroBatcher(self.scorer, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms, stats=self.stats)
+        print(f"Serving {self.manifest['model']} from {checkpoint_path} ({self.manifest.get('script')}, "
+              f"step {self.manifest.get('step')}) on {device}; thresholds "
+              f"{'calibrated' if self.scorer.calibrated else 'default 0.5'}: {self.scorer.thresholds}")
+
+    def health(self):
+        return {"status": "ok", "model": self.manifest["model"], "script": self.manifest.get("script"),
+                "checkpoint": self.checkpoint_path, "saved_at": self.manifest.get("saved_at"),
+                "thresholds": self.scorer.thresholds, "calibrated": self.scorer.calibrated}
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    server_version = "FairMultimodalScoring/1.0"
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, self.server.service.health())
+        elif self.path == "/stats":
+            self._send_json(200, self.server.service.stats.snapshot())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+        if isinstance(body, dict) and isinstance(body.get("patients"), list):
+            self._send_json(200, {"results": self.server.service.batcher.submit_many(body["patients"])})
+        elif isinstance(body, dict):
+            result = self.server.service.batcher.submit(body)
+            self._send_json(400 if "error" in result else 200, result)
+        else:
+            self._send_json(400, {"error": "Expected a patient object or {\"patients\": [...]}"})
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(service, host="127.0.0.1", port=8000, unix_socket=None, verbose=False):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, ScoringHandler)
+        where = f"unix socket {unix_socket}"
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringHandler)
+        where = f"http://{host}:{port}"
+    server.service = service
+    server.verbose = verbose
+    print(f"Scoring service listening on {where} (POST /score, GET /stats, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.batcher.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        print("Final stats:", json.dumps(service.stats.snapshot()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score ICU admissions with a checkpointed fusion model.")
+    parser.add_argument("--checkpoint", required=True, help="checkpoint path prefix, e.g. checkpoints/best_model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", default=None, help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_latency_ms", type=float, default=10.0, help="longest a request waits for its batch to fill")
+    parser.add_argument("--no_text_encoder", action="store_true", help="do not load Bio_ClinicalBERT; payloads must carry text_embedding")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    service = ScoringService(args.checkpoint, device, max_batch_size=args.max_batch_size,
+                             max_latency_ms=args.max_latency_ms, text_encoder=not args.no_text_encoder)
+    serve(service, host=args.host, port=args.port, unix_socket=args.unix_socket, verbose=args.verbose)
@@ -0,0 +1,333 @@
+import os
+import atexit
+import copy
+import time
+import contextlib
+import weakref
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import train_test_split
+
+# Execution backends for the frozen Bio_ClinicalBERT CLS extractor (BioClinicalBERT_FT).
+# Every script's apply_bioclinicalbert_on_patient_notes takes backend=..., defaulting to the
+# TEXT_ENCODER_BACKEND environment variable, and calls prepare_text_encoder before encoding notes.
+#   fp32 - the eager PyTorch model as loaded (default)
+#   int8 - dynamic int8 quantization of every nn.Linear (CPU only)
+#   onnx - the exported graph run by onnxruntime on CPU, exported on first use to TEXT_ENCODER_ONNX with
+#          the weights fingerprint added to the file name (bioclinicalbert_cls_<sha1>.onnx)
+# Setting TEXT_ENCODER_CACHE to a directory caches CLS vectors keyed on the token ids, in one file per
+# backend and set of encoder weights (a sha1 of the parameters, or TEXT_ENCODER_CACHE_TAG when set), so
+# fine-tuned / LoRA-adapted encoders and the int8 / onnx backends never read another encoder's vectors.
+TEXT_ENCODER_BACKENDS = ["fp32", "int8", "onnx"]
+TEXT_ENCODER_BACKEND = os.environ.get("TEXT_ENCODER_BACKEND", "fp32")
+TEXT_ENCODER_ONNX_PATH = os.environ.get("TEXT_ENCODER_ONNX", "bioclinicalbert_cls.onnx")
+TEXT_ENCODER_THREADS = int(os.environ.get("TEXT_ENCODER_THREADS", "0"))  # 0 lets onnxruntime decide
+TEXT_ENCODER_CACHE = os.environ.get("TEXT_ENCODER_CACHE")
+TEXT_ENCODER_CACHE_TAG = os.environ.get("TEXT_ENCODER_CACHE_TAG")
+BIOCLINICALBERT_NAME = "emilyalsentzer/Bio_ClinicalBERT"
+
+class CLSExtractor(nn.Module):
+    """Same computation as the scripts' BioClinicalBERT_FT: last_hidden_state[:, 0, :]."""
+    def __init__(self, base_model):
+        super(CLSExtractor, self).__init__()
+        self.bert = base_model
+
+    def forward(self, input_ids, attention_mask):
+        outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
+        return outputs.last_hidden_state[:, 0, :]
+
+def quantize_text_encoder(model):
+    """Dynamic int8 quantization of the Linear layers of a CPU copy of the encoder; the original is untouched."""
+    cpu_model = copy.deepcopy(model).to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(cpu_model, {nn.Linear}, dtype=torch.qint8)
+
+def export_text_encoder_onnx(model, onnx_path=TEXT_ENCODER_ONNX_PATH, opset=17):
+    """Exports the CLS extractor with dynamic batch and sequence axes."""
+    model = copy.deepcopy(model).to("cpu").eval()
+    dummy_ids = torch.ones((2, 16), dtype=torch.long)
+    dummy_mask = torch.ones((2, 16), dtype=torch.long)
+    torch.onnx.export(model, (dummy_ids, dummy_mask), onnx_path,
+                      input_names=["input_ids", "attention_mask"],
+                      output_names=["cls_embedding"],
+                      dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                    "attention_mask": {0: "batch", 1: "sequence"},
+                                    "cls_embedding": {0: "batch"}},
+                      opset_version=opset, do_constant_folding=True)
+    print("Exported text encoder to", onnx_path)
+    return onnx_path
+
+class OnnxTextEncoder(object):
+    """
+    Drop-in replacement for the torch encoder inside apply_bioclinicalbert_on_patient_notes:
+    called as model(input_ids, attention_mask) and returns a CPU tensor. Attribute lookups
+    (e.g. model.BioBert.config.hidden_size) fall through to the torch model it was exported from.
+    """
+    def __init__(self, onnx_path, torch_model=None, intra_op_threads=TEXT_ENCODER_THREADS):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.torch_model = torch_model
+
+    def __call__(self, input_ids, attention_mask):
+        outputs = self.session.run(["cls_embedding"], {"input_ids": input_ids.cpu().numpy().astype(np.int64),
+                                                       "attention_mask": attention_mask.cpu().numpy().astype(np.int64)})
+        return torch.from_numpy(outputs[0])
+
+    def eval(self):
+        return self
+
+    def __getattr__(self, name):
+        torch_model = self.__dict__.get("torch_model")
+        if torch_model is None:
+            raise AttributeError(name)
+        return getattr(torch_model, name)
+
+def text_encoder_cache_key(input_ids, attention_mask):
+    """Key on the attended token ids only, so it is identical for every backend and padding length."""
+    ids = input_ids[attention_mask.bool()].cpu().numpy().astype(np.int64)
+    return hashlib.sha1(ids.tobytes()).hexdigest()
+
+_WEIGHT_FINGERPRINTS = weakref.WeakKeyDictionary()  # model -> (tensor versions, fingerprint)
+
+def weights_fingerprint(model):
+    """
+    sha1 over the names and values of the model's parameters and buffers. Memoized per model object and
+    recomputed only when a tensor was replaced or modified in place (optimizer steps, merge_lora).
+    """
+    state = model.state_dict(keep_vars=True)
+    versions = tuple((name, id(t), t._version) for name, t in state.items())
+    memo = _WEIGHT_FINGERPRINTS.get(model)
+    if memo is not None and memo[0] == versions:
+        return memo[1]
+    digest = hashlib.sha1()
+    for name, tensor in state.items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    fingerprint = digest.hexdigest()[:16]
+    _WEIGHT_FINGERPRINTS[model] = (versions, fingerprint)
+    return fingerprint
+
+def onnx_path_for(fingerprint, onnx_path=TEXT_ENCODER_ONNX_PATH):
+    root, ext = os.path.splitext(onnx_path)
+    return f"{root}_{fingerprint}{ext or '.onnx'}"
+
+class EmbeddingCache(object):
+    """CLS vectors keyed by text_encoder_cache_key, persisted as one .npz per backend and model tag."""
+    def __init__(self, cache_dir, backend, model_tag, model_name=BIOCLINICALBERT_NAME):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f"{model_name.replace('/', '__')}__{backend}__{model_tag}.npz")
+        self.entries = dict(np.load(self.path)) if os.path.exists(self.path) else {}
+        self.hits = 0
+        self.misses = 0
+
+    def save(self):
+        np.savez(self.path, **self.entries)
+
+class CachedTextEncoder(object):
+    """Wraps any backend; only rows missing from the cache are sent to the encoder."""
+    def __init__(self, encoder, cache):
+        self.encoder = encoder
+        self.cache = cache
+
+    def __call__(self, input_ids, attention_mask):
+        keys = [text_encoder_cache_key(input_ids[i], attention_mask[i]) for i in range(input_ids.size(0))]
+        missing = [i for i, k in enumerate(keys) if k not in self.cache.entries]
+        self.cache.hits += len(keys) - len(missing)
+        self.cache.misses += len(missing)
+        if missing:
+            idx = torch.tensor(missing, device=input_ids.device)
+            with torch.no_grad():
+                emb = self.encoder(input_ids[idx], attention_mask[idx]).float().cpu().numpy()
+            for j, i in enumerate(missing):
+                self.cache.entries[keys[i]] = emb[j]
+        return torch.from_numpy(np.stack([self.cache.entries[k] for k in keys]))
+
+    def eval(self):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["encoder"], name)
+
+_QUANTIZED_ENCODERS = weakref.WeakKeyDictionary()  # fp32 model -> (fingerprint, int8 copy), so repeated calls quantize once
+_ONNX_ENCODERS = {}  # fingerprinted .onnx path -> OnnxTextEncoder
+_EMBEDDING_CACHES = {}
+_CACHE_SUSPENDED = [False]
+
+@contextlib.contextmanager
+def embedding_cache_suspended():
+    """prepare_text_encoder ignores cache_dir inside this block."""
+    _CACHE_SUSPENDED[0] = True
+    try:
+        yield
+    finally:
+        _CACHE_SUSPENDED[0] = False
+
+def prepare_text_encoder(model, backend, device, cache_dir=TEXT_ENCODER_CACHE, cache_tag=TEXT_ENCODER_CACHE_TAG):
+    """Returns (model, device) to use for embedding with the requested backend."""
+    if backend not in TEXT_ENCODER_BACKENDS:
+        raise ValueError(f"Unknown text encoder backend: {backend} (expected one of {TEXT_ENCODER_BACKENDS})")
+    use_cache = cache_dir and not _CACHE_SUSPENDED[0]
+    # int8 / onnx copies are tied to the weights they were made from; fine-tuned or merged weights get new ones.
+    fingerprint = weights_fingerprint(model) if backend != "fp32" or (use_cache and not cache_tag) else None
+    if backend == "fp32":
+        encoder = model.eval()
+    elif backend == "int8":
+        cached = _QUANTIZED_ENCODERS.get(model)
+        if cached is None or cached[0] != fingerprint:
+            cached = _QUANTIZED_ENCODERS[model] = (fingerprint, quantize_text_encoder(model))
+        encoder, device = cached[1], torch.device("cpu")
+    else:
+        onnx_path = onnx_path_for(fingerprint)
+        if onnx_path not in _ONNX_ENCODERS:
+            if not os.path.exists(onnx_path):
+                export_text_encoder_onnx(model, onnx_path)
+            _ONNX_ENCODERS[onnx_path] = OnnxTextEncoder(onnx_path, model)
+        encoder, device = _ONNX_ENCODERS[onnx_path], torch.device("cpu")
+    if use_cache:
+        key = (cache_dir, backend, cache_tag or fingerprint)
+        if key not in _EMBEDDING_CACHES:
+            if not _EMBEDDING_CACHES:
+                atexit.register(save_embedding_caches)
+            _EMBEDDING_CACHES[key] = EmbeddingCache(*key)
+        encoder = CachedTextEncoder(encoder, _EMBEDDING_CACHES[key])
+    return encoder, device
+
+def save_embedding_caches():
+    for cache in _EMBEDDING_CACHES.values():
+        if cache.misses == 0:
+            continue
+        cache.save()
+        print(f"Embedding cache {cache.path}: {len(cache.entries)} entries, {cache.hits} hits, {cache.misses} misses")
+
+def check_onnx_parity(model, onnx_path=TEXT_ENCODER_ONNX_PATH, batch_size=4, seq_len=128, atol=1e-3, seed=0):
+    """Runs the torch model and the ONNX graph on the same random token ids and compares the CLS vectors."""
+    torch.manual_seed(seed)
+    model = copy.deepcopy(model).to("cpu").eval()
+    base = getattr(model, "bert", None) or getattr(model, "BioBert", None)
+    vocab_size = base.config.vocab_size if base is not None else 28996
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_len))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[batch_size // 2:, seq_len // 2:] = 0  # half the rows padded
+    with torch.no_grad():
+        ref = model(input_ids, attention_mask).numpy()
+    out = OnnxTextEncoder(onnx_path)(input_ids, attention_mask).numpy()
+    max_abs = float(np.max(np.abs(ref - out)))
+    cos = cosine_similarity_report(ref, out)
+    print(f"ONNX parity: max |diff| {max_abs:.2e}, min cosine {cos['min']:.6f}")
+    if max_abs > atol:
+        raise AssertionError(f"ONNX output differs from torch by {max_abs:.2e} (> {atol})")
+    return max_abs
+
+def cosine_similarity_report(emb_ref, emb_test):
+    """Row-wise cosine similarity between two embedding matrices (rows with a zero vector are skipped)."""
+    ref_norm = np.linalg.norm(emb_ref, axis=1)
+    test_norm = np.linalg.norm(emb_test, axis=1)
+    valid = (ref_norm > 0) & (test_norm > 0)
+    cos = np.sum(emb_ref[valid] * emb_test[valid], axis=1) / (ref_norm[valid] * test_norm[valid])
+    return {"mean": float(np.mean(cos)), "min": float(np.min(cos)), "p05": float(np.percentile(cos, 5)),
+            "n": int(valid.sum())}
+
+def compute_eddi(y_true, y_pred, sensitive_labels, threshold=0.5):
+    y_pred_binary = (np.array(y_pred) > threshold).astype(int)
+    unique_groups = np.unique(sensitive_labels)
+    overall_error = np.mean(y_pred_binary != y_true)
+    denom = max(overall_error, 1 - overall_error) if overall_error not in [0, 1] else 1.0
+    subgroup_eddi = []
+    for group in unique_groups:
+        mask = (sensitive_labels == group)
+        er_group = np.mean(y_pred_binary[mask] != y_true[mask])
+        subgroup_eddi.append((er_group - overall_error) / denom)
+    return np.sqrt(np.sum(np.array(subgroup_eddi) ** 2)) / len(unique_groups)
+
+def downstream_delta(embeddings, labels, sensitive, train_idx, val_idx, threshold=0.5):
+    """
+    Fits a logistic-regression probe per outcome on the train rows of each embedding set and reports
+    validation AUROC and combined EDDI (sqrt of summed squared attribute EDDIs / #attributes).
+    embeddings: {"fp32": array, "<backend>": array}; labels: {outcome: array}; sensitive: {attr: array}.
+    """
+    rows = []
+    for outcome, y in labels.items():
+        row = {"outcome": outcome}
+        for name, emb in embeddings.items():
+            clf = LogisticRegression(max_iter=2000, class_weight="balanced")
+            clf.fit(emb[train_idx], y[train_idx])
+            probs = clf.predict_proba(emb[val_idx])[:, 1]
+            try:
+                row[f"auroc_{name}"] = roc_auc_score(y[val_idx], probs)
+            except ValueError:
+                row[f"auroc_{name}"] = float("nan")
+            eddis = [compute_eddi(y[val_idx], probs, attr[val_idx], threshold) for attr in sensitive.values()]
+            row[f"eddi_{name}"] = np.sqrt(np.sum(np.array(eddis) ** 2)) / len(eddis)
+        for name in embeddings:
+            if name != "fp32":
+                row[f"auroc_delta_{name}"] = row[f"auroc_{name}"] - row["auroc_fp32"]
+                row[f"eddi_delta_{name}"] = row[f"eddi_{name}"] - row["eddi_fp32"]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def check_text_encoder_backend(apply_fn, df, note_columns, tokenizer, model, device, backend="int8",
+                               label_columns=("short_term_mortality", "los_binary", "mechanical_ventilation"),
+                               sensitive_columns=None, val_size=0.2, out_file=None, **apply_kwargs):
+    """
+    Accuracy and throughput check of `backend` against fp32 on the same notes.
+    apply_fn is the calling script's apply_bioclinicalbert_on_patient_notes; its rows follow
+    df["subject_id"].unique(), so labels/sensitive attributes are taken from each patient's first row.
+    The embedding cache is bypassed so both backends are actually run and timed.
+    """
+    results = {}
+    timings = {}
+    for name in ["fp32", backend]:
+        start = time.time()
+        with embedding_cache_suspended():
+            out = apply_fn(df, note_columns, tokenizer, model, device, backend=name, **apply_kwargs)
+        timings[name] = time.time() - start
+        results[name] = out[0] if isinstance(out, tuple) else out
+    patients = df.groupby("subject_id", sort=False).first()
+    n = len(patients)
+    cos = cosine_similarity_report(results["fp32"], results[backend])
+    print(f"\n--- Text encoder check: {backend} vs fp32 ({n} patients) ---")
+    print(f"Embedding time: fp32 {timings['fp32']:.1f}s, {backend} {timings[backend]:.1f}s "
+          f"(speedup {timings['fp32'] / max(timings[backend], 1e-9):.2f}x)")
+    print(f"Cosine similarity: mean {cos['mean']:.4f}, p05 {cos['p05']:.4f}, min {cos['min']:.4f}")
+
+    labels = {col: patients[col].values.astype(int) for col in label_columns if col in patients.columns}
+    if sensitive_columns is None:
+        sensitive_columns = [c for c in patients.columns if c.lower() in ("age_bucket", "ethnicity_category", "insurance_category",
+                                                                          "ethnicity", "insurance")]
+    sensitive = {col: patients[col].astype(str).values for col in sensitive_columns}
+    if "age" in patients.columns and "age" not in sensitive and pd.api.types.is_numeric_dtype(patients["age"]):
+        sensitive["age"] = pd.cut(patients["age"], bins=[-np.inf, 29, 49, 69, np.inf]).astype(str).values
+    if not labels or not sensitive:
+        print("No label or sensitive columns found; skipping downstream AUROC/EDDI check.")
+        return cos, None
+    stratify = next(iter(labels.values()))
+    train_idx, val_idx = train_test_split(np.arange(n), test_size=val_size, random_state=42, stratify=stratify)
+    report = downstream_delta(results, labels, sensitive, train_idx, val_idx)
+    report["cosine_mean"] = cos["mean"]
+    report["speedup"] = timings["fp32"] / max(timings[backend], 1e-9)
+    print(report.to_string(index=False))
+    if out_file is not None:
+        report.to_csv(out_file, index=False)
+    return cos, report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / verify the ONNX Bio_ClinicalBERT CLS encoder.")
+    parser.add_argument("command", choices=["export-onnx", "parity"])
+    parser.add_argument("--out", default=TEXT_ENCODER_ONNX_PATH)
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    from transformers import AutoModel
+    encoder = CLSExtractor(AutoModel.from_pretrained(BIOCLINICALBERT_NAME))
+    if args.command == "export-onnx":
+        export_text_encoder_onnx(encoder, args.out, opset=args.opset)
+    check_onnx_parity(encoder, args.out)
@@ -0,0 +1,456 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import subprocess
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from synthetic_mimic import SyntheticMimicGenerator, load_01_data
+
+# End-to-end benchmark suite at fixed synthetic scales (see synthetic_mimic.py).
+# Every stage has an untimed setup and a timed run; wall time and peak RSS (sampled every 10 ms,
+# plus CUDA peak allocation when a GPU is used) are measured around the run only.
+#   load_tables   - pd.read_csv of the raw tables 01_Data.py reads
+#   vent_flags    - calculate_mechanical_ventilation()
+#   binning       - load_and_aggregate_feature_data() for every Feature Set C table (24h, 2-h bins)
+#   notes         - notes window + concat, preprocessing() and 512-token chunking
+#   notes_stream  - notes_stream.py: the same window, per-note chunk records streamed from NOTEEVENTS blocks
+#   note_dedup    - note_dedup.py: per-patient and global MinHash/LSH near-duplicate flags of those records
+#   cls_embedding - apply_bioclinicalbert_on_patient_notes() (TEXT_ENCODER_BACKEND applies)
+#   train_fame / train_dfc / train_eddi - one training epoch of FAME.py, 03_DfC.py, 08_eddi.py
+#   fairness_eval - FAME evaluate_model_multi with bootstrap CIs and intersectional cells
+# Results are appended to a JSON history keyed by git commit; each new result is compared with the
+# latest result of the same stage and scale from another commit, and slowdowns above --threshold are flagged.
+# By default every stage runs in its own process so peak memory is not shared between stages.
+# Usage: python benchmark.py --scale small [--stages vent_flags binning] [--in_process]
+
+BENCH_DIR = "benchmarks"
+HISTORY_FILE = "benchmark_history.json"
+SCALES = {"small": 1000, "medium": 10000, "large": 100000, "xlarge": 1000000}
+FINAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Final")
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=here, stderr=subprocess.DEVNULL) != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class MemorySampler(object):
+    """
+    Peak resident memory while the block runs, sampled from a background thread. Without a with block,
+    start() / close() bound the sampling and reset() restarts the peak (per optimizer step in activation_memory.py).
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start_mb = 0.0
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self.start_mb = self.peak_mb = current_rss_mb()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def reset(self):
+        self.peak_mb = current_rss_mb()
+
+    def peak(self):
+        return max(self.peak_mb, current_rss_mb())
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.peak_mb = self.peak()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+@contextlib.contextmanager
+def in_dir(path):
+    """01_Data.py reads and writes relative to the working directory."""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def load_script(name):
+    """A numbered Final/ script as a module (its pipeline only runs under __main__)."""
+    path = os.path.join(FINAL_DIR, name)
+    module_name = "bench_" + os.path.splitext(name)[0].replace("-", "_")
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+class BenchContext(object):
+    def __init__(self, scale, bench_dir=BENCH_DIR, batch_size=16, lab_features=100, embed_patients=200, seed=42):
+        self.scale = scale
+        self.n_patients = SCALES[scale]
+        self.data_dir = os.path.abspath(os.path.join(bench_dir, f"mimic_{scale}"))
+        self.batch_size = batch_size
+        self.lab_features = lab_features
+        self.embed_patients = embed_patients
+        self.seed = seed
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = load_01_data()
+        return self._data
+
+    def ensure_data(self):
+        if not os.path.exists(os.path.join(self.data_dir, "synthetic_manifest.json")):
+            print(f"Generating synthetic MIMIC-III tables for {self.n_patients} patients in {self.data_dir}")
+            SyntheticMimicGenerator(self.data_dir, seed=self.seed).generate(self.n_patients)
+        return self.data_dir
+
+    def device(self):
+        import torch
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def feature_arrays(self):
+        """Arrays shaped like FAME.prepare_experiment_data's output, one row per synthetic patient."""
+        rng = np.random.default_rng(self.seed)
+        n = self.n_patients
+        return {
+            "age_ids": rng.integers(0, 4, n), "gender_ids": rng.integers(0, 2, n),
+            "ethnicity_ids": rng.integers(0, 5, n), "insurance_ids": rng.integers(0, 5, n),
+            "lab_features": rng.standard_normal((n, self.lab_features)).astype(np.float32),
+            "text_embeddings": rng.standard_normal((n, 768)).astype(np.float32),
+            "labels": (rng.random((n, 3)) < [0.1, 0.35, 0.45]).astype(np.float32),
+        }
+
+    def notes_frame(self):
+        """Concatenated first-ICU-stay notes per patient, as build_unstructured_dataset builds them."""
+        notes = pd.read_csv("NOTEEVENTS.csv.gz", compression="gzip", low_memory=False,
+                            usecols=["SUBJECT_ID", "HADM_ID", "CHARTDATE", "TEXT"])
+        stays = pd.read_csv("ICUSTAYS.csv.gz", compression="gzip", usecols=["SUBJECT_ID", "HADM_ID", "INTIME", "OUTTIME"])
+        notes["CHARTDATE"] = pd.to_datetime(notes["CHARTDATE"], format="%Y-%m-%d", errors="coerce")
+        stays["INTIME"] = pd.to_datetime(stays["INTIME"])
+        stays["OUTTIME"] = pd.to_datetime(stays["OUTTIME"])
+        first = stays.sort_values("INTIME").groupby("SUBJECT_ID").first().reset_index()
+        merged = notes[notes["HADM_ID"].isin(first["HADM_ID"])].merge(first, on=["SUBJECT_ID", "HADM_ID"])
+        merged = merged[(merged["CHARTDATE"] >= merged["INTIME"]) & (merged["CHARTDATE"] <= merged["OUTTIME"])]
+        notes_agg = merged.groupby(["SUBJECT_ID", "HADM_ID"]).agg({"TEXT": lambda texts: " ".join(texts)}).reset_index()
+        return notes_agg.rename(columns={"SUBJECT_ID": "subject_id", "HADM_ID": "hadm_id"})
+
+# ---- stages: stage(ctx) does the untimed setup and returns run(); run() is timed and returns the items processed ----
+
+def stage_load_tables(ctx):
+    tables = ["ADMISSIONS", "PATIENTS", "ICUSTAYS", "CHARTEVENTS", "LABEVENTS", "inputevents_cv",
+              "inputevents_mv", "OUTPUTEVENTS", "PRESCRIPTIONS", "NOTEEVENTS"]
+    def run():
+        return sum(len(pd.read_csv(f"{t}.csv.gz", compression="gzip", low_memory=False)) for t in tables)
+    return run
+
+def stage_vent_flags(ctx):
+    def run():
+        return len(ctx.data.calculate_mechanical_ventilation())
+    return run
+
+def stage_binning(ctx):
+    icu_stays = pd.read_csv("ICUSTAYS.csv.gz", compression="gzip", usecols=["SUBJECT_ID", "HADM_ID", "INTIME", "OUTTIME"])
+    icu_stays.columns = icu_stays.columns.str.lower()
+    icu_stays["intime"] = pd.to_datetime(icu_stays["intime"])
+    icu_stays["outtime"] = pd.to_datetime(icu_stays["outtime"])
+    icu_stays = icu_stays[(icu_stays["outtime"] - icu_stays["intime"]).dt.total_seconds() / 3600 >= 30]
+    filtered_subjects = set(icu_stays["subject_id"].unique())
+    def run():
+        rows = 0
+        for table, files in ctx.data.input_files.items():
+            aggregated = ctx.data.load_and_aggregate_feature_data(files, table, filtered_subjects, icu_stays)
+            rows += 0 if aggregated is None else len(aggregated)
+        return rows
+    return run
+
+def stage_notes(ctx):
+    def run():
+        notes_agg = ctx.data.preprocessing(ctx.notes_frame())
+        chunks = notes_agg["TEXT"].apply(ctx.data.split_into_512_token_columns)
+        return int(chunks.notnull().values.sum())
+    return run
+
+def stage_notes_stream(ctx):
+    from notes_stream import iter_note_chunks
+    def run():
+        return sum(len(records) for records in iter_note_chunks())
+    return run
+
+def stage_note_dedup(ctx):
+    from notes_stream import iter_note_chunks
+    from note_dedup import flag_duplicates
+    records = pd.concat(list(iter_note_chunks()), ignore_index=True)
+    def run():
+        return int(flag_duplicates(records)[0]["representative"].nunique())
+    return run
+
+def stage_cls_embedding(ctx):
+    import torch
+    from transformers import AutoTokenizer, BertModel
+    fame = load_script("FAME.py")
+    notes_agg = ctx.data.preprocessing(ctx.notes_frame().head(ctx.embed_patients))
+    df = pd.concat([notes_agg[["subject_id"]], notes_agg["TEXT"].apply(ctx.data.split_into_512_token_columns)], axis=1)
+    note_columns = [c for c in df.columns if c.startswith("note_")]
+    device = ctx.device()
+    tokenizer = AutoTokenizer.from_pretrained("emilyalsentzer/Bio_ClinicalBERT")
+    base = BertModel.from_pretrained("emilyalsentzer/Bio_ClinicalBERT")
+    model = fame.BioClinicalBERT_FT(base, base.config, device).to(device)
+    model.eval()
+    def run():
+        with torch.no_grad():
+            embeddings = fame.apply_bioclinicalbert_on_patient_notes(df, note_columns, tokenizer, model, device)
+        return len(embeddings)
+    return run
+
+def fame_model(ctx, fame, device):
+    from lab_encoder import build_lab_encoder
+    behrt_demo = fame.BEHRTModel_Demo(num_ages=4, num_genders=2, num_ethnicities=5, num_insurances=5, hidden_size=768).to(device)
+    behrt_lab = build_lab_encoder(fame.BEHRTModel_Lab, lab_token_count=ctx.lab_features, hidden_size=768,
+                                  nhead=8, num_layers=2).to(device)
+    return fame.MultimodalTransformer_EDDI_Sigmoid(text_embed_size=768, behrt_demo=behrt_demo, behrt_lab=behrt_lab,
+                                                   device=device, fusion_hidden=512, beta=1.0).to(device)
+
+def fame_loader(ctx, device, shuffle=True):
+    import torch
+    from torch.utils.data import TensorDataset
+    from batch_loader import BatchLoader
+    a = ctx.feature_arrays()
+    n = ctx.n_patients
+    dataset = TensorDataset(torch.zeros((n, 1), dtype=torch.long), torch.ones((n, 1), dtype=torch.long),
+                            torch.tensor(a["age_ids"]), torch.tensor(a["gender_ids"]),
+                            torch.tensor(a["ethnicity_ids"]), torch.tensor(a["insurance_ids"]),
+                            torch.tensor(a["lab_features"]), torch.tensor(a["text_embeddings"]),
+                            torch.tensor(a["labels"]))
+    return BatchLoader(dataset, batch_size=ctx.batch_size, shuffle=shuffle, device=device)
+
+def stage_train_fame(ctx):
+    import torch
+    from torch.optim import AdamW
+    fame = load_script("FAME.py")
+    device = ctx.device()
+    model = fame_model(ctx, fame, device)
+    loader = fame_loader(ctx, device)
+    optimizer = AdamW(model.parameters(), lr=2e-5, weight_decay=0.01)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    def run():
+        fame.train_step(model, loader, optimizer, device, criterion)
+        return ctx.n_patients
+    return run
+
+def stage_train_dfc(ctx):
+    import torch
+    from torch.optim import AdamW
+    from torch.utils.data import TensorDataset
+    from batch_loader import BatchLoader
+    dfc = load_script("03_DfC.py")
+    device = ctx.device()
+    a = ctx.feature_arrays()
+    n = ctx.n_patients
+    rng = np.random.default_rng(ctx.seed)
+    labels = torch.tensor(a["labels"])
+    dataset = TensorDataset(torch.zeros((n, 1), dtype=torch.long), torch.ones((n, 1), dtype=torch.long),
+                            torch.tensor(rng.integers(0, 2, n)), torch.tensor(rng.integers(0, 9, n)),
+                            torch.tensor(rng.integers(0, 15, n)), torch.tensor(a["text_embeddings"]),
+                            labels[:, 0], labels[:, 1], labels[:, 2], torch.tensor(a["age_ids"]),
+                            torch.tensor(a["ethnicity_ids"]), torch.tensor(a["insurance_ids"]))
+    loader = BatchLoader(dataset, batch_size=ctx.batch_size, shuffle=True, device=device)
+    behrt = dfc.BEHRTModel_DfC(num_diseases=1, num_segments=2, num_admission_locs=9, num_discharge_locs=15, hidden_size=768).to(device)
+    model = dfc.MultimodalTransformer_DfC(text_embed_size=768, BEHRT=behrt, device=device, hidden_size=512).to(device)
+    optimizer = AdamW(model.parameters(), lr=2e-5, weight_decay=0.01)
+    crit = [dfc.FocalLoss(gamma=1, reduction="mean") for _ in range(3)]
+    def run():
+        dfc.train_step(model, loader, optimizer, device, *crit)
+        return n
+    return run
+
+def stage_train_eddi(ctx):
+    import torch
+    from torch.optim import AdamW
+    from torch.utils.data import TensorDataset
+    from batch_loader import BatchLoader
+    from lab_encoder import build_lab_encoder
+    eddi = load_script("08_eddi.py")
+    device = ctx.device()
+    a = ctx.feature_arrays()
+    n = ctx.n_patients
+    labels = torch.tensor(a["labels"])
+    dataset = TensorDataset(torch.zeros((n, 1), dtype=torch.long), torch.ones((n, 1), dtype=torch.long),
+                            torch.tensor(a["age_ids"]), torch.tensor(a["gender_ids"]),
+                            torch.tensor(a["ethnicity_ids"]), torch.tensor(a["insurance_ids"]),
+                            torch.tensor(a["lab_features"]), torch.tensor(a["text_embeddings"]),
+                            labels[:, 0], labels[:, 1], labels[:, 2])
+    loader = BatchLoader(dataset, batch_size=ctx.batch_size, shuffle=True, device=device)
+    behrt_demo = eddi.BEHRTModel_Demo(num_ages=4, num_genders=2, num_ethnicities=5, num_insurances=5, hidden_size=768).to(device)
+    behrt_lab = build_lab_encoder(eddi.BEHRTModel_Lab, lab_token_count=ctx.lab_features, hidden_size=768,
+                                  nhead=8, num_layers=2).to(device)
+    model = eddi.MultimodalTransformer(text_embed_size=768, behrt_demo=behrt_demo, behrt_lab=behrt_lab, device=device, beta=0.3).to(device)
+    # 08_eddi.py defines its criteria as module globals inside train_pipeline.
+    eddi.criterion_mortality = eddi.FocalLoss(gamma=1, reduction="mean")
+    eddi.criterion_los = eddi.FocalLoss(gamma=1, reduction="mean")
+    eddi.criterion_mech = eddi.FocalLoss(gamma=1, reduction="mean")
+    optimizer = AdamW(model.parameters(), lr=2e-5, weight_decay=0.01)
+    def run():
+        eddi.train_step(model, loader, optimizer, device)
+        return n
+    return run
+
+def stage_fairness_eval(ctx):
+    fame = load_script("FAME.py")
+    from bootstrap_ci import BOOTSTRAP_SAMPLES
+    device = ctx.device()
+    model = fame_model(ctx, fame, device)
+    loader = fame_loader(ctx, device, shuffle=False)
+    def run():
+        fame.evaluate_model_multi(model, loader, device, thresholds=0.5, bootstrap=BOOTSTRAP_SAMPLES, intersectional=True)
+        return ctx.n_patients
+    return run
+
+STAGES = {
+    "load_tables": stage_load_tables,
+    "vent_flags": stage_vent_flags,
+    "binning": stage_binning,
+    "notes": stage_notes,
+    "notes_stream": stage_notes_stream,
+    "note_dedup": stage_note_dedup,
+    "cls_embedding": stage_cls_embedding,
+    "train_fame": stage_train_fame,
+    "train_dfc": stage_train_dfc,
+    "train_eddi": stage_train_eddi,
+    "fairness_eval": stage_fairness_eval,
+}
+
+def run_stage(name, ctx):
+    """Runs one stage in this process and returns its result record."""
+    if FINAL_DIR not in sys.path:
+        sys.path.append(FINAL_DIR)
+    ctx.ensure_data()
+    with in_dir(ctx.data_dir):
+        run = STAGES[name](ctx)
+        cuda = None
+        if "torch" in sys.modules and sys.modules["torch"].cuda.is_available():
+            cuda = sys.modules["torch"].cuda
+            cuda.reset_peak_memory_stats()
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            items = run()
+            if cuda is not None:
+                cuda.synchronize()
+            seconds = time.perf_counter() - start
+    return {"stage": name, "scale": ctx.scale, "n_patients": ctx.n_patients, "seconds": round(seconds, 4),
+            "items": int(items), "items_per_s": round(items / seconds, 2) if seconds > 0 else None,
+            "rss_start_mb": round(memory.start_mb, 1), "peak_rss_mb": round(memory.peak_mb, 1),
+            "peak_delta_mb": round(memory.peak_mb - memory.start_mb, 1),
+            "cuda_peak_mb": round(cuda.max_memory_allocated() / 2 ** 20, 1) if cuda is not None else None}
+
+def run_stage_isolated(name, args):
+    """Runs one stage in a fresh interpreter so its peak RSS is its own."""
+    cmd = [sys.executable, os.path.abspath(__file__), "--scale", args.scale, "--stages", name, "--in_process",
+           "--bench_dir", args.bench_dir, "--batch_size", str(args.batch_size), "--lab_features", str(args.lab_features),
+           "--embed_patients", str(args.embed_patients), "--seed", str(args.seed), "--json_only"]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    lines = [line for line in out.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if out.returncode != 0 or not lines:
+        return {"stage": name, "scale": args.scale, "n_patients": SCALES[args.scale], "error": f"exit code {out.returncode}"}
+    return json.loads(lines[-1][len(RESULT_PREFIX):])
+
+def append_history(records, history_file=HISTORY_FILE, threshold=0.2):
+    """Adds the records to the JSON history and reports the change against the last run of another commit."""
+    history = []
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            history = json.load(f)
+    commit = git_commit()
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    print(f"\n--- Benchmark results ({commit}) ---")
+    for record in records:
+        record.update({"commit": commit, "time": stamp})
+        if "error" in record:
+            print(f"  {record['stage']:<14} FAILED ({record['error']})")
+            continue
+        previous = [r for r in history if r["stage"] == record["stage"] and r["scale"] == record["scale"]
+                    and r["commit"] != commit and "error" not in r]
+        line = f"  {record['stage']:<14} {record['seconds']:>9.2f}s  peak {record['peak_rss_mb']:>8.0f} MB"
+        if previous:
+            base = previous[-1]
+            change = record["seconds"] / base["seconds"] - 1 if base["seconds"] > 0 else 0.0
+            line += f"  {change:+.1%} time, {record['peak_rss_mb'] - base['peak_rss_mb']:+.0f} MB vs {base['commit']}"
+            if change > threshold:
+                line += "  <-- REGRESSION"
+        print(line)
+    history.extend(records)
+    with open(history_file, "w") as f:
+        json.dump(history, f, indent=2)
+    print("History written to", history_file)
+    return records
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory-profile the data, embedding, training and fairness stages.")
+    parser.add_argument("--scale", choices=list(SCALES.keys()), default="small")
+    parser.add_argument("--stages", nargs="+", default=["all"], help=f"Any of {list(STAGES.keys())} or 'all'.")
+    parser.add_argument("--bench_dir", default=BENCH_DIR, help="Synthetic data per scale is generated here once and reused.")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown reported as a regression.")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--lab_features", type=int, default=100)
+    parser.add_argument("--embed_patients", type=int, default=200, help="Patients encoded by the cls_embedding stage.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--in_process", action="store_true", help="Run all stages in this process instead of one process each.")
+    parser.add_argument("--json_only", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    stages = list(STAGES.keys()) if args.stages == ["all"] else args.stages
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"Unknown stages {unknown}; choose from {list(STAGES.keys())}")
+    ctx = BenchContext(args.scale, bench_dir=args.bench_dir, batch_size=args.batch_size, lab_features=args.lab_features,
+                       embed_patients=args.embed_patients, seed=args.seed)
+    ctx.ensure_data()
+    records = []
+    for name in stages:
+        if args.in_process:
+            record = run_stage(name, ctx)
+        else:
+            print(f"Running {name} ({args.scale}, {ctx.n_patients} patients)...")
+            record = run_stage_isolated(name, args)
+        if args.json_only:
+            print(RESULT_PREFIX + json.dumps(record))
+        records.append(record)
+    if not args.json_only:
+        append_history(records, args.history, args.threshold)
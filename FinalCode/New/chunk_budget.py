@@ -0,0 +1,225 @@
+import sys
+import time
+import zlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from benchmark import in_dir, FINAL_DIR
+from notes_stream import KEYS, read_note_chunks, build_unstructured_dataset
+
+# Per-admission chunk budget for the note chunk records of notes_stream.py. Every chunk that reaches a training
+# script is embedded (one padded 512-token Bio_ClinicalBERT pass), so long stays with dozens of chunks dominate
+# embedding time. ChunkBudget keeps at most max_chunks chunks (and / or max_tokens tokens) per admission:
+#   score = category priority x 0.5 ** (hours before the admission's latest note / half_life_hours)
+# chunks are taken in score order, skipping a chunk whose MinHash estimate of word-shingle Jaccard similarity
+# with an already kept chunk of the admission is >= dedup_threshold (copy-forwarded / templated text), and
+# the kept chunks are returned in note order. budget_report gives the chunks and tokens saved and the
+# per-admission maximum (the embedding cost bound); evaluate_budget embeds all chunks, the kept chunks, and the
+# kept chunks through note_dedup's CachedEncoder (one BERT pass per near-duplicate cluster), and compares AUROC
+# of a logistic-regression probe on the mean CLS vector per outcome.
+# Usage: python chunk_budget.py --data_dir . --records note_chunks.csv.gz --max_chunks 16 --out budget_chunks.csv.gz
+#        [--wide unstructured_with_demographics.csv] [--evaluate --max_patients 2000]
+OUTCOME_COLUMNS = ["short_term_mortality", "los_binary", "mechanical_ventilation"]
+# MIMIC-III NOTEEVENTS categories (compared without surrounding spaces); unlisted categories get DEFAULT_PRIORITY.
+CATEGORY_PRIORITY = {"Physician": 1.0, "Nursing": 0.9, "Consult": 0.8, "Respiratory": 0.7, "Nursing/other": 0.7,
+                     "Radiology": 0.6, "General": 0.5, "Echo": 0.5, "Nutrition": 0.4, "Pharmacy": 0.4,
+                     "Rehab Services": 0.4, "ECG": 0.3, "Case Management": 0.3, "Social Work": 0.3,
+                     "Discharge summary": 0.2}
+DEFAULT_PRIORITY = 0.5
+MINHASH_PRIME = (1 << 61) - 1
+
+def shingle_hashes(text, shingle=5):
+    """crc32 of every `shingle`-word window of a text (the whole text when it is shorter)."""
+    tokens = text.split()
+    windows = {" ".join(tokens[i:i + shingle]) for i in range(max(1, len(tokens) - shingle + 1))}
+    return np.fromiter((zlib.crc32(w.encode("utf-8")) for w in windows), dtype=np.uint64, count=len(windows))
+
+class MinHasher(object):
+    def __init__(self, num_perm=64, shingle=5, seed=1):
+        """(a x + b) mod MINHASH_PRIME per permutation; a, b < 2^29 and x < 2^32 keep a x + b below 2^62 in uint64."""
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 29, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 29, num_perm, dtype=np.uint64)
+        self.shingle = shingle
+
+    def signature(self, text):
+        hashes = shingle_hashes(text, self.shingle)
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+def similarity(sig_a, sig_b):
+    """MinHash estimate of the Jaccard similarity of two shingle sets."""
+    return float(np.mean(sig_a == sig_b))
+
+class ChunkBudget(object):
+    def __init__(self, max_chunks=16, max_tokens=None, category_priority=CATEGORY_PRIORITY, half_life_hours=48.0,
+                 dedup_threshold=0.8, num_perm=64, shingle=5):
+        """max_chunks / max_tokens of None are unlimited; half_life_hours None ignores recency, dedup_threshold None keeps duplicates."""
+        self.max_chunks = max_chunks
+        self.max_tokens = max_tokens
+        self.category_priority = category_priority
+        self.half_life_hours = half_life_hours
+        self.dedup_threshold = dedup_threshold
+        self.hasher = MinHasher(num_perm, shingle)
+
+    def score(self, records):
+        priority = records["category"].astype(str).str.strip().map(self.category_priority).fillna(DEFAULT_PRIORITY)
+        if self.half_life_hours is None:
+            return priority
+        note_time = pd.to_datetime(records["charttime"]).fillna(pd.to_datetime(records["chartdate"]))
+        hours_before_last = (note_time.groupby([records[k] for k in KEYS]).transform("max") - note_time).dt.total_seconds() / 3600
+        return priority * 0.5 ** (hours_before_last.fillna(0) / self.half_life_hours)
+
+    def select(self, records):
+        """The kept records in note order, and the number of chunks skipped as near-duplicates."""
+        records = records.assign(score=self.score(records).to_numpy())
+        records = records.sort_values(KEYS + ["score", "row_id", "chunk_index"], ascending=[True, True, False, False, True],
+                                      kind="stable")
+        keep = np.zeros(len(records), dtype=bool)
+        duplicates = 0
+        offsets = np.flatnonzero(np.r_[True, (records[KEYS].to_numpy()[1:] != records[KEYS].to_numpy()[:-1]).any(axis=1)])
+        bounds = np.r_[offsets, len(records)]
+        texts = records["text"].to_numpy()
+        n_tokens = records["n_tokens"].to_numpy()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            kept_signatures = []
+            tokens = 0
+            for i in range(start, end):
+                if self.max_chunks is not None and len(kept_signatures) >= self.max_chunks:
+                    break
+                if self.max_tokens is not None and tokens + n_tokens[i] > self.max_tokens:
+                    continue
+                signature = self.hasher.signature(texts[i]) if self.dedup_threshold is not None else None
+                if signature is not None and any(similarity(signature, s) >= self.dedup_threshold for s in kept_signatures):
+                    duplicates += 1
+                    continue
+                keep[i] = True
+                kept_signatures.append(signature)
+                tokens += n_tokens[i]
+        selected = records[keep].drop(columns=["score"]).sort_values(KEYS + ["row_id", "chunk_index"], kind="stable")
+        return selected.reset_index(drop=True), duplicates
+
+def per_admission(records):
+    return records.groupby(KEYS).agg(chunks=("text", "size"), tokens=("n_tokens", "sum"))
+
+def budget_report(records, selected, duplicates=0):
+    """Chunks and tokens before / after the budget, and the per-admission spread that bounds embedding cost."""
+    before, after = per_admission(records), per_admission(selected)
+    report = {"admissions": len(before), "chunks_before": int(before["chunks"].sum()), "chunks_after": int(after["chunks"].sum()),
+              "tokens_before": int(before["tokens"].sum()), "tokens_after": int(after["tokens"].sum()),
+              "near_duplicates_skipped": int(duplicates),
+              "max_chunks_before": int(before["chunks"].max()) if len(before) else 0,
+              "max_chunks_after": int(after["chunks"].max()) if len(after) else 0,
+              "p99_chunks_before": float(before["chunks"].quantile(0.99)) if len(before) else 0.0,
+              "p99_chunks_after": float(after["chunks"].quantile(0.99)) if len(after) else 0.0}
+    # apply_bioclinicalbert_on_patient_notes pads every chunk to 512 tokens, so BERT compute follows the chunk count.
+    report["embedding_compute_saved"] = 1 - report["chunks_after"] / max(report["chunks_before"], 1)
+    print(f"Chunks {report['chunks_before']} -> {report['chunks_after']} "
+          f"({report['embedding_compute_saved']:.1%} of the embedding passes saved), "
+          f"tokens {report['tokens_before']} -> {report['tokens_after']}, {duplicates} near-duplicates skipped")
+    print(f"Chunks per admission: max {report['max_chunks_before']} -> {report['max_chunks_after']}, "
+          f"p99 {report['p99_chunks_before']:.0f} -> {report['p99_chunks_after']:.0f}")
+    return report
+
+def patient_embeddings(encoder, records, patients, dedup_threshold=None):
+    """
+    Mean CLS vector of each patient's chunks (zeros without chunks), as the training scripts aggregate them, and
+    the number of chunks sent to the encoder. With dedup_threshold the chunks go through note_dedup: a patient's
+    repeated chunks are dropped and near-duplicates across patients reuse one embedding (CachedEncoder).
+    """
+    index = {p: i for i, p in enumerate(patients)}
+    records = records[records["subject_id"].isin(index)].sort_values(["subject_id", "row_id", "chunk_index"], kind="stable")
+    encoded = len(records)
+    if dedup_threshold is not None and len(records):
+        from note_dedup import flag_duplicates, CachedEncoder
+        records, _, _ = flag_duplicates(records, threshold=dedup_threshold)
+        records = records[~records["patient_duplicate"]]
+        cached = CachedEncoder(encoder)
+        chunk_embeddings = cached.encode_records(records)
+        encoded = cached.misses
+    elif len(records):
+        chunk_embeddings = encoder.encode(records["text"].tolist())
+    out = np.zeros((len(patients), chunk_embeddings.shape[1] if len(records) else 768), dtype=np.float32)
+    if len(records):
+        owners = records["subject_id"].map(index).to_numpy()
+        np.add.at(out, owners, chunk_embeddings)
+        counts = np.bincount(owners, minlength=len(patients))
+        out[counts > 0] /= counts[counts > 0, None]
+    return out, encoded
+
+def evaluate_budget(records, selected, structured_file="final_structured_dataset.csv", max_patients=None, seed=42,
+                    test_size=0.3, dedup_threshold=0.8):
+    """
+    Embeds all chunks, the budgeted chunks and the budgeted chunks with near-duplicate embeddings reused
+    (note_dedup); returns embedding time, BERT passes and test AUROC of a logistic probe per outcome.
+    """
+    import torch
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import roc_auc_score
+    from sklearn.model_selection import train_test_split
+    if FINAL_DIR not in sys.path:
+        sys.path.append(FINAL_DIR)
+    from scoring_service import NoteEncoder
+
+    structured = pd.read_csv(structured_file).drop_duplicates("subject_id").set_index("subject_id")
+    if "los_binary" not in structured.columns:
+        structured["los_binary"] = (structured["icu_los"] > 72).astype(int)
+    patients = sorted(set(records["subject_id"]) & set(structured.index))
+    if max_patients and len(patients) > max_patients:
+        patients = sorted(np.random.default_rng(seed).choice(patients, max_patients, replace=False).tolist())
+    labels = structured.loc[patients, OUTCOME_COLUMNS].fillna(0).astype(int).to_numpy()
+    train_idx, test_idx = train_test_split(np.arange(len(patients)), test_size=test_size, random_state=seed,
+                                           stratify=labels[:, 0] if labels[:, 0].min() != labels[:, 0].max() else None)
+    encoder = NoteEncoder(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+    results = {}
+    variants = (("all", records, None), ("budget", selected, None), ("dedup", selected, dedup_threshold))
+    for name, chunks, threshold in variants:
+        start = time.perf_counter()
+        embeddings, encoded = patient_embeddings(encoder, chunks, patients, threshold)
+        seconds = time.perf_counter() - start
+        results[name] = {"chunks_embedded": int(encoded), "embedding_s": round(seconds, 2)}
+        for j, outcome in enumerate(OUTCOME_COLUMNS):
+            y_train, y_test = labels[train_idx, j], labels[test_idx, j]
+            if y_train.min() == y_train.max() or y_test.min() == y_test.max():
+                results[name][outcome] = None
+                continue
+            probe = LogisticRegression(max_iter=2000, class_weight="balanced").fit(embeddings[train_idx], y_train)
+            results[name][outcome] = round(float(roc_auc_score(y_test, probe.predict_proba(embeddings[test_idx])[:, 1])), 4)
+    print(f"\n{len(patients)} patients, probe AUROC on {len(test_idx)} test patients:")
+    for name, _, _ in variants:
+        r = results[name]
+        print(f"  {name:<7} {r['chunks_embedded']:>7} chunks embedded in {r['embedding_s']:>8.1f}s  " +
+              "  ".join(f"{o} {r[o] if r[o] is not None else 'n/a'}" for o in OUTCOME_COLUMNS))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Category- and recency-aware per-admission chunk budget with near-duplicate skipping.")
+    parser.add_argument("--data_dir", default=".")
+    parser.add_argument("--records", default="note_chunks.csv.gz", help="chunk records written by notes_stream.py")
+    parser.add_argument("--out", default="budget_chunks.csv.gz")
+    parser.add_argument("--max_chunks", type=int, default=16)
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--half_life_hours", type=float, default=48.0)
+    parser.add_argument("--dedup_threshold", type=float, default=0.8)
+    parser.add_argument("--wide", default=None, help="also write the note_chunk_<k> dataset of the kept chunks")
+    parser.add_argument("--structured_file", default="final_structured_dataset.csv")
+    parser.add_argument("--evaluate", action="store_true", help="embed both chunk sets and compare probe AUROC")
+    parser.add_argument("--max_patients", type=int, default=2000)
+    parser.add_argument("--embed_dedup_threshold", type=float, default=0.8,
+                        help="near-duplicate threshold of the note_dedup variant in --evaluate")
+    args = parser.parse_args()
+    with in_dir(args.data_dir):
+        records = read_note_chunks(args.records)
+        budget = ChunkBudget(args.max_chunks, args.max_tokens, half_life_hours=args.half_life_hours,
+                             dedup_threshold=args.dedup_threshold)
+        start = time.time()
+        selected, duplicates = budget.select(records)
+        print(f"Selected chunks for {records[KEYS].drop_duplicates().shape[0]} admissions in {time.time() - start:.1f}s")
+        budget_report(records, selected, duplicates)
+        selected.to_csv(args.out, index=False, compression="gzip")
+        if args.wide:
+            build_unstructured_dataset(selected, args.structured_file).to_csv(args.wide, index=False)
+            print(f"Unstructured dataset with the budgeted note_chunk columns saved as '{args.wide}'.")
+        if args.evaluate:
+            evaluate_budget(records, selected, args.structured_file, args.max_patients,
+                            dedup_threshold=args.embed_dedup_threshold)
@@ -0,0 +1,529 @@
+import os
+import time
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+
+from synthetic_mimic import load_01_data
+from benchmark import in_dir
+
+# DuckDB execution of the 01_Data.py build: the same stages as SQL over the gzipped MIMIC-III CSVs (or a
+# Parquet cache of them) in an embedded DuckDB database, so the event tables are scanned out-of-core and
+# multi-threaded instead of being loaded into pandas whole.
+#   vent_flags          - calculate_mechanical_ventilation(): CHARTEVENTS / PROCEDUREEVENTS_MV flags per admission
+#   lab_bins            - load_and_aggregate_lab_data(): LABEVENTS means per 2-hour bin of the first 24 h
+#   structured_dataset  - build_structured_dataset(): stays + admissions + patients, age filter, outcomes, first
+#                         ICU stay per subject (groupby().first() semantics: first non-null value per column)
+#   feature_bins        - load_and_aggregate_feature_data(): Feature Set C items, 24 h window, 2-hour bins, pivot
+#   feature_set_c       - merge_feature_set_c(): per-admission mean over the bins of every table, joined once per
+#                         table instead of through the pandas merge of every table's bin rows
+#   unstructured_dataset - build_unstructured_dataset(): notes of the first ICU stay joined on CHARTDATE window
+# Every column is read as text and cast with TRY_CAST, which matches pd.to_numeric / pd.to_datetime with
+# errors='coerce'; casts, windows and aggregation quirks (sum of no numeric values is 0, the first timestamp /
+# numeric column present is used, inputevents_mv rows have no CHARTTIME) follow the pandas code.
+# Usage: python duckdb_cohort.py --data_dir <mimic> --build [--out_dir .] [--threads 8 --memory_limit 8GB]
+#        python duckdb_cohort.py --data_dir synthetic_mimic --parity   (every stage against the pandas output)
+#        python duckdb_cohort.py --data_dir <mimic> --cache_parquet    (writes <TABLE>.parquet for faster rescans)
+SOURCE_FILES = ["ADMISSIONS.csv.gz", "PATIENTS.csv.gz", "ICUSTAYS.csv.gz", "CHARTEVENTS.csv.gz",
+                "PROCEDUREEVENTS_MV.csv.gz", "LABEVENTS.csv.gz", "inputevents_cv.csv.gz", "inputevents_mv.csv.gz",
+                "OUTPUTEVENTS.csv.gz", "PRESCRIPTIONS.csv.gz", "NOTEEVENTS.csv.gz"]
+TIME_COLUMNS = ["charttime", "starttime", "storetime", "eventtime", "endtime"]
+VALUE_COLUMNS = ["value", "amount", "valuenum"]
+SUM_TABLES = ("inputevents", "outputevents")
+KEYS = ["subject_id", "hadm_id"]
+
+# determine_flags(): vent_itemids that set mechvent regardless of VALUE are all of them except the
+# VALUE-dependent ones and the oxygen device group.
+VALUE_DEPENDENT_ITEMS = (720, 223848, 223849, 467)
+OXYGEN_DEVICE_ITEMS = (468, 469, 470, 471, 227287, 226732, 223834)
+OXYGEN_VALUES_226732 = ["Nasal cannula", "Face tent", "Aerosol-cool", "Trach mask ", "High flow neb", "Non-rebreather",
+                        "Venti mask ", "Medium conc mask ", "T-piece", "High flow nasal cannula", "Ultrasonic neb", "Vapomist"]
+OXYGEN_VALUES_467 = ["Cannula", "Nasal Cannula", "Face Tent", "Aerosol-Cool", "Trach Mask", "Hi Flow Neb", "Non-Rebreather",
+                     "Venti Mask", "Medium Conc Mask", "Vapotherm", "T-Piece", "Hood", "Hut", "TranstrachealCat",
+                     "Heated Neb", "Ultrasonic Neb"]
+PROCEDURE_EXTUBATION_ITEMS = (227194, 225468, 225477)
+
+# build_structured_dataset() output columns after subject_id, in order (lab_t* columns follow).
+STRUCTURED_COLUMNS = ["hadm_id", "ICUSTAY_ID", "INTIME", "OUTTIME", "ADMITTIME", "DISCHTIME", "DEATHTIME", "INSURANCE",
+                      "ETHNICITY", "GENDER", "DOB", "age", "age_bucket", "ethnicity_category", "insurance_category",
+                      "gender_label", "short_term_mortality", "icu_los", "los_binary", "mechanical_ventilation"]
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(int(value)) if isinstance(value, (int, np.integer)) else repr(float(value))
+
+def sql_list(values):
+    return ", ".join(sql_literal(v) for v in values)
+
+class DuckDBCohortBuilder(object):
+    def __init__(self, data_dir=".", database=":memory:", threads=None, memory_limit=None, temp_directory=None,
+                 source="auto"):
+        """source: 'csv', 'parquet' or 'auto' (the <TABLE>.parquet next to a CSV when it exists)."""
+        import duckdb
+        self.data_dir = os.path.abspath(data_dir)
+        self.source = source
+        self.data01 = load_01_data()
+        config = {"threads": threads or os.cpu_count() or 1, "preserve_insertion_order": False,
+                  "temp_directory": temp_directory or os.path.join(tempfile.gettempdir(), "duckdb_cohort_spill")}
+        if memory_limit:
+            config["memory_limit"] = memory_limit
+        self.con = duckdb.connect(database, config=config)
+        self.con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE icustays AS
+            SELECT TRY_CAST(SUBJECT_ID AS BIGINT) AS subject_id, TRY_CAST(HADM_ID AS BIGINT) AS hadm_id,
+                   TRY_CAST(ICUSTAY_ID AS BIGINT) AS icustay_id, TRY_CAST(INTIME AS TIMESTAMP) AS intime,
+                   TRY_CAST(OUTTIME AS TIMESTAMP) AS outtime, CAST(INTIME AS VARCHAR) AS intime_text,
+                   CAST(OUTTIME AS VARCHAR) AS outtime_text
+            FROM {self.scan("ICUSTAYS.csv.gz")}""")
+
+    # ---- sources ----
+    def path(self, file_name):
+        parquet = os.path.join(self.data_dir, file_name.replace(".csv.gz", "") + ".parquet")
+        if self.source != "csv" and os.path.exists(parquet):
+            return parquet
+        if self.source == "parquet":
+            raise FileNotFoundError(parquet)
+        return os.path.join(self.data_dir, file_name)
+
+    def scan(self, file_names):
+        """FROM-clause of one table; several files (inputevents) are unioned with columns matched by name."""
+        names = file_names if isinstance(file_names, list) else [file_names]
+        paths = [self.path(name) for name in names]
+        if all(p.endswith(".parquet") for p in paths):
+            return f"read_parquet([{sql_list(paths)}], union_by_name=true)"
+        paths = [os.path.join(self.data_dir, name) for name in names]
+        return f"read_csv([{sql_list(paths)}], header=true, all_varchar=true, union_by_name=true)"
+
+    def columns(self, scan):
+        return [row[0].lower() for row in self.con.execute(f"DESCRIBE SELECT * FROM {scan}").fetchall()]
+
+    def df(self, sql):
+        return self.con.execute(sql).fetchdf()
+
+    def cache_parquet(self, file_names=SOURCE_FILES):
+        """Writes <TABLE>.parquet next to each gzipped CSV (columns kept as text, as the CSV scan reads them)."""
+        for name in file_names:
+            csv_path = os.path.join(self.data_dir, name)
+            if not os.path.exists(csv_path):
+                continue
+            start = time.time()
+            target = os.path.join(self.data_dir, name.replace(".csv.gz", "") + ".parquet")
+            self.con.execute(f"COPY (SELECT * FROM read_csv({sql_literal(csv_path)}, header=true, all_varchar=true)) "
+                             f"TO {sql_literal(target)} (FORMAT PARQUET, COMPRESSION ZSTD)")
+            print(f"Cached {name} as {os.path.basename(target)} ({time.time() - start:.1f}s)")
+
+    def pivot_sql(self, source, prefix, keys):
+        """One <prefix>_t<itemid> column per itemid of `source` (ascending, as DataFrame.unstack orders them)."""
+        items = [row[0] for row in self.con.execute(f"SELECT DISTINCT itemid FROM {source} ORDER BY itemid").fetchall()]
+        columns = [f"{prefix}_t{int(item)}" for item in items]
+        pivots = "".join(f", max(bin_value) FILTER (WHERE itemid = {int(item)}) AS {column}" for item, column in zip(items, columns))
+        key_list = ", ".join(keys)
+        return f"SELECT {key_list}{pivots} FROM {source} GROUP BY {key_list} ORDER BY {key_list}", columns
+
+    # ---- stages ----
+    def vent_flags(self):
+        """calculate_mechanical_ventilation(): subject_id, hadm_id, mechanical_ventilation (also kept as a table)."""
+        vent_itemids = list(self.data01.vent_itemids)
+        direct = [i for i in vent_itemids if i not in VALUE_DEPENDENT_ITEMS and i not in OXYGEN_DEVICE_ITEMS]
+        flag = f"""CASE WHEN (itemid = 720 AND value <> 'Other/Remarks') OR (itemid = 223848 AND value <> 'Other')
+                          OR itemid = 223849 OR (itemid = 467 AND value = 'Ventilator') OR itemid IN ({sql_list(direct)})
+                          OR (itemid = 226732 AND value IN ({sql_list(OXYGEN_VALUES_226732)}))
+                          OR (itemid = 467 AND value IN ({sql_list(OXYGEN_VALUES_467)}))
+                          OR (itemid = 640 AND value IN ('Extubated', 'Self Extubation')) THEN 1 ELSE 0 END"""
+        # mechanical_ventilation is the max of all four flags, so one flag per row is enough. A procedure
+        # extubation at the same (icustay_id, charttime) as a chart row is dropped, as drop_duplicates does.
+        self.con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE vent_flags AS
+            WITH events AS (
+                SELECT TRY_CAST(ICUSTAY_ID AS BIGINT) AS icustay_id, CAST(CHARTTIME AS VARCHAR) AS charttime,
+                       TRY_CAST(ITEMID AS BIGINT) AS itemid, CAST(VALUE AS VARCHAR) AS value
+                FROM {self.scan("CHARTEVENTS.csv.gz")}
+                WHERE VALUE IS NOT NULL AND (TRY_CAST(ERROR AS DOUBLE) IS NULL OR TRY_CAST(ERROR AS DOUBLE) <> 1)
+            ), chart AS (
+                SELECT icustay_id, charttime, max({flag}) AS flag
+                FROM events
+                WHERE itemid IN ({sql_list(vent_itemids)}) AND icustay_id IS NOT NULL AND charttime IS NOT NULL
+                GROUP BY icustay_id, charttime
+            ), proc AS (
+                SELECT DISTINCT TRY_CAST(ICUSTAY_ID AS BIGINT) AS icustay_id, CAST(STARTTIME AS VARCHAR) AS charttime
+                FROM {self.scan("PROCEDUREEVENTS_MV.csv.gz")}
+                WHERE TRY_CAST(ITEMID AS BIGINT) IN ({sql_list(PROCEDURE_EXTUBATION_ITEMS)})
+            ), flags AS (
+                SELECT icustay_id, flag FROM chart
+                UNION ALL
+                SELECT icustay_id, 1 AS flag FROM proc ANTI JOIN chart USING (icustay_id, charttime)
+            )
+            SELECT s.subject_id, s.hadm_id, max(f.flag) AS mechanical_ventilation
+            FROM flags f JOIN icustays s ON s.icustay_id = f.icustay_id
+            GROUP BY s.subject_id, s.hadm_id""")
+        return self.df("SELECT * FROM vent_flags ORDER BY subject_id, hadm_id")
+
+    def _lab_long(self, bin_size=2):
+        """LABEVENTS means per (subject_id, hadm_id, hour_bin, itemid) as table lab_long; False without VALUENUM."""
+        scan = self.scan("LABEVENTS.csv.gz")
+        if "valuenum" not in self.columns(scan):
+            print("LABEVENTS missing 'valuenum' column.")
+            return False
+        self.con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE lab_long AS
+            SELECT subject_id, hadm_id, CAST(floor(hours / {bin_size}) AS BIGINT) AS hour_bin, itemid,
+                   avg(valuenum) AS bin_value
+            FROM (
+                SELECT e.subject_id, e.hadm_id, e.itemid, e.valuenum,
+                       date_diff('second', s.intime, e.charttime) / 3600.0 AS hours
+                FROM (SELECT TRY_CAST(SUBJECT_ID AS BIGINT) AS subject_id, TRY_CAST(HADM_ID AS BIGINT) AS hadm_id,
+                             TRY_CAST(ITEMID AS BIGINT) AS itemid, TRY_CAST(VALUENUM AS DOUBLE) AS valuenum,
+                             TRY_CAST(CHARTTIME AS TIMESTAMP) AS charttime
+                      FROM {scan}) e
+                JOIN icustays s ON s.subject_id = e.subject_id AND s.hadm_id = e.hadm_id
+                WHERE e.valuenum IS NOT NULL AND e.charttime IS NOT NULL
+            )
+            WHERE hours BETWEEN 0 AND 24 AND itemid IS NOT NULL
+            GROUP BY ALL""")
+        return True
+
+    def lab_bins(self, bin_size=2):
+        """load_and_aggregate_lab_data(): one row per (subject_id, hadm_id, 2-hour bin), lab_t<itemid> columns."""
+        if not self._lab_long(bin_size):
+            return None
+        sql, _ = self.pivot_sql("lab_long", "lab", KEYS + ["hour_bin"])
+        return self.df(sql).drop(columns=["hour_bin"])
+
+    def register_categories(self, name, column, categorize):
+        """Mapping table of the distinct cohort values of `column` through a 01_Data.py categorize_* function."""
+        values = [row[0] for row in self.con.execute(f"SELECT DISTINCT {column} FROM cohort_stays").fetchall()]
+        self.con.register(name, pd.DataFrame({"value": values,
+                                              "category": [categorize(np.nan if v is None else v) for v in values]}))
+
+    def structured_dataset(self):
+        """build_structured_dataset() without writing the file."""
+        start = time.time()
+        self.vent_flags()
+        self.con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE cohort_stays AS
+            WITH adm AS (
+                SELECT TRY_CAST(SUBJECT_ID AS BIGINT) AS subject_id, TRY_CAST(HADM_ID AS BIGINT) AS hadm_id,
+                       TRY_CAST(ADMITTIME AS TIMESTAMP) AS ADMITTIME, TRY_CAST(DISCHTIME AS TIMESTAMP) AS DISCHTIME,
+                       TRY_CAST(DEATHTIME AS TIMESTAMP) AS DEATHTIME, CAST(INSURANCE AS VARCHAR) AS INSURANCE,
+                       CAST(ETHNICITY AS VARCHAR) AS ETHNICITY
+                FROM {self.scan("ADMISSIONS.csv.gz")}
+            ), pat AS (
+                SELECT TRY_CAST(SUBJECT_ID AS BIGINT) AS subject_id, CAST(GENDER AS VARCHAR) AS GENDER,
+                       TRY_CAST(DOB AS TIMESTAMP) AS DOB
+                FROM {self.scan("PATIENTS.csv.gz")}
+            ), stays AS (
+                SELECT s.subject_id, s.hadm_id, s.icustay_id AS ICUSTAY_ID, s.intime AS INTIME, s.outtime AS OUTTIME,
+                       a.ADMITTIME, a.DISCHTIME, a.DEATHTIME, a.INSURANCE, a.ETHNICITY, p.GENDER, p.DOB,
+                       CAST(year(s.intime) - year(p.DOB)
+                            - CASE WHEN month(s.intime) < month(p.DOB)
+                                        OR (month(s.intime) = month(p.DOB) AND day(s.intime) < day(p.DOB))
+                                   THEN 1 ELSE 0 END AS DOUBLE) AS age
+                FROM icustays s
+                LEFT JOIN adm a ON a.subject_id = s.subject_id AND a.hadm_id = s.hadm_id
+                LEFT JOIN pat p ON p.subject_id = s.subject_id
+            )
+            SELECT * FROM stays WHERE age BETWEEN 15 AND 90""")
+        self.register_categories("age_map", "age", self.data01.categorize_age)
+        self.register_categories("ethnicity_map", "ETHNICITY", self.data01.categorize_ethnicity)
+        self.register_categories("insurance_map", "INSURANCE", self.data01.categorize_insurance)
+
+        # groupby('subject_id').first() after the lab merge takes, per column, the first non-null value in
+        # INTIME order and, within a stay, in bin order: the earliest bin of each lab item.
+        lab_columns = []
+        lab_join = ""
+        if self._lab_long(2):
+            sql, lab_columns = self.pivot_sql("(SELECT subject_id, hadm_id, itemid, arg_min(bin_value, hour_bin) AS bin_value "
+                                              "FROM lab_long GROUP BY ALL)", "lab", KEYS)
+            self.con.execute(f"CREATE OR REPLACE TEMP TABLE lab_first AS {sql}")
+            lab_join = "LEFT JOIN lab_first l ON l.subject_id = c.subject_id AND l.hadm_id = c.hadm_id"
+        lab_select = "".join(f", l.{column}" for column in lab_columns)
+        aggregates = ",\n".join(f"first({column} ORDER BY INTIME, ICUSTAY_ID) FILTER (WHERE {column} IS NOT NULL) AS {column}"
+                                for column in STRUCTURED_COLUMNS + lab_columns)
+        df_struct = self.df(f"""
+            WITH stay_rows AS (
+                SELECT c.*, age_map.category AS age_bucket, ethnicity_map.category AS ethnicity_category,
+                       insurance_map.category AS insurance_category,
+                       CASE WHEN contains(lower(c.GENDER), 'm') THEN 'male'
+                            WHEN contains(lower(c.GENDER), 'f') THEN 'female' ELSE lower(c.GENDER) END AS gender_label,
+                       CAST(c.DEATHTIME IS NOT NULL AS INTEGER) AS short_term_mortality,
+                       date_diff('second', c.INTIME, c.OUTTIME) / 3600.0 AS icu_los,
+                       CAST(coalesce(date_diff('second', c.INTIME, c.OUTTIME) / 3600.0 > 72, false) AS INTEGER) AS los_binary,
+                       coalesce(v.mechanical_ventilation, 0) AS mechanical_ventilation{lab_select}
+                FROM cohort_stays c
+                LEFT JOIN age_map ON age_map.value IS NOT DISTINCT FROM c.age
+                LEFT JOIN ethnicity_map ON ethnicity_map.value IS NOT DISTINCT FROM c.ETHNICITY
+                LEFT JOIN insurance_map ON insurance_map.value IS NOT DISTINCT FROM c.INSURANCE
+                LEFT JOIN vent_flags v ON v.subject_id = c.subject_id AND v.hadm_id = c.hadm_id
+                {lab_join}
+            )
+            SELECT subject_id, {aggregates}
+            FROM stay_rows GROUP BY subject_id ORDER BY subject_id""")
+        df_struct = df_struct.rename(columns={"gender_label": "gender"})
+        print(f"Structured dataset: {df_struct.shape} ({time.time() - start:.1f}s)")
+        return df_struct
+
+    def feature_stays(self, subjects):
+        """The ICU stays merge_feature_set_c uses: stays of `subjects` lasting at least 30 hours."""
+        self.con.register("feature_subjects", pd.DataFrame({"subject_id": sorted(int(s) for s in subjects)}, dtype=np.int64))
+        return self.df("""
+            SELECT subject_id, hadm_id, intime, outtime, date_diff('second', intime, outtime) / 3600.0 AS icu_los
+            FROM icustays
+            WHERE subject_id IN (SELECT subject_id FROM feature_subjects)
+              AND date_diff('second', intime, outtime) / 3600.0 >= 30""")
+
+    def _feature_long(self, file_paths, table_name, filtered_subjects, icu_stays):
+        """Table feature_long: bin values per (subject_id, hadm_id, hour_bin, itemid); False if the table is skipped."""
+        print(f"\nProcessing {table_name} from {file_paths} (DuckDB)...")
+        scan = self.scan(file_paths)
+        columns = self.columns(scan)
+        if "subject_id" not in columns:
+            print(f"{table_name} is missing 'subject_id'. Skipping...")
+            return False
+        timestamp_col = next((col for col in TIME_COLUMNS if col in columns), None)
+        if not timestamp_col:
+            print(f"{table_name} has no valid timestamp column. Skipping...")
+            return False
+        numeric_col = next((col for col in VALUE_COLUMNS if col in columns), None)
+        if not numeric_col or "itemid" not in columns:
+            print(f"{table_name} has no numeric column. Skipping...")
+            return False
+        self.con.register("feature_subjects", pd.DataFrame({"subject_id": sorted(int(s) for s in filtered_subjects)}, dtype=np.int64))
+        self.con.register("feature_stays", icu_stays[["subject_id", "hadm_id", "intime"]])
+        item_filter = ""
+        if table_name != "prescriptions":
+            item_filter = f"AND itemid IN ({sql_list(self.data01.feature_set_C_items.get(table_name, [])) or 'NULL'})"
+        agg = "coalesce(sum(value), 0)" if table_name in SUM_TABLES else "avg(value)"
+        self.con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE feature_long AS
+            SELECT subject_id, hadm_id, CAST(floor(hours / 2) AS BIGINT) AS hour_bin, itemid, {agg} AS bin_value
+            FROM (
+                SELECT e.subject_id, e.hadm_id, e.itemid, e.value,
+                       date_diff('second', CAST(s.intime AS TIMESTAMP), e.event_time) / 3600.0 AS hours
+                FROM (SELECT TRY_CAST(subject_id AS BIGINT) AS subject_id, TRY_CAST(hadm_id AS BIGINT) AS hadm_id,
+                             TRY_CAST(itemid AS BIGINT) AS itemid, TRY_CAST({numeric_col} AS DOUBLE) AS value,
+                             TRY_CAST({timestamp_col} AS TIMESTAMP) AS event_time
+                      FROM {scan}) e
+                JOIN feature_stays s ON s.subject_id = e.subject_id AND s.hadm_id = e.hadm_id
+                WHERE e.subject_id IN (SELECT subject_id FROM feature_subjects) AND e.event_time IS NOT NULL
+            )
+            WHERE hours BETWEEN 0 AND 24 AND itemid IS NOT NULL {item_filter}
+            GROUP BY ALL""")
+        return True
+
+    def feature_bins(self, file_paths, table_name, filtered_subjects, icu_stays):
+        """load_and_aggregate_feature_data(): one row per (subject_id, hadm_id, 2-hour bin)."""
+        if not self._feature_long(file_paths, table_name, filtered_subjects, icu_stays):
+            return None
+        sql, _ = self.pivot_sql("feature_long", table_name, KEYS + ["hour_bin"])
+        aggregated_df = self.df(sql).drop(columns=["hour_bin"])
+        print(f"{table_name}: Final aggregated shape: {aggregated_df.shape}")
+        return aggregated_df
+
+    def feature_means(self, file_paths, table_name, filtered_subjects, icu_stays):
+        """Per-admission mean over the bins of feature_bins(), what merge_feature_set_c ends up with per table."""
+        if not self._feature_long(file_paths, table_name, filtered_subjects, icu_stays):
+            return None
+        sql, _ = self.pivot_sql("(SELECT subject_id, hadm_id, itemid, avg(bin_value) AS bin_value FROM feature_long GROUP BY ALL)",
+                                table_name, KEYS)
+        return self.df(sql)
+
+    def feature_set_c(self, structured_file="final_structured_dataset.csv"):
+        """merge_feature_set_c() without writing the file."""
+        start = time.time()
+        structured_df = pd.read_csv(structured_file)
+        filtered_subjects = set(structured_df["subject_id"].unique())
+        icu_stays = self.feature_stays(filtered_subjects)
+        print(f"ICU stays shape after filtering by subject_id and LOS>=30h: {icu_stays.shape}")
+
+        # Merging every table's bin rows multiplies them per admission, but each row of one table is repeated
+        # equally often, so the per-subject mean below equals the mean over that table's bins.
+        merged_features = structured_df.copy()
+        for table, file in self.data01.input_files.items():
+            feature_df = self.feature_means(file, table, filtered_subjects, icu_stays)
+            if feature_df is not None:
+                merged_features = merged_features.merge(feature_df, on=KEYS, how="left")
+
+        numeric_cols = merged_features.select_dtypes(include=[np.number]).columns
+        categorical_cols = merged_features.select_dtypes(exclude=[np.number]).columns
+        merged_features_numeric = merged_features.groupby("subject_id", as_index=False)[numeric_cols].mean()
+        merged_features_categorical = merged_features.groupby("subject_id", as_index=False)[categorical_cols].first()
+        merged_features = merged_features_numeric.merge(merged_features_categorical, on="subject_id", how="left")
+        print(f"Feature Set C dataset: {merged_features.shape} ({time.time() - start:.1f}s)")
+        return merged_features
+
+    def notes_window(self):
+        """Per-admission note text of build_unstructured_dataset before preprocessing (TEXT joined in ROW_ID order)."""
+        return self.df(f"""
+            WITH first_icu AS (
+                SELECT subject_id, hadm_id, admission_time, discharge_time
+                FROM (SELECT subject_id, hadm_id, icustay_id,
+                             TRY_STRPTIME(intime_text, '%Y-%m-%d %H:%M:%S') AS admission_time,
+                             TRY_STRPTIME(outtime_text, '%Y-%m-%d %H:%M:%S') AS discharge_time
+                      FROM icustays)
+                QUALIFY row_number() OVER (PARTITION BY subject_id ORDER BY admission_time NULLS LAST, icustay_id) = 1
+            ), notes AS (
+                SELECT TRY_CAST(ROW_ID AS BIGINT) AS row_id, TRY_CAST(SUBJECT_ID AS BIGINT) AS subject_id,
+                       TRY_CAST(HADM_ID AS BIGINT) AS hadm_id,
+                       CAST(TRY_STRPTIME(CAST(CHARTDATE AS VARCHAR), '%Y-%m-%d') AS TIMESTAMP) AS chartdate,
+                       CAST(TEXT AS VARCHAR) AS note_text
+                FROM {self.scan("NOTEEVENTS.csv.gz")}
+            )
+            SELECT n.subject_id, n.hadm_id, string_agg(n.note_text, ' ' ORDER BY n.row_id) AS TEXT
+            FROM notes n JOIN first_icu f ON n.subject_id = f.subject_id AND n.hadm_id = f.hadm_id
+            WHERE n.chartdate >= f.admission_time AND n.chartdate <= f.discharge_time
+            GROUP BY n.subject_id, n.hadm_id
+            ORDER BY n.subject_id, n.hadm_id""")
+
+    def unstructured_dataset(self, structured_file="final_structured_dataset.csv"):
+        """build_unstructured_dataset() without writing the file."""
+        start = time.time()
+        notes_agg = self.data01.preprocessing(self.notes_window())
+        df_note_chunks = notes_agg["TEXT"].apply(self.data01.split_into_512_token_columns)
+        notes_agg = pd.concat([notes_agg, df_note_chunks], axis=1)
+
+        structured_df = pd.read_csv(structured_file)
+        if "los_binary" not in structured_df.columns:
+            structured_df["los_binary"] = (structured_df["icu_los"] > 72).astype(int)
+        unstructured_merged = pd.merge(
+            notes_agg,
+            structured_df[["subject_id", "short_term_mortality", "icu_los", "los_binary", "mechanical_ventilation",
+                           "age", "age_bucket", "ethnicity_category", "insurance_category", "gender"]],
+            on="subject_id", how="left"
+        )
+        print(f"Unstructured dataset: {unstructured_merged.shape} ({time.time() - start:.1f}s)")
+        return unstructured_merged
+
+    def build(self, out_dir="."):
+        """The 01_Data.py pipeline: writes the same four CSV outputs (and the common-subject pair) to out_dir."""
+        os.makedirs(out_dir, exist_ok=True)
+        with in_dir(out_dir):
+            self.structured_dataset().to_csv("final_structured_dataset.csv", index=False)
+            print("Base structured dataset saved as 'final_structured_dataset.csv'.")
+            self.feature_set_c().to_csv("final_structured_with_feature_set_C_24h_2h_bins.csv", index=False)
+            print("Final dataset saved as final_structured_with_feature_set_C_24h_2h_bins.csv")
+            self.unstructured_dataset().to_csv("unstructured_with_demographics.csv", index=False)
+            print("Unstructured dataset saved as 'unstructured_with_demographics.csv'.")
+            self.data01.build_common_datasets()
+
+# ---- parity with the pandas implementation ----
+def column_mismatches(expected, got, rtol, atol):
+    """(number of differing values, max |difference| of numeric values) of two aligned Series."""
+    if pd.api.types.is_numeric_dtype(expected) or pd.api.types.is_numeric_dtype(got):
+        a = pd.to_numeric(expected, errors="coerce").to_numpy(dtype=np.float64)
+        b = pd.to_numeric(got, errors="coerce").to_numpy(dtype=np.float64)
+        both = ~np.isnan(a) & ~np.isnan(b)
+        max_diff = float(np.abs(a[both] - b[both]).max()) if both.any() else 0.0
+        return int((~np.isclose(a, b, rtol=rtol, atol=atol, equal_nan=True)).sum()), max_diff
+    if pd.api.types.is_datetime64_any_dtype(expected) or pd.api.types.is_datetime64_any_dtype(got):
+        a = pd.to_datetime(expected, errors="coerce")
+        b = pd.to_datetime(got, errors="coerce")
+        return int(((a != b) & ~(a.isnull() & b.isnull())).sum()), 0.0
+    a = expected.astype(object).where(expected.notnull(), None).map(str)
+    b = got.astype(object).where(got.notnull(), None).map(str)
+    return int((a != b).sum()), 0.0
+
+def compare_frames(expected, got, keys, exclude_prefixes=(), rtol=1e-6, atol=1e-8):
+    """Differences between a pandas and a DuckDB output, rows aligned by a stable sort on `keys`."""
+    if expected is None or got is None:
+        return {"rows": 0, "missing_columns": [], "extra_columns": [], "max_abs_diff": 0.0,
+                "mismatches": int((expected is None) != (got is None))}
+    expected = expected[[c for c in expected.columns if not c.startswith(tuple(exclude_prefixes))]]
+    got = got[[c for c in got.columns if not c.startswith(tuple(exclude_prefixes))]]
+    missing = [c for c in expected.columns if c not in got.columns]
+    extra = [c for c in got.columns if c not in expected.columns]
+    summary = {"rows": len(expected), "missing_columns": missing, "extra_columns": extra, "max_abs_diff": 0.0,
+               "mismatches": len(missing) + len(extra)}
+    if len(expected) != len(got):
+        print(f"  row count differs: pandas {len(expected)}, DuckDB {len(got)}")
+        summary["mismatches"] += abs(len(expected) - len(got))
+        return summary
+    expected = expected.sort_values(keys, kind="stable").reset_index(drop=True)
+    got = got.sort_values(keys, kind="stable").reset_index(drop=True)
+    for column in expected.columns:
+        if column in got.columns:
+            count, max_diff = column_mismatches(expected[column], got[column], rtol, atol)
+            summary["mismatches"] += count
+            summary["max_abs_diff"] = max(summary["max_abs_diff"], max_diff)
+    return summary
+
+@contextlib.contextmanager
+def pandas_workspace(data_dir):
+    """Temporary working directory with links to the CSVs, so the pandas stages do not overwrite outputs in data_dir."""
+    data_dir = os.path.abspath(data_dir)
+    with tempfile.TemporaryDirectory() as workspace:
+        for name in os.listdir(data_dir):
+            if name.endswith(".csv.gz"):
+                os.symlink(os.path.join(data_dir, name), os.path.join(workspace, name))
+        with in_dir(workspace):
+            yield workspace
+
+def parity(data_dir=".", rtol=1e-6, atol=1e-8, **options):
+    """Runs every stage with pandas (01_Data.py) and DuckDB and compares the outputs; returns one summary per stage."""
+    builder = DuckDBCohortBuilder(data_dir, **options)
+    data01 = builder.data01
+    results = []
+
+    def check(stage, run_pandas, run_duckdb, keys, exclude_prefixes=()):
+        start = time.perf_counter()
+        expected = run_pandas()
+        pandas_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        got = run_duckdb()
+        duckdb_seconds = time.perf_counter() - start
+        summary = compare_frames(expected, got, keys, exclude_prefixes, rtol, atol)
+        summary.update({"stage": stage, "pandas_s": round(pandas_seconds, 3), "duckdb_s": round(duckdb_seconds, 3)})
+        results.append(summary)
+
+    with pandas_workspace(data_dir):
+        check("vent_flags", data01.calculate_mechanical_ventilation, builder.vent_flags, KEYS)
+        check("lab_bins", lambda: data01.load_and_aggregate_lab_data("LABEVENTS.csv.gz", bin_size=2), builder.lab_bins, KEYS)
+        # The lab_t columns of the pandas cohort depend on the order of equal INTIMEs after an unstable sort;
+        # their values are covered by lab_bins.
+        check("structured_dataset", data01.build_structured_dataset, builder.structured_dataset, ["subject_id"],
+              exclude_prefixes=("lab_t",))
+        filtered_subjects = set(pd.read_csv("final_structured_dataset.csv")["subject_id"].unique())
+        icu_stays = builder.feature_stays(filtered_subjects)
+        for table, files in data01.input_files.items():
+            check(f"{table}_bins", lambda: data01.load_and_aggregate_feature_data(files, table, filtered_subjects, icu_stays),
+                  lambda: builder.feature_bins(files, table, filtered_subjects, icu_stays), KEYS)
+        check("feature_set_c", data01.merge_feature_set_c, builder.feature_set_c, ["subject_id"])
+        check("unstructured_dataset", data01.build_unstructured_dataset, builder.unstructured_dataset, KEYS)
+
+    print("\n--- pandas vs DuckDB ---")
+    for r in results:
+        speedup = r["pandas_s"] / r["duckdb_s"] if r["duckdb_s"] > 0 else float("inf")
+        print(f"  {r['stage']:<22} pandas {r['pandas_s']:>8.2f}s  DuckDB {r['duckdb_s']:>8.2f}s  ({speedup:4.1f}x)  "
+              f"{r['rows']:>8} rows, {r['mismatches']} mismatches, max |diff| {r['max_abs_diff']:.2e}")
+        if r["missing_columns"] or r["extra_columns"]:
+            print(f"    missing {r['missing_columns'][:5]}, extra {r['extra_columns'][:5]}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DuckDB execution of the 01_Data.py cohort, feature and notes build.")
+    parser.add_argument("--data_dir", default=".", help="directory with the MIMIC-III (or synthetic_mimic.py) CSVs")
+    parser.add_argument("--out_dir", default=".", help="where --build writes the 01_Data.py outputs")
+    parser.add_argument("--build", action="store_true", help="run the full build")
+    parser.add_argument("--parity", action="store_true", help="compare every stage with the pandas implementation")
+    parser.add_argument("--cache_parquet", action="store_true", help="write <TABLE>.parquet next to the CSVs first")
+    parser.add_argument("--source", choices=["auto", "csv", "parquet"], default="auto")
+    parser.add_argument("--database", default=":memory:", help="DuckDB database file (default in memory)")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--memory_limit", default=None, help="e.g. 8GB; larger intermediates spill to --temp_directory")
+    parser.add_argument("--temp_directory", default=None)
+    args = parser.parse_args()
+    options = {"database": args.database, "threads": args.threads, "memory_limit": args.memory_limit,
+               "temp_directory": args.temp_directory, "source": args.source}
+    if args.cache_parquet:
+        DuckDBCohortBuilder(args.data_dir, source="csv", **{k: v for k, v in options.items() if k != "source"}).cache_parquet()
+    if args.build:
+        start = time.time()
+        DuckDBCohortBuilder(args.data_dir, **options).build(args.out_dir)
+        print(f"DuckDB build finished in {time.time() - start:.1f}s")
+    if args.parity:
+        results = parity(args.data_dir, **options)
+        failed = [r for r in results if r["mismatches"]]
+        print("Parity OK." if not failed else f"Parity FAILED for {len(failed)} stages.")
+        raise SystemExit(1 if failed else 0)
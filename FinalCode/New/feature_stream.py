@@ -0,0 +1,215 @@
+import os
+import math
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+from synthetic_mimic import load_01_data
+
+# Incremental Feature Set C state of one ICU stay, for rescoring while chart / lab / input / output events
+# arrive. It reproduces load_and_aggregate_feature_data (01_Data.py) followed by the per-patient mean of
+# merge_feature_set_c, restricted to the events seen so far:
+#   - an event counts if its itemid is in feature_set_C_items[table] and 0 <= hours since intime <= 24;
+#   - its 2-hour bin is floor(hours / 2) (hour 24 falls in bin 12, as in the batch builder);
+#   - per (table, itemid, bin) the running sum and count give the bin value: mean of the numeric values, or
+#     for inputevents / outputevents their sum (0 when the bin only has non-numeric values, like pandas);
+#   - the feature <table>_t<itemid> is the mean of its bin values over the bins that have one, kept as a
+#     running sum and count that are corrected whenever one bin value changes.
+# Every ingest is O(1). Stays are assumed to pass the cohort filters (first ICU stay, LOS >= 30 h) already.
+# python feature_stream.py --data_dir synthetic_mimic replays the tables in time order through one state per
+# stay and checks the vectors against load_and_aggregate_feature_data at several cut-off hours.
+WINDOW_HOURS = 24
+BIN_HOURS = 2
+SUM_TABLES = ("inputevents", "outputevents")
+TIME_COLUMNS = ["charttime", "starttime", "storetime", "eventtime", "endtime"]
+VALUE_COLUMNS = ["value", "amount", "valuenum"]
+EVENT_TABLES = ["chartevents", "labevents", "inputevents", "outputevents"]
+
+def to_number(value):
+    """float(value), NaN where pd.to_numeric(errors='coerce') would give NaN."""
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+class StayFeatureState(object):
+    def __init__(self, subject_id, hadm_id, intime, items):
+        """items is 01_Data.feature_set_C_items."""
+        self.subject_id = subject_id
+        self.hadm_id = hadm_id
+        self.intime = pd.Timestamp(intime)
+        self.items = {table: set(ids) for table, ids in items.items() if table in EVENT_TABLES}
+        self.bins = {}      # (table, itemid, bin) -> [sum of numeric values, number of numeric values]
+        self.features = {}  # column -> [sum of bin values, number of bins with a value]
+        self.ingested = 0
+        self.skipped = 0
+        self.last_event_time = None
+
+    @staticmethod
+    def bin_value(table, acc):
+        if table in SUM_TABLES:
+            return acc[0]
+        return acc[0] / acc[1] if acc[1] else math.nan
+
+    def ingest(self, table, itemid, event_time, value):
+        """Adds one event; returns False when it is outside the window or not a Feature Set C item."""
+        hours = (pd.Timestamp(event_time) - self.intime).total_seconds() / 3600.0
+        try:
+            itemid = int(itemid)
+        except (TypeError, ValueError):
+            itemid = None
+        if not 0 <= hours <= WINDOW_HOURS or itemid not in self.items.get(table, ()):
+            self.skipped += 1
+            return False
+        key = (table, itemid, int(hours // BIN_HOURS))
+        acc = self.bins.get(key)
+        if acc is None:
+            old = math.nan
+            acc = self.bins[key] = [0.0, 0]
+        else:
+            old = self.bin_value(table, acc)
+        value = to_number(value)
+        if not math.isnan(value):
+            acc[0] += value
+            acc[1] += 1
+        self._replace_bin_value(f"{table}_t{itemid}", old, self.bin_value(table, acc))
+        self.ingested += 1
+        self.last_event_time = event_time
+        return True
+
+    def _replace_bin_value(self, column, old, new):
+        feature = self.features.get(column)
+        if feature is None:
+            feature = self.features[column] = [0.0, 0]
+        if not math.isnan(old):
+            feature[0] -= old
+            feature[1] -= 1
+        if not math.isnan(new):
+            feature[0] += new
+            feature[1] += 1
+
+    def ingest_frame(self, table, events):
+        """Small-batch ingest of raw table rows (columns as in the MIMIC CSVs, any case); returns rows used."""
+        events = events.rename(columns=str.lower)
+        time_col = next((c for c in TIME_COLUMNS if c in events.columns), None)
+        value_col = next((c for c in VALUE_COLUMNS if c in events.columns), None)
+        if time_col is None or value_col is None or "itemid" not in events.columns:
+            return 0
+        used = 0
+        for itemid, event_time, value in zip(events["itemid"], pd.to_datetime(events[time_col], errors="coerce"), events[value_col]):
+            if not pd.isnull(event_time):
+                used += self.ingest(table, itemid, event_time, value)
+        return used
+
+    def feature_vector(self, columns=None):
+        """{column: value} of the features seen so far, or an array in the order of `columns` (NaN if unseen)."""
+        values = {column: (total / n if n else math.nan) for column, (total, n) in self.features.items()}
+        if columns is None:
+            return values
+        return np.array([values.get(column, math.nan) for column in columns], dtype=np.float64)
+
+def read_event_table(data_dir, file_paths):
+    """The raw rows load_and_aggregate_feature_data reads, with lower-case columns."""
+    paths = file_paths if isinstance(file_paths, list) else [file_paths]
+    df = pd.concat([pd.read_csv(os.path.join(data_dir, p), compression="gzip", low_memory=False) for p in paths],
+                   ignore_index=True)
+    df.columns = df.columns.str.lower()
+    return df
+
+def load_replay_stays(data_dir, max_stays=None):
+    stays = pd.read_csv(os.path.join(data_dir, "ICUSTAYS.csv.gz"), compression="gzip",
+                        usecols=["SUBJECT_ID", "HADM_ID", "INTIME", "OUTTIME"])
+    stays.columns = stays.columns.str.lower()
+    stays["intime"] = pd.to_datetime(stays["intime"])
+    # load_and_aggregate_feature_data joins events on (subject_id, hadm_id), so only admissions with a single
+    # ICU stay have an unambiguous per-stay reference.
+    stays = stays.drop_duplicates(subset=["subject_id", "hadm_id"], keep=False)
+    if max_stays:
+        stays = stays.head(max_stays)
+    return stays.reset_index(drop=True)
+
+def replay_parity(data_dir=".", tables=EVENT_TABLES, cutoffs=(6, 12, 24), max_stays=None, rtol=1e-6, atol=1e-8):
+    """
+    Replays every table in event-time order through one StayFeatureState per stay and, at each cut-off hour,
+    compares the state vectors with load_and_aggregate_feature_data run on the events up to that hour.
+    Returns one summary dict per (table, cutoff).
+    """
+    data01 = load_01_data()
+    stays = load_replay_stays(data_dir, max_stays)
+    subjects = set(stays["subject_id"])
+    intimes = {(s, h): t for s, h, t in zip(stays["subject_id"], stays["hadm_id"], stays["intime"])}
+    states = {key: StayFeatureState(key[0], key[1], t, data01.feature_set_C_items) for key, t in intimes.items()}
+    summaries = []
+    for table in tables:
+        events = read_event_table(data_dir, data01.input_files[table])
+        time_col = next((c for c in TIME_COLUMNS if c in events.columns), None)
+        value_col = next((c for c in VALUE_COLUMNS if c in events.columns), None)
+        if time_col is None or value_col is None:
+            print(f"{table}: no timestamp or numeric column, skipped.")
+            continue
+        events = events[events["subject_id"].isin(subjects)]
+        event_times = pd.to_datetime(events[time_col], errors="coerce")
+        stay_intime = pd.Series([intimes.get(key, pd.NaT) for key in zip(events["subject_id"], events["hadm_id"])],
+                                index=events.index)
+        hours = (event_times - stay_intime).dt.total_seconds() / 3600
+        order = hours.dropna().sort_values(kind="stable").index
+        cursor = 0
+        for cutoff in sorted(cutoffs):
+            # Stream every event up to the cut-off, in arrival order.
+            upto = order[cursor:cursor + int((hours.loc[order[cursor:]] <= cutoff).sum())]
+            start = time.perf_counter()
+            for subject_id, hadm_id, itemid, event_time, value in zip(events.loc[upto, "subject_id"], events.loc[upto, "hadm_id"],
+                                                                      events.loc[upto, "itemid"], event_times.loc[upto],
+                                                                      events.loc[upto, value_col]):
+                states[(subject_id, hadm_id)].ingest(table, itemid, event_time, value)
+            stream_seconds = time.perf_counter() - start
+            cursor += len(upto)
+
+            # Batch reference on the same events.
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, table + ".csv.gz")
+                events.loc[order[:cursor]].to_csv(path, index=False, compression="gzip")
+                reference = data01.load_and_aggregate_feature_data(path, table, subjects, stays)
+            mismatches = 0
+            max_abs_diff = 0.0
+            compared = 0
+            reference_keys = set()
+            if reference is not None and len(reference):
+                reference = reference.groupby(["subject_id", "hadm_id"]).mean()
+                reference_keys = set(reference.index)
+                columns = list(reference.columns)
+                for (subject_id, hadm_id), expected in zip(reference.index, reference.to_numpy(dtype=np.float64)):
+                    got = states[(subject_id, hadm_id)].feature_vector(columns)
+                    same = np.isclose(got, expected, rtol=rtol, atol=atol, equal_nan=True)
+                    mismatches += int((~same).sum())
+                    both = ~np.isnan(got) & ~np.isnan(expected)
+                    if both.any():
+                        max_abs_diff = max(max_abs_diff, float(np.abs(got[both] - expected[both]).max()))
+                    compared += len(columns)
+            # Stays the batch builder has no row for must have no streamed features either.
+            mismatches += sum(1 for key, state in states.items()
+                              if key not in reference_keys and any(c.startswith(table + "_") for c in state.features))
+            summary = {"table": table, "cutoff_hours": cutoff, "events_streamed": len(upto),
+                       "stream_events_per_s": len(upto) / stream_seconds if stream_seconds > 0 else float("inf"),
+                       "values_compared": compared, "mismatches": mismatches, "max_abs_diff": max_abs_diff}
+            print(f"{table:<13} <= {cutoff:>2} h: {summary['events_streamed']:>8} events streamed "
+                  f"({summary['stream_events_per_s']:,.0f}/s), {compared} values compared, "
+                  f"{mismatches} mismatches, max |diff| {max_abs_diff:.2e}")
+            summaries.append(summary)
+    return summaries
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity of the streaming feature state with load_and_aggregate_feature_data.")
+    parser.add_argument("--data_dir", default=".", help="directory with the MIMIC-III (or synthetic_mimic.py) CSVs")
+    parser.add_argument("--tables", nargs="+", default=EVENT_TABLES, choices=EVENT_TABLES)
+    parser.add_argument("--cutoffs", nargs="+", type=float, default=[6, 12, 24])
+    parser.add_argument("--max_stays", type=int, default=None)
+    args = parser.parse_args()
+    results = replay_parity(args.data_dir, args.tables, args.cutoffs, args.max_stays)
+    failed = [r for r in results if r["mismatches"]]
+    print("Parity OK." if not failed else f"Parity FAILED for {len(failed)} table / cut-off combinations.")
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,167 @@
+import time
+import hashlib
+import argparse
+import numpy as np
+
+from benchmark import in_dir
+from chunk_budget import MinHasher, similarity
+from notes_stream import read_note_chunks
+
+# Near-duplicate index over the note chunk records of notes_stream.py. Nursing and progress notes are templated
+# and copy-forwarded, so many chunks repeat text the model has already embedded. DedupIndex assigns every chunk a
+# representative: an earlier chunk with the same text (sha1) or, failing that, an LSH candidate (MinHash over
+# word shingles, num_perm = bands x rows) whose estimated Jaccard similarity is >= threshold; otherwise the chunk
+# is its own representative and is added to the index. Only representatives are indexed, so clusters are stars
+# around their first chunk. The scope of an index is either one patient (scope="patient") or all notes
+# (scope="global"); flag_duplicates runs both:
+#   patient_duplicate - repeats text of the same patient (dropping it stops copy-forwarded text from being
+#                       weighted several times in the patient's mean embedding)
+#   representative    - chunk_id of the global representative; CachedEncoder embeds each representative once
+#                       and reuses the vector for all its duplicates (cached by the sha1 of its text, so one
+#                       encoder can be shared across record sets)
+# Chunks are indexed in the order given, so notes_stream blocks can be fed one at a time by passing the same
+# two indexes and the next first_chunk_id to every flag_duplicates call.
+# Usage: python note_dedup.py --data_dir . --records note_chunks.csv.gz --out note_chunks_dedup.csv.gz
+#        [--threshold 0.8 --bands 8] [--drop_patient_duplicates]
+
+class DedupIndex(object):
+    def __init__(self, threshold=0.8, scope="global", num_perm=64, bands=8, shingle=5):
+        """With bands x rows = num_perm, pairs are LSH candidates from a similarity of about (1 / bands) ** (1 / rows)."""
+        if scope not in ("patient", "global"):
+            raise ValueError(f"scope must be 'patient' or 'global', got {scope!r}")
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.scope = scope
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, shingle)
+        self.buckets = [{} for _ in range(bands)]  # (scope key, band bytes) -> representative chunk ids
+        self.exact = {}                            # (scope key, sha1 of text) -> representative chunk id
+        self.signatures = {}                       # representative chunk id -> MinHash signature
+        self.text_sha1 = {}                        # representative chunk id -> sha1 (hex) of its text
+        self.counts = {"chunks": 0, "exact": 0, "near": 0}
+
+    def _band_keys(self, signature, scope_key):
+        return [(scope_key, signature[b * self.rows:(b + 1) * self.rows].tobytes()) for b in range(len(self.buckets))]
+
+    def add(self, chunk_id, text, subject_id=None):
+        """Indexes one chunk; returns (representative chunk id, similarity to it)."""
+        scope_key = subject_id if self.scope == "patient" else None
+        self.counts["chunks"] += 1
+        digest = (scope_key, hashlib.sha1(text.encode("utf-8")).digest())
+        if digest in self.exact:
+            self.counts["exact"] += 1
+            return self.exact[digest], 1.0
+        signature = self.hasher.signature(text)
+        band_keys = self._band_keys(signature, scope_key)
+        best, best_similarity = None, 0.0
+        seen = set()
+        for bucket, key in zip(self.buckets, band_keys):
+            for candidate in bucket.get(key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                s = similarity(signature, self.signatures[candidate])
+                if s >= self.threshold and s > best_similarity:
+                    best, best_similarity = candidate, s
+        if best is not None:
+            self.counts["near"] += 1
+            self.exact[digest] = best
+            return best, best_similarity
+        self.exact[digest] = chunk_id
+        self.signatures[chunk_id] = signature
+        self.text_sha1[chunk_id] = digest[1].hex()
+        for bucket, key in zip(self.buckets, band_keys):
+            bucket.setdefault(key, []).append(chunk_id)
+        return chunk_id, 1.0
+
+    def dedup_rate(self):
+        return (self.counts["exact"] + self.counts["near"]) / max(self.counts["chunks"], 1)
+
+def flag_duplicates(records, threshold=0.8, num_perm=64, bands=8, shingle=5, first_chunk_id=0,
+                    patient_index=None, global_index=None):
+    """
+    records with chunk_id, patient_duplicate, representative and similarity columns (the global match), and
+    the per-patient and global indexes (new ones unless given). Chunks are indexed in note order per patient.
+    """
+    records = records.sort_values(["subject_id", "hadm_id", "row_id", "chunk_index"], kind="stable").reset_index(drop=True)
+    records["chunk_id"] = np.arange(first_chunk_id, first_chunk_id + len(records))
+    if patient_index is None:
+        patient_index = DedupIndex(threshold, "patient", num_perm, bands, shingle)
+    if global_index is None:
+        global_index = DedupIndex(threshold, "global", num_perm, bands, shingle)
+    patient_duplicate, representative, match = [], [], []
+    for chunk_id, subject_id, text in zip(records["chunk_id"], records["subject_id"], records["text"]):
+        patient_rep, _ = patient_index.add(chunk_id, text, subject_id)
+        global_rep, s = global_index.add(chunk_id, text)
+        patient_duplicate.append(patient_rep != chunk_id)
+        representative.append(global_rep)
+        match.append(s)
+    records["patient_duplicate"] = patient_duplicate
+    records["representative"] = representative
+    records["similarity"] = match
+    # The representative may come from an earlier call, so the cache key is its text hash, not its chunk_id.
+    records["representative_sha1"] = [global_index.text_sha1[r] for r in representative]
+    return records, patient_index, global_index
+
+def dedup_report(records, patient_index, global_index):
+    """Dedup rates and the BERT passes left: one per global representative among the chunks that are embedded."""
+    embedded = records[~records["patient_duplicate"]]
+    report = {"chunks": len(records),
+              "patient_dedup_rate": patient_index.dedup_rate(), "global_dedup_rate": global_index.dedup_rate(),
+              "exact_duplicates": global_index.counts["exact"], "near_duplicates": global_index.counts["near"],
+              "chunks_embedded": len(embedded), "bert_passes": int(embedded["representative"].nunique())}
+    report["bert_passes_saved"] = 1 - report["bert_passes"] / max(report["chunks"], 1)
+    print(f"{report['chunks']} chunks: {report['patient_dedup_rate']:.1%} near-duplicates within a patient, "
+          f"{report['global_dedup_rate']:.1%} across all notes ({report['exact_duplicates']} exact, "
+          f"{report['near_duplicates']} near)")
+    print(f"{report['bert_passes']} BERT passes for {report['chunks_embedded']} embedded chunks "
+          f"({report['bert_passes_saved']:.1%} of the passes saved)")
+    return report
+
+class CachedEncoder(object):
+    """Wraps an encoder with encode(texts) (e.g. scoring_service.NoteEncoder); duplicates reuse their representative's vector."""
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.cache = {}  # sha1 of the representative's text -> embedding
+        self.hits = 0
+        self.misses = 0
+
+    def encode_records(self, records):
+        """One embedding row per record, in record order; flag_duplicates columns are required."""
+        # A representative of an earlier block that is missing from the cache is embedded from the first duplicate
+        # in this block; near-duplicates are close enough for that to stand in.
+        texts = {}
+        for key, text in zip(records["representative_sha1"], records["text"]):
+            texts.setdefault(key, text)
+        texts.update({key: text for key, text, chunk_id, rep in zip(records["representative_sha1"], records["text"],
+                                                                     records["chunk_id"], records["representative"])
+                      if chunk_id == rep})
+        missing = [key for key in texts if key not in self.cache]
+        if missing:
+            for key, emb in zip(missing, self.encoder.encode([texts[key] for key in missing])):
+                self.cache[key] = emb
+        self.misses += len(missing)
+        self.hits += len(records) - len(missing)
+        return np.stack([self.cache[key] for key in records["representative_sha1"]])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MinHash/LSH near-duplicate flags for note chunk records.")
+    parser.add_argument("--data_dir", default=".")
+    parser.add_argument("--records", default="note_chunks.csv.gz", help="chunk records written by notes_stream.py")
+    parser.add_argument("--out", default="note_chunks_dedup.csv.gz")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--num_perm", type=int, default=64)
+    parser.add_argument("--bands", type=int, default=8)
+    parser.add_argument("--drop_patient_duplicates", action="store_true", help="write only the chunks that are embedded")
+    args = parser.parse_args()
+    with in_dir(args.data_dir):
+        records = read_note_chunks(args.records)
+        start = time.time()
+        records, patient_index, global_index = flag_duplicates(records, args.threshold, args.num_perm, args.bands)
+        print(f"Indexed {len(records)} chunks in {time.time() - start:.1f}s")
+        dedup_report(records, patient_index, global_index)
+        if args.drop_patient_duplicates:
+            records = records[~records["patient_duplicate"]]
+        records.to_csv(args.out, index=False, compression="gzip")
+        print(f"Flagged chunk records saved as '{args.out}'.")
@@ -0,0 +1,191 @@
+import gzip
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from synthetic_mimic import load_01_data
+from benchmark import in_dir, MemorySampler
+
+# Streaming notes stage. build_unstructured_dataset (01_Data.py) reads all of NOTEEVENTS with TEXT, joins every
+# admission's notes into one string and splits that into 512-token columns, so memory grows with the largest
+# patient's notes and the whole table. Here NOTEEVENTS is read in blocks of read_chunksize rows. Each block is
+# filtered by hadm_id, then by the CHARTDATE window of the first ICU stay. Every note is cleaned on its own
+# (preprocessing()) and split into chunk records right away:
+#   subject_id, hadm_id, row_id, category, chartdate, charttime, chunk_index (within the note), n_tokens, text
+# so memory is bounded by the block, never by a patient. Chunks do not cross note boundaries (each one has a
+# single category and time), which gives slightly more, shorter chunks than the concatenated split; the token
+# sequence of an admission in ROW_ID order is the concatenated one (token_parity checks this).
+# records_to_wide rebuilds the note_chunk_<k> layout the training scripts read, without the TEXT column.
+# Usage: python notes_stream.py --data_dir . --out note_chunks.csv.gz [--wide unstructured_with_demographics.csv]
+#        python notes_stream.py --data_dir synthetic_mimic --parity
+NOTE_COLUMNS = ["ROW_ID", "SUBJECT_ID", "HADM_ID", "CHARTDATE", "CHARTTIME", "CATEGORY", "TEXT"]
+RECORD_COLUMNS = ["subject_id", "hadm_id", "row_id", "category", "chartdate", "charttime", "chunk_index", "n_tokens", "text"]
+KEYS = ["subject_id", "hadm_id"]
+
+def first_icu_windows(icustays_path="ICUSTAYS.csv.gz"):
+    """subject_id, hadm_id, admission_time, discharge_time of each subject's first ICU stay."""
+    df_icustays = pd.read_csv(icustays_path, compression="gzip", low_memory=False,
+                              usecols=["SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "INTIME", "OUTTIME"])
+    df_icustays["INTIME"] = pd.to_datetime(df_icustays["INTIME"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    df_icustays["OUTTIME"] = pd.to_datetime(df_icustays["OUTTIME"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    df_icustays.rename(columns={"SUBJECT_ID": "subject_id", "HADM_ID": "hadm_id"}, inplace=True)
+    df_first_icu = df_icustays.sort_values(by="INTIME").groupby("subject_id").first().reset_index()
+    return df_first_icu[["subject_id", "hadm_id", "INTIME", "OUTTIME"]].rename(
+        columns={"INTIME": "admission_time", "OUTTIME": "discharge_time"})
+
+def chunk_records(notes, chunk_tokens=512):
+    """Chunk records of cleaned notes (columns as after preprocessing(), one row per note)."""
+    tokens = notes["TEXT"].str.split()
+    counts = tokens.str.len().to_numpy()
+    n_chunks = -(-counts // chunk_tokens)
+    idx = np.repeat(np.arange(len(notes)), n_chunks)
+    chunk_index = np.arange(len(idx)) - np.repeat(np.cumsum(n_chunks) - n_chunks, n_chunks)
+    texts = [" ".join(t[i * chunk_tokens:(i + 1) * chunk_tokens]) for t, n in zip(tokens, n_chunks) for i in range(n)]
+    return pd.DataFrame({
+        "subject_id": notes["subject_id"].to_numpy()[idx], "hadm_id": notes["hadm_id"].to_numpy()[idx],
+        "row_id": notes["ROW_ID"].to_numpy()[idx], "category": notes["CATEGORY"].to_numpy()[idx],
+        "chartdate": notes["CHARTDATE"].to_numpy()[idx], "charttime": notes["CHARTTIME"].to_numpy()[idx],
+        "chunk_index": chunk_index, "n_tokens": np.minimum(counts[idx] - chunk_index * chunk_tokens, chunk_tokens),
+        "text": texts}, columns=RECORD_COLUMNS)
+
+def iter_note_chunks(notes_path="NOTEEVENTS.csv.gz", windows=None, read_chunksize=20000, chunk_tokens=512, stats=None):
+    """Yields one DataFrame of chunk records per block of NOTEEVENTS rows; `stats` (a dict) collects counts."""
+    data01 = load_01_data()
+    windows = first_icu_windows() if windows is None else windows
+    hadm_ids = set(windows["hadm_id"])
+    stats = {} if stats is None else stats
+    for key in ("rows_read", "notes_kept", "chunks", "tokens"):
+        stats.setdefault(key, 0)
+    for notes in pd.read_csv(notes_path, compression="gzip", usecols=NOTE_COLUMNS, chunksize=read_chunksize):
+        stats["rows_read"] += len(notes)
+        notes = notes[notes["HADM_ID"].isin(hadm_ids)].rename(columns={"SUBJECT_ID": "subject_id", "HADM_ID": "hadm_id"})
+        if notes.empty:
+            continue
+        notes["CHARTDATE"] = pd.to_datetime(notes["CHARTDATE"], format="%Y-%m-%d", errors="coerce")
+        notes["CHARTTIME"] = pd.to_datetime(notes["CHARTTIME"], errors="coerce")
+        notes = notes.merge(windows, on=KEYS, how="inner")
+        notes = notes[(notes["CHARTDATE"] >= notes["admission_time"]) & (notes["CHARTDATE"] <= notes["discharge_time"])]
+        if notes.empty:
+            continue
+        records = chunk_records(data01.preprocessing(notes).reset_index(drop=True), chunk_tokens)
+        stats["notes_kept"] += len(notes)
+        stats["chunks"] += len(records)
+        stats["tokens"] += int(records["n_tokens"].sum())
+        yield records
+
+def write_note_chunks(out_path, notes_path="NOTEEVENTS.csv.gz", windows=None, read_chunksize=20000, chunk_tokens=512):
+    """Streams the chunk records to out_path (.csv.gz appended block by block, or .parquet); returns the counts."""
+    stats = {}
+    start = time.time()
+    writer = None
+    first = True
+    for records in iter_note_chunks(notes_path, windows, read_chunksize, chunk_tokens, stats):
+        if out_path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(records, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        else:
+            with gzip.open(out_path, "wt" if first else "at", newline="") as f:
+                records.to_csv(f, header=first, index=False)
+        first = False
+    if writer is not None:
+        writer.close()
+    stats["seconds"] = round(time.time() - start, 2)
+    print(f"{stats['rows_read']} notes read, {stats['notes_kept']} in a first-ICU-stay window -> {stats['chunks']} chunks "
+          f"({stats['tokens']} tokens) in {stats['seconds']}s, written to {out_path}")
+    return stats
+
+def read_note_chunks(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, compression="gzip", parse_dates=["chartdate", "charttime"])
+
+def records_to_wide(records):
+    """note_chunk_<k> columns per (subject_id, hadm_id), chunks in ROW_ID then chunk order."""
+    records = records.sort_values(KEYS + ["row_id", "chunk_index"], kind="stable")
+    records = records.assign(position=records.groupby(KEYS).cumcount() + 1)
+    wide = records.pivot(index=KEYS, columns="position", values="text")
+    wide.columns = [f"note_chunk_{k}" for k in wide.columns]
+    return wide.reset_index()
+
+def build_unstructured_dataset(records, structured_file="final_structured_dataset.csv"):
+    """build_unstructured_dataset() from chunk records (note_chunk_<k> columns, no TEXT column)."""
+    notes_wide = records_to_wide(records)
+    structured_df = pd.read_csv(structured_file)
+    if "los_binary" not in structured_df.columns:
+        structured_df["los_binary"] = (structured_df["icu_los"] > 72).astype(int)
+    return pd.merge(
+        notes_wide,
+        structured_df[["subject_id", "short_term_mortality", "icu_los", "los_binary", "mechanical_ventilation",
+                       "age", "age_bucket", "ethnicity_category", "insurance_category", "gender"]],
+        on="subject_id", how="left"
+    )
+
+def concatenated_notes(notes_path="NOTEEVENTS.csv.gz", windows=None):
+    """The cleaned per-admission TEXT of build_unstructured_dataset (the reference for token_parity)."""
+    data01 = load_01_data()
+    windows = first_icu_windows() if windows is None else windows
+    df_notes = pd.read_csv(notes_path, compression="gzip", low_memory=False, usecols=["SUBJECT_ID", "HADM_ID", "CHARTDATE", "TEXT"])
+    df_notes["CHARTDATE"] = pd.to_datetime(df_notes["CHARTDATE"], format="%Y-%m-%d", errors="coerce")
+    df_notes.rename(columns={"SUBJECT_ID": "subject_id", "HADM_ID": "hadm_id"}, inplace=True)
+    notes_merged = df_notes[df_notes["hadm_id"].isin(windows["hadm_id"])].merge(windows, on=KEYS, how="inner")
+    notes_filtered = notes_merged[(notes_merged["CHARTDATE"] >= notes_merged["admission_time"]) &
+                                  (notes_merged["CHARTDATE"] <= notes_merged["discharge_time"])]
+    notes_agg = notes_filtered.groupby(KEYS).agg({"TEXT": lambda texts: " ".join(texts)}).reset_index()
+    return data01.preprocessing(notes_agg)
+
+def token_parity(data_dir=".", read_chunksize=20000, chunk_tokens=512):
+    """Compares the streamed chunks with the concatenated notes: tokens per admission, chunk counts, peak memory."""
+    with in_dir(data_dir):
+        windows = first_icu_windows()
+        with MemorySampler() as stream_memory:
+            start = time.perf_counter()
+            records = pd.concat(list(iter_note_chunks(windows=windows, read_chunksize=read_chunksize,
+                                                      chunk_tokens=chunk_tokens)), ignore_index=True)
+            stream_seconds = time.perf_counter() - start
+        with MemorySampler() as legacy_memory:
+            start = time.perf_counter()
+            reference = concatenated_notes(windows=windows)
+            legacy_chunks = int(sum(-(-len(text.split()) // chunk_tokens) for text in reference["TEXT"]))
+            legacy_seconds = time.perf_counter() - start
+    records = records.sort_values(KEYS + ["row_id", "chunk_index"], kind="stable")
+    streamed = records.groupby(KEYS)["text"].apply(lambda chunks: " ".join(chunks).split())
+    mismatched = 0
+    for subject_id, hadm_id, text in zip(reference["subject_id"], reference["hadm_id"], reference["TEXT"]):
+        if streamed.get((subject_id, hadm_id), []) != text.split():
+            mismatched += 1
+    mismatched += len(set(streamed.index) - set(zip(reference["subject_id"], reference["hadm_id"])))
+    summary = {"admissions": len(reference), "token_mismatches": mismatched,
+               "streamed_chunks": len(records), "concatenated_chunks": legacy_chunks,
+               "stream_s": round(stream_seconds, 2), "concatenated_s": round(legacy_seconds, 2),
+               "stream_peak_delta_mb": round(stream_memory.peak_mb - stream_memory.start_mb, 1),
+               "concatenated_peak_delta_mb": round(legacy_memory.peak_mb - legacy_memory.start_mb, 1)}
+    print(f"{summary['admissions']} admissions, {mismatched} with a different token sequence "
+          f"(a cleanup pattern spanning two notes, e.g. an unclosed '[', is only removed in the concatenated text)")
+    print(f"Chunks: {summary['streamed_chunks']} streamed (per note) vs {summary['concatenated_chunks']} concatenated")
+    print(f"Streaming {summary['stream_s']}s, +{summary['stream_peak_delta_mb']} MB peak; "
+          f"concatenated {summary['concatenated_s']}s, +{summary['concatenated_peak_delta_mb']} MB peak")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream NOTEEVENTS into per-note 512-token chunk records.")
+    parser.add_argument("--data_dir", default=".", help="directory with NOTEEVENTS.csv.gz and ICUSTAYS.csv.gz")
+    parser.add_argument("--out", default="note_chunks.csv.gz", help=".csv.gz or .parquet, relative to data_dir")
+    parser.add_argument("--read_chunksize", type=int, default=20000, help="NOTEEVENTS rows read per block")
+    parser.add_argument("--chunk_tokens", type=int, default=512)
+    parser.add_argument("--wide", default=None, help="also write the note_chunk_<k> dataset (e.g. unstructured_with_demographics.csv)")
+    parser.add_argument("--structured_file", default="final_structured_dataset.csv")
+    parser.add_argument("--parity", action="store_true", help="compare with the concatenated notes instead of writing")
+    args = parser.parse_args()
+    if args.parity:
+        token_parity(args.data_dir, args.read_chunksize, args.chunk_tokens)
+    else:
+        with in_dir(args.data_dir):
+            write_note_chunks(args.out, read_chunksize=args.read_chunksize, chunk_tokens=args.chunk_tokens)
+            if args.wide:
+                build_unstructured_dataset(read_note_chunks(args.out), args.structured_file).to_csv(args.wide, index=False)
+                print(f"Unstructured dataset with note_chunk columns saved as '{args.wide}'.")
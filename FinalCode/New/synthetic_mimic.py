@@ -0,0 +1,436 @@
+import os
+import gzip
+import json
+import time
+import argparse
+import importlib.util
+import numpy as np
+import pandas as pd
+
+# Synthetic MIMIC-III-shaped tables for everything 01_Data.py reads, for throughput benchmarks without
+# credentialed data. Column order follows the MIMIC-III v1.4 CSVs; columns 01_Data.py does not use are
+# written empty. Values are drawn to exercise the same code paths as the real data:
+#   - ethnicity / insurance strings are raw MIMIC values, with the skew of the MIMIC-III ICU population
+#     after categorize_ethnicity / categorize_insurance (insurance also depends on age and ethnicity);
+#   - ages include the >89 DOB shift (ages around 300) that 01_Data.py filters out;
+#   - ventilated stays get CHARTEVENTS rows on vent_itemids (with the VALUE strings that set the
+#     mechvent / oxygen / extubation flags) and PROCEDUREEVENTS_MV extubations; other stays never do;
+#   - Feature Set C itemids follow a Zipf-like frequency per table, mostly inside the first 24h;
+#   - note lengths are log-normal (heavy tailed), discharge summaries several times longer.
+# Tables are generated in patient chunks and appended, so memory stays flat from 1k to 1M patients.
+# Usage: python synthetic_mimic.py --patients 10000 --out_dir synthetic_mimic [--formats csv parquet]
+# then run 01_Data.py from inside out_dir.
+
+SCHEMAS = {
+    "PATIENTS": ["ROW_ID", "SUBJECT_ID", "GENDER", "DOB", "DOD", "DOD_HOSP", "DOD_SSN", "EXPIRE_FLAG"],
+    "ADMISSIONS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ADMITTIME", "DISCHTIME", "DEATHTIME", "ADMISSION_TYPE",
+                   "ADMISSION_LOCATION", "DISCHARGE_LOCATION", "INSURANCE", "LANGUAGE", "RELIGION", "MARITAL_STATUS",
+                   "ETHNICITY", "EDREGTIME", "EDOUTTIME", "DIAGNOSIS", "HOSPITAL_EXPIRE_FLAG", "HAS_CHARTEVENTS_DATA"],
+    "ICUSTAYS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "DBSOURCE", "FIRST_CAREUNIT", "LAST_CAREUNIT",
+                 "FIRST_WARDID", "LAST_WARDID", "INTIME", "OUTTIME", "LOS"],
+    "CHARTEVENTS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "ITEMID", "CHARTTIME", "STORETIME", "CGID",
+                    "VALUE", "VALUENUM", "VALUEUOM", "WARNING", "ERROR", "RESULTSTATUS", "STOPPED"],
+    "PROCEDUREEVENTS_MV": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "STARTTIME", "ENDTIME", "ITEMID", "VALUE",
+                           "VALUEUOM", "LOCATION", "LOCATIONCATEGORY", "STORETIME", "CGID", "ORDERID", "LINKORDERID",
+                           "ORDERCATEGORYNAME", "SECONDARYORDERCATEGORYNAME", "ORDERCATEGORYDESCRIPTION", "ISOPENBAG",
+                           "CONTINUEINNEXTDEPT", "CANCELREASON", "STATUSDESCRIPTION", "COMMENTS_EDITEDBY",
+                           "COMMENTS_CANCELEDBY", "COMMENTS_DATE"],
+    "LABEVENTS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ITEMID", "CHARTTIME", "VALUE", "VALUENUM", "VALUEUOM", "FLAG"],
+    "inputevents_cv": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "CHARTTIME", "ITEMID", "AMOUNT", "AMOUNTUOM",
+                       "RATE", "RATEUOM", "STORETIME", "CGID", "ORDERID", "LINKORDERID", "STOPPED", "NEWBOTTLE",
+                       "ORIGINALAMOUNT", "ORIGINALAMOUNTUOM", "ORIGINALROUTE", "ORIGINALRATE", "ORIGINALRATEUOM",
+                       "ORIGINALSITE"],
+    "inputevents_mv": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "STARTTIME", "ENDTIME", "ITEMID", "AMOUNT",
+                       "AMOUNTUOM", "RATE", "RATEUOM", "STORETIME", "CGID", "ORDERID", "LINKORDERID", "ORDERCATEGORYNAME",
+                       "SECONDARYORDERCATEGORYNAME", "ORDERCOMPONENTTYPEDESCRIPTION", "ORDERCATEGORYDESCRIPTION",
+                       "PATIENTWEIGHT", "TOTALAMOUNT", "TOTALAMOUNTUOM", "ISOPENBAG", "CONTINUEINNEXTDEPT",
+                       "CANCELREASON", "STATUSDESCRIPTION", "COMMENTS_EDITEDBY", "COMMENTS_CANCELEDBY",
+                       "COMMENTS_DATE", "ORIGINALAMOUNT", "ORIGINALRATE"],
+    "OUTPUTEVENTS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "CHARTTIME", "ITEMID", "VALUE", "VALUEUOM",
+                     "STORETIME", "CGID", "STOPPED", "NEWBOTTLE", "ISERROR"],
+    "PRESCRIPTIONS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "ICUSTAY_ID", "STARTDATE", "ENDDATE", "DRUG_TYPE", "DRUG",
+                      "DRUG_NAME_POE", "DRUG_NAME_GENERIC", "FORMULARY_DRUG_CD", "GSN", "NDC", "PROD_STRENGTH",
+                      "DOSE_VAL_RX", "DOSE_UNIT_RX", "FORM_VAL_DISP", "FORM_UNIT_DISP", "ROUTE"],
+    "NOTEEVENTS": ["ROW_ID", "SUBJECT_ID", "HADM_ID", "CHARTDATE", "CHARTTIME", "STORETIME", "CATEGORY",
+                   "DESCRIPTION", "CGID", "ISERROR", "TEXT"],
+}
+
+# Raw MIMIC-III ETHNICITY values and approximate admission shares.
+ETHNICITY_WEIGHTS = {
+    "WHITE": 0.660, "WHITE - RUSSIAN": 0.004, "WHITE - OTHER EUROPEAN": 0.002, "WHITE - EASTERN EUROPEAN": 0.001,
+    "WHITE - BRAZILIAN": 0.001, "BLACK/AFRICAN AMERICAN": 0.090, "BLACK/CAPE VERDEAN": 0.003, "BLACK/HAITIAN": 0.002,
+    "BLACK/AFRICAN": 0.001, "CARIBBEAN ISLAND": 0.0002, "HISPANIC OR LATINO": 0.026,
+    "HISPANIC/LATINO - PUERTO RICAN": 0.0135, "HISPANIC/LATINO - DOMINICAN": 0.0013, "HISPANIC/LATINO - MEXICAN": 0.0003,
+    "ASIAN": 0.021, "ASIAN - CHINESE": 0.005, "ASIAN - INDIAN": 0.001, "UNKNOWN/NOT SPECIFIED": 0.074, "OTHER": 0.027,
+    "UNABLE TO OBTAIN": 0.014, "PATIENT DECLINED TO ANSWER": 0.001, "MULTI RACE ETHNICITY": 0.002,
+    "AMERICAN INDIAN/ALASKA NATIVE": 0.001, "PORTUGUESE": 0.001, "MIDDLE EASTERN": 0.001,
+}
+INSURANCE_VALUES = ["Medicare", "Private", "Medicaid", "Government", "Self Pay"]
+NOTE_CATEGORIES = {"Nursing/other": 0.40, "Radiology": 0.20, "Nursing": 0.10, "ECG": 0.08, "Physician ": 0.07,
+                   "Discharge summary": 0.05, "Echo": 0.04, "Respiratory ": 0.04, "Nutrition": 0.01, "General": 0.01}
+EXTRA_DRUGS = ["Heparin", "Sodium Chloride 0.9%  Flush", "Potassium Chloride", "Furosemide", "Insulin",
+               "Acetaminophen", "Magnesium Sulfate", "D5W", "Senna", "Vancomycin"]
+NOTE_WORDS = np.array((
+    "patient pt denies reports chest pain shortness of breath sob fever chills nausea vomiting abdominal history "
+    "hx hypertension htn diabetes dm copd chf cad afib renal failure aki ckd sepsis pneumonia intubated extubated "
+    "ventilator vent settings peep fio2 tidal volume sedation propofol fentanyl pressors levophed norepinephrine "
+    "lasix diuresis urine output foley lines picc cvl arterial line bp hr rr spo2 sat stable unstable improved "
+    "worsening plan continue monitor labs wbc hct plt creatinine bun lactate abg ph pco2 po2 cxr ct head neg "
+    "family meeting code status full dnr dni consult cardiology nephrology id surgery post op s/p cabg ett tube "
+    "secretions suctioned lungs clear coarse crackles bilateral edema skin intact wound care neuro alert oriented "
+    "follows commands moves all extremities gi tolerating tube feeds npo iv fluids bolus given overnight today "
+    "will recheck am and the with for on to in was is no at by from mg ml q4h prn").split())
+
+def load_01_data():
+    """01_Data.py as a module (it only runs its pipeline under __main__)."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "01_Data.py")
+    spec = importlib.util.spec_from_file_location("mimic_01_data", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def zipf_weights(n, s=0.8):
+    w = 1.0 / np.arange(1, n + 1) ** s
+    return w / w.sum()
+
+def fmt_time(ts):
+    return pd.Series(ts).dt.strftime("%Y-%m-%d %H:%M:%S").values
+
+def fmt_date(ts):
+    return pd.Series(ts).dt.strftime("%Y-%m-%d").values
+
+def sample_rows(rng, probs):
+    """One categorical draw per row of a (n, k) probability matrix."""
+    cum = np.cumsum(probs, axis=1)
+    return (rng.random((len(probs), 1)) * cum[:, -1:] > cum).sum(axis=1)
+
+def with_schema(table, columns):
+    df = pd.DataFrame(columns)
+    for col in SCHEMAS[table]:
+        if col not in df.columns:
+            df[col] = None
+    return df[SCHEMAS[table]]
+
+class SyntheticMimicGenerator(object):
+    def __init__(self, out_dir, seed=42, formats=("csv",), events_scale=1.0, compresslevel=4):
+        self.out_dir = out_dir
+        self.rng = np.random.default_rng(seed)
+        self.formats = formats
+        self.events_scale = events_scale
+        self.compresslevel = compresslevel
+        data = load_01_data()
+        self.data = data
+        self.vent_itemids = list(data.vent_itemids)
+        self.feature_items = {k: list(dict.fromkeys(v)) for k, v in data.feature_set_C_items.items()}
+        vent = set(self.vent_itemids)
+        # Feature items that are also ventilation items would flag every stay as ventilated.
+        self.chart_items_nonvent = [i for i in self.feature_items["chartevents"] if i not in vent]
+        all_items = sorted(set(self.feature_items["chartevents"]) | set(self.feature_items["labevents"])
+                           | set(self.feature_items["inputevents"]) | set(self.feature_items["outputevents"]) | vent)
+        item_rng = np.random.default_rng(seed + 1)
+        self.item_mean = dict(zip(all_items, item_rng.uniform(5, 150, len(all_items))))
+        self.row_ids = {table: 0 for table in SCHEMAS}
+        self.row_counts = {table: 0 for table in SCHEMAS}
+        self.parquet_writers = {}
+        self.next_ids = {"subject": 1, "hadm": 100001, "icustay": 200001}
+        os.makedirs(out_dir, exist_ok=True)
+
+    # ---- output ----
+    def write(self, table, df):
+        if len(df) == 0:
+            return
+        df = df.copy()
+        df["ROW_ID"] = np.arange(self.row_ids[table] + 1, self.row_ids[table] + len(df) + 1)
+        self.row_ids[table] += len(df)
+        first = self.row_counts[table] == 0
+        self.row_counts[table] += len(df)
+        if "csv" in self.formats:
+            path = os.path.join(self.out_dir, table + ".csv.gz")
+            with gzip.open(path, "wt" if first else "at", compresslevel=self.compresslevel, newline="") as f:
+                df.to_csv(f, header=first, index=False)
+        if "parquet" in self.formats:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if table not in self.parquet_writers:
+                arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+                self.parquet_writers[table] = pq.ParquetWriter(os.path.join(self.out_dir, table + ".parquet"), arrow_table.schema)
+            writer = self.parquet_writers[table]
+            writer.write_table(pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False))
+
+    def close(self):
+        for writer in self.parquet_writers.values():
+            writer.close()
+        self.parquet_writers = {}
+
+    # ---- core tables ----
+    def generate_patients(self, n):
+        rng = self.rng
+        subject_ids = np.arange(self.next_ids["subject"], self.next_ids["subject"] + n)
+        self.next_ids["subject"] += n
+        gender = np.where(rng.random(n) < 0.56, "M", "F")
+        age = np.where(rng.random(n) < 0.65, rng.normal(68, 13, n), rng.normal(45, 15, n)).clip(16, 89)
+        age = np.where(rng.random(n) < 0.025, rng.uniform(299.5, 305, n), age)  # MIMIC shifts DOB of patients > 89
+        eth_names = np.array(list(ETHNICITY_WEIGHTS.keys()))
+        eth_p = np.array(list(ETHNICITY_WEIGHTS.values()))
+        eth_codes = rng.choice(len(eth_names), size=n, p=eth_p / eth_p.sum())
+        ethnicity = eth_names[eth_codes]
+        eth_cat = np.array([self.data.categorize_ethnicity(e) for e in eth_names])[eth_codes]
+        # Insurance: Medicare for most patients >= 65, more Medicaid among Black and Hispanic patients.
+        old = (age >= 65)[:, None]
+        probs = np.where(old, [0.86, 0.10, 0.02, 0.015, 0.005], [0.12, 0.58, 0.20, 0.06, 0.04])
+        probs = probs * np.where(np.isin(eth_cat, ["Black", "Hispanic"])[:, None], [1.0, 0.7, 2.2, 1.0, 1.3], 1.0)
+        insurance = np.array(INSURANCE_VALUES)[sample_rows(rng, probs)]
+        return pd.DataFrame({"SUBJECT_ID": subject_ids, "GENDER": gender, "age": age,
+                             "ETHNICITY": ethnicity, "INSURANCE": insurance})
+
+    def generate_stays(self, patients):
+        rng = self.rng
+        n_stays = 1 + (rng.random(len(patients)) < 0.12)  # some patients are readmitted
+        stays = patients.loc[patients.index.repeat(n_stays)].reset_index(drop=True)
+        n = len(stays)
+        stays["stay_number"] = stays.groupby("SUBJECT_ID").cumcount()
+        base = pd.Timestamp("2100-01-01") + pd.to_timedelta(rng.uniform(0, 100 * 365, len(patients)), unit="D")
+        stays["INTIME"] = base.values.repeat(n_stays) + pd.to_timedelta(stays["stay_number"].values * rng.uniform(30, 900, n), unit="D").values
+        stays["INTIME"] = pd.to_datetime(stays["INTIME"]).dt.round("min")
+        los_hours = np.exp(rng.normal(np.log(50), 0.8, n)).clip(4, 2000)
+        stays["OUTTIME"] = (stays["INTIME"] + pd.to_timedelta(los_hours, unit="h")).dt.round("min")
+        stays["los_hours"] = los_hours
+        stays["ADMITTIME"] = stays["INTIME"] - pd.to_timedelta(rng.exponential(10, n), unit="h").round("min")
+        stays["DISCHTIME"] = stays["OUTTIME"] + pd.to_timedelta(rng.exponential(72, n), unit="h").round("min")
+        age_now = stays["age"].values + stays["stay_number"].values * 0.5
+        p_death = 1 / (1 + np.exp(-(-3.0 + 0.035 * (np.minimum(age_now, 90) - 60) + 0.4 * np.log(los_hours / 50))))
+        died = rng.random(n) < p_death
+        death = stays["INTIME"] + pd.to_timedelta(rng.uniform(0.2, 1.0, n) * los_hours, unit="h")
+        stays["DEATHTIME"] = death.where(died).dt.round("min")
+        stays["DISCHTIME"] = stays["DISCHTIME"].where(~died, stays["DEATHTIME"])
+        stays["ventilated"] = rng.random(n) < (0.30 + 0.25 * died + 0.15 * (los_hours > 72))
+        stays["metavision"] = rng.random(n) < 0.45
+        stays["HADM_ID"] = np.arange(self.next_ids["hadm"], self.next_ids["hadm"] + n)
+        stays["ICUSTAY_ID"] = np.arange(self.next_ids["icustay"], self.next_ids["icustay"] + n)
+        self.next_ids["hadm"] += n
+        self.next_ids["icustay"] += n
+        return stays
+
+    def event_times(self, stays, counts, first_day_share=0.8):
+        """Event timestamps per stay: mostly in [-2h, 26h] around INTIME, the rest anywhere in the stay."""
+        rng = self.rng
+        idx = np.repeat(np.arange(len(stays)), counts)
+        los = stays["los_hours"].values[idx]
+        early = rng.random(len(idx)) < first_day_share
+        offset = np.where(early, rng.uniform(-2, 26, len(idx)), rng.uniform(0, 1, len(idx)) * los)
+        times = stays["INTIME"].values[idx] + pd.to_timedelta(offset, unit="h").values
+        return idx, pd.to_datetime(times).round("min")
+
+    def numeric_values(self, items):
+        means = np.array([self.item_mean.get(i, 50.0) for i in items])
+        return np.round(self.rng.normal(means, 0.15 * means), 2)
+
+    def core_tables(self, patients, stays):
+        rng = self.rng
+        intime_first = stays.groupby("SUBJECT_ID")["INTIME"].min().reindex(patients["SUBJECT_ID"]).values
+        dob = pd.to_datetime(intime_first) - pd.to_timedelta(patients["age"].values * 365.25, unit="D")
+        dob = pd.Series(dob).dt.normalize()
+        dod = stays.groupby("SUBJECT_ID")["DEATHTIME"].max().reindex(patients["SUBJECT_ID"]).values
+        self.write("PATIENTS", with_schema("PATIENTS", {
+            "SUBJECT_ID": patients["SUBJECT_ID"].values, "GENDER": patients["GENDER"].values,
+            "DOB": fmt_time(dob), "DOD": fmt_time(pd.Series(dod).dt.normalize()),
+            "EXPIRE_FLAG": pd.notnull(dod).astype(int)}))
+        m = len(stays)
+        self.write("ADMISSIONS", with_schema("ADMISSIONS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values, "HADM_ID": stays["HADM_ID"].values,
+            "ADMITTIME": fmt_time(stays["ADMITTIME"]), "DISCHTIME": fmt_time(stays["DISCHTIME"]),
+            "DEATHTIME": fmt_time(stays["DEATHTIME"]),
+            "ADMISSION_TYPE": np.where(rng.random(m) < 0.8, "EMERGENCY", "ELECTIVE"),
+            "INSURANCE": stays["INSURANCE"].values, "ETHNICITY": stays["ETHNICITY"].values,
+            "HOSPITAL_EXPIRE_FLAG": stays["DEATHTIME"].notnull().astype(int).values, "HAS_CHARTEVENTS_DATA": 1}))
+        units = np.array(["MICU", "SICU", "CCU", "CSRU", "TSICU"])
+        unit = units[rng.integers(0, len(units), m)]
+        self.write("ICUSTAYS", with_schema("ICUSTAYS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values, "HADM_ID": stays["HADM_ID"].values,
+            "ICUSTAY_ID": stays["ICUSTAY_ID"].values,
+            "DBSOURCE": np.where(stays["metavision"].values, "metavision", "carevue"),
+            "FIRST_CAREUNIT": unit, "LAST_CAREUNIT": unit,
+            "FIRST_WARDID": rng.integers(1, 60, m), "LAST_WARDID": rng.integers(1, 60, m),
+            "INTIME": fmt_time(stays["INTIME"]), "OUTTIME": fmt_time(stays["OUTTIME"]),
+            "LOS": np.round(stays["los_hours"].values / 24, 4)}))
+
+    # ---- event tables ----
+    def chartevents(self, stays):
+        rng = self.rng
+        counts = rng.poisson(150 * self.events_scale, len(stays))
+        idx, times = self.event_times(stays, counts)
+        items = np.array(self.chart_items_nonvent)[rng.choice(len(self.chart_items_nonvent), len(idx),
+                                                              p=zipf_weights(len(self.chart_items_nonvent)))]
+        values = self.numeric_values(items)
+        frame = {"idx": idx, "ITEMID": items, "times": times, "VALUE": values.astype(str), "VALUENUM": values}
+
+        # Ventilation rows only for ventilated stays.
+        vent_stays = np.nonzero(stays["ventilated"].values)[0]
+        vent_counts = rng.poisson(12 * self.events_scale, len(vent_stays)) + 1
+        vidx_local, vtimes = self.event_times(stays.iloc[vent_stays], vent_counts, first_day_share=0.9)
+        vidx = vent_stays[vidx_local]
+        vitems = np.array(self.vent_itemids)[rng.choice(len(self.vent_itemids), len(vidx), p=zipf_weights(len(self.vent_itemids), 1.1))]
+        vnum = self.numeric_values(vitems)
+        vvalues = vnum.astype(str).astype(object)
+        text_values = {720: ["Assist Control", "SIMV+PS", "CPAP/PSV"], 223848: ["Drager", "PB 7200", "Avea"],
+                       467: ["Ventilator", "Nasal Cannula", "Face Tent"], 226732: ["Nasal cannula", "Non-rebreather", "High flow nasal cannula"]}
+        for item, choices in text_values.items():
+            mask = vitems == item
+            vvalues[mask] = np.array(choices)[rng.integers(0, len(choices), mask.sum())]
+        text_mask = np.isin(vitems, list(text_values.keys()))
+        vnum = np.where(text_mask, np.nan, vnum)
+        # A share of ventilated stays ends with an extubation charted on itemid 640.
+        ext = vent_stays[rng.random(len(vent_stays)) < 0.5]
+        ext_times = stays["INTIME"].values[ext] + pd.to_timedelta(rng.uniform(4, 26, len(ext)), unit="h").values
+        frame = {
+            "idx": np.concatenate([idx, vidx, ext]),
+            "ITEMID": np.concatenate([items, vitems, np.full(len(ext), 640)]),
+            "times": np.concatenate([times.values, vtimes.values, pd.to_datetime(ext_times).round("min").values]),
+            "VALUE": np.concatenate([frame["VALUE"].astype(object), vvalues,
+                                     np.where(rng.random(len(ext)) < 0.05, "Self Extubation", "Extubated")]),
+            "VALUENUM": np.concatenate([values, vnum, np.full(len(ext), np.nan)]),
+        }
+        k = len(frame["idx"])
+        error = np.where(rng.random(k) < 0.002, 1, 0).astype(object)
+        error[stays["metavision"].values[frame["idx"]]] = None  # ERROR is only filled for carevue rows
+        self.write("CHARTEVENTS", with_schema("CHARTEVENTS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values[frame["idx"]], "HADM_ID": stays["HADM_ID"].values[frame["idx"]],
+            "ICUSTAY_ID": stays["ICUSTAY_ID"].values[frame["idx"]], "ITEMID": frame["ITEMID"],
+            "CHARTTIME": fmt_time(frame["times"]), "STORETIME": fmt_time(pd.to_datetime(frame["times"]) + pd.Timedelta(minutes=15)),
+            "CGID": rng.integers(14000, 21000, k), "VALUE": frame["VALUE"], "VALUENUM": frame["VALUENUM"], "ERROR": error}))
+
+        # PROCEDUREEVENTS_MV extubations (metavision stays only).
+        mv_ext = np.nonzero(stays["ventilated"].values & stays["metavision"].values & (rng.random(len(stays)) < 0.6))[0]
+        start = stays["INTIME"].values[mv_ext] + pd.to_timedelta(rng.uniform(4, 40, len(mv_ext)), unit="h").values
+        start = pd.to_datetime(start).round("min")
+        self.write("PROCEDUREEVENTS_MV", with_schema("PROCEDUREEVENTS_MV", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values[mv_ext], "HADM_ID": stays["HADM_ID"].values[mv_ext],
+            "ICUSTAY_ID": stays["ICUSTAY_ID"].values[mv_ext], "STARTTIME": fmt_time(start),
+            "ENDTIME": fmt_time(start + pd.Timedelta(minutes=1)),
+            "ITEMID": np.array([227194, 225468, 225477])[rng.choice(3, len(mv_ext), p=[0.8, 0.05, 0.15])],
+            "VALUE": 1, "VALUEUOM": "None", "STATUSDESCRIPTION": "FinishedRunning"}))
+
+    def labevents(self, stays):
+        rng = self.rng
+        items_all = self.feature_items["labevents"]
+        idx, times = self.event_times(stays, rng.poisson(40 * self.events_scale, len(stays)))
+        items = np.array(items_all)[rng.choice(len(items_all), len(idx), p=zipf_weights(len(items_all)))]
+        values = self.numeric_values(items)
+        values = np.where(rng.random(len(idx)) < 0.03, np.nan, values)
+        self.write("LABEVENTS", with_schema("LABEVENTS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values[idx], "HADM_ID": stays["HADM_ID"].values[idx], "ITEMID": items,
+            "CHARTTIME": fmt_time(times), "VALUE": np.where(np.isnan(values), "ERROR", values.astype(str)),
+            "VALUENUM": values, "VALUEUOM": "mg/dL", "FLAG": np.where(rng.random(len(idx)) < 0.3, "abnormal", None)}))
+
+    def inputevents(self, stays):
+        rng = self.rng
+        items_all = self.feature_items["inputevents"]
+        for table, use_mv in [("inputevents_cv", False), ("inputevents_mv", True)]:
+            items_src = [i for i in items_all if (i >= 200000) == use_mv]
+            sub = np.nonzero(stays["metavision"].values == use_mv)[0]
+            idx_local, times = self.event_times(stays.iloc[sub], rng.poisson(20 * self.events_scale, len(sub)))
+            idx = sub[idx_local]
+            items = np.array(items_src)[rng.choice(len(items_src), len(idx), p=zipf_weights(len(items_src)))]
+            amount = np.round(np.exp(rng.normal(3.5, 1.2, len(idx))), 2)
+            cols = {"SUBJECT_ID": stays["SUBJECT_ID"].values[idx], "HADM_ID": stays["HADM_ID"].values[idx],
+                    "ICUSTAY_ID": stays["ICUSTAY_ID"].values[idx], "ITEMID": items, "AMOUNT": amount, "AMOUNTUOM": "ml",
+                    "STORETIME": fmt_time(times + pd.Timedelta(minutes=10)), "CGID": rng.integers(14000, 21000, len(idx)),
+                    "ORDERID": rng.integers(1, 10 ** 7, len(idx))}
+            if use_mv:
+                cols.update({"STARTTIME": fmt_time(times), "ENDTIME": fmt_time(times + pd.Timedelta(hours=1)),
+                             "STATUSDESCRIPTION": "FinishedRunning", "PATIENTWEIGHT": np.round(rng.normal(80, 18, len(idx)), 1)})
+            else:
+                cols.update({"CHARTTIME": fmt_time(times)})
+            self.write(table, with_schema(table, cols))
+
+    def outputevents(self, stays):
+        rng = self.rng
+        items_all = self.feature_items["outputevents"]
+        idx, times = self.event_times(stays, rng.poisson(10 * self.events_scale, len(stays)))
+        items = np.array(items_all)[rng.choice(len(items_all), len(idx), p=zipf_weights(len(items_all), 1.2))]
+        self.write("OUTPUTEVENTS", with_schema("OUTPUTEVENTS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values[idx], "HADM_ID": stays["HADM_ID"].values[idx],
+            "ICUSTAY_ID": stays["ICUSTAY_ID"].values[idx], "CHARTTIME": fmt_time(times), "ITEMID": items,
+            "VALUE": np.round(np.exp(rng.normal(4.5, 0.8, len(idx)))), "VALUEUOM": "ml",
+            "STORETIME": fmt_time(times + pd.Timedelta(minutes=5)), "CGID": rng.integers(14000, 21000, len(idx))}))
+
+    def prescriptions(self, stays):
+        rng = self.rng
+        drugs = np.array(self.feature_items["prescriptions"] + EXTRA_DRUGS)
+        idx, times = self.event_times(stays, rng.poisson(8 * self.events_scale, len(stays)))
+        drug = drugs[rng.choice(len(drugs), len(idx), p=zipf_weights(len(drugs), 0.6))]
+        start = times.normalize()
+        self.write("PRESCRIPTIONS", with_schema("PRESCRIPTIONS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values[idx], "HADM_ID": stays["HADM_ID"].values[idx],
+            "ICUSTAY_ID": stays["ICUSTAY_ID"].values[idx], "STARTDATE": fmt_time(start),
+            "ENDDATE": fmt_time(start + pd.to_timedelta(rng.integers(1, 6, len(idx)), unit="D")),
+            "DRUG_TYPE": "MAIN", "DRUG": drug, "DRUG_NAME_POE": drug, "DRUG_NAME_GENERIC": drug,
+            "DOSE_VAL_RX": rng.integers(1, 500, len(idx)), "DOSE_UNIT_RX": "mg", "ROUTE": "PO"}))
+
+    def noteevents(self, stays):
+        rng = self.rng
+        counts = np.minimum(rng.poisson(1 + 2 * stays["los_hours"].values / 24), 60)
+        idx = np.repeat(np.arange(len(stays)), counts)
+        n = len(idx)
+        names = np.array(list(NOTE_CATEGORIES.keys()))
+        p = np.array(list(NOTE_CATEGORIES.values()))
+        category = names[rng.choice(len(names), n, p=p / p.sum())]
+        # Heavy-tailed note lengths (words): log-normal, discharge summaries ~6x longer.
+        lengths = np.exp(rng.normal(np.log(220), 0.9, n)) * np.where(category == "Discharge summary", 6.0, 1.0)
+        lengths = lengths.clip(5, 12000).astype(np.int64)
+        words = NOTE_WORDS[rng.integers(0, len(NOTE_WORDS), lengths.sum())]
+        bounds = np.cumsum(lengths)[:-1]
+        chartdate = (stays["INTIME"].values[idx] + pd.to_timedelta(rng.uniform(0, 1, n) * (stays["los_hours"].values[idx] + 24), unit="h").values)
+        chartdate = pd.to_datetime(chartdate)
+        texts = []
+        for i, chunk in enumerate(np.split(words, bounds)):
+            header = f"Admission Date:  [**{chartdate[i]:%Y-%m-%d}**]\n1. " if category[i] == "Discharge summary" else ""
+            texts.append(header + " ".join(chunk))
+        self.write("NOTEEVENTS", with_schema("NOTEEVENTS", {
+            "SUBJECT_ID": stays["SUBJECT_ID"].values[idx], "HADM_ID": stays["HADM_ID"].values[idx],
+            "CHARTDATE": fmt_date(chartdate), "CHARTTIME": fmt_time(chartdate.round("min")),
+            "CATEGORY": category, "DESCRIPTION": "Report", "CGID": rng.integers(14000, 21000, n), "TEXT": texts}))
+
+    def generate(self, n_patients, chunk_size=20000):
+        start = time.time()
+        for offset in range(0, n_patients, chunk_size):
+            n = min(chunk_size, n_patients - offset)
+            patients = self.generate_patients(n)
+            stays = self.generate_stays(patients)
+            self.core_tables(patients, stays)
+            self.chartevents(stays)
+            self.labevents(stays)
+            self.inputevents(stays)
+            self.outputevents(stays)
+            self.prescriptions(stays)
+            self.noteevents(stays)
+            print(f"  {offset + n}/{n_patients} patients ({time.time() - start:.1f}s)")
+        self.close()
+        manifest = {"patients": n_patients, "formats": list(self.formats), "events_scale": self.events_scale,
+                    "rows": self.row_counts, "seconds": round(time.time() - start, 1)}
+        with open(os.path.join(self.out_dir, "synthetic_manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+def describe(out_dir):
+    """Category shares after 01_Data.py's categorization, as a check of the demographic skew."""
+    data = load_01_data()
+    admissions = pd.read_csv(os.path.join(out_dir, "ADMISSIONS.csv.gz"), usecols=["ETHNICITY", "INSURANCE", "DEATHTIME"])
+    print("Ethnicity categories:", admissions["ETHNICITY"].map(data.categorize_ethnicity).value_counts(normalize=True).round(3).to_dict())
+    print("Insurance categories:", admissions["INSURANCE"].map(data.categorize_insurance).value_counts(normalize=True).round(3).to_dict())
+    print("In-hospital deaths:", round(admissions["DEATHTIME"].notnull().mean(), 3))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic MIMIC-III tables for benchmarking 01_Data.py and the Final scripts.")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--out_dir", default="synthetic_mimic")
+    parser.add_argument("--formats", nargs="+", choices=["csv", "parquet"], default=["csv"])
+    parser.add_argument("--chunk_size", type=int, default=20000, help="Patients generated and appended per chunk.")
+    parser.add_argument("--events_scale", type=float, default=1.0, help="Multiplier on the event counts per ICU stay.")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    generator = SyntheticMimicGenerator(args.out_dir, seed=args.seed, formats=args.formats, events_scale=args.events_scale)
+    manifest = generator.generate(args.patients, chunk_size=args.chunk_size)
+    print(json.dumps(manifest["rows"], indent=2))
+    if "csv" in args.formats:
+        describe(args.out_dir)